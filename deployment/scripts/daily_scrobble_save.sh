@@ -5,6 +5,5 @@ CUR_DATE=$(date '+%F')
 source $HOME/.profile
 
 pushd ${PROJECT_DIR}
-just run-command import_scrobbles "${PROJECT_DIR}/scrobbles/scrobbles_${CUR_DATE}.json" database \
-     --failed-scrobbles-file="${PROJECT_DIR}/scrobbles/failed_scrobbles_${CUR_DATE}.json"
+just run-command import_scrobbles "${PROJECT_DIR}/scrobbles/scrobbles_${CUR_DATE}.jsonl" database
 popd
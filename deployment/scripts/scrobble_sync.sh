@@ -0,0 +1,8 @@
+#!/usr/bin/env bash
+
+PROJECT_DIR=$(dirname $(dirname $(dirname "$0")))
+source $HOME/.profile
+
+pushd ${PROJECT_DIR}
+just run-command import_scrobbles sync
+popd
@@ -1,13 +1,105 @@
+import threading
+import time
+
 from django.contrib.auth.backends import BaseBackend
 from django.contrib.auth.models import User
 
-from .models import ApiKey
+from .models import ApiKey, MobileSession
+
+# marks a key that isn't in the cache, as opposed to one cached as not existing
+MISSING = object()
+
+
+class AuthCache:
+    """
+    Short-lived, thread-safe cache of API keys, session keys and their users, so
+    authenticating bridge requests doesn't need any queries. Entries are dropped
+    when the keys or users change (see signals) and otherwise expire after the
+    TTL, which covers changes made by other processes.
+    """
+
+    def __init__(self, ttl=300):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+
+    def get(self, kind, key):
+        with self._lock:
+            entry = self._entries.get((kind, key))
+            if entry is None:
+                return MISSING
+            expires_at, _, value = entry
+            if expires_at <= time.monotonic():
+                del self._entries[(kind, key)]
+                return MISSING
+            return value
+
+    def set(self, kind, key, value, user_id=None):
+        with self._lock:
+            self._entries[(kind, key)] = (time.monotonic() + self.ttl, user_id, value)
+
+    def invalidate(self, kind, key):
+        with self._lock:
+            self._entries.pop((kind, key), None)
+
+    def invalidate_user(self, user_id):
+        with self._lock:
+            self._entries = {
+                cache_key: entry
+                for cache_key, entry in self._entries.items()
+                if entry[1] != user_id
+            }
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+auth_cache = AuthCache()
 
 
 class ApiKeyAuthBackend(BaseBackend):
     def get_user(self, user_id):
-        return User.objects.get(pk=user_id)
+        user = auth_cache.get("user", user_id)
+        if user is MISSING:
+            user = User.objects.filter(pk=user_id).first()
+            auth_cache.set("user", user_id, user, user_id=user_id)
+        return user
+
+    def authenticate(self, request, api_key=None, session_key=None, **kwargs):
+        if api_key is None:
+            return None
+        found_key = auth_cache.get("api_key", api_key)
+        if found_key is MISSING:
+            found_data = ApiKey.objects.filter(name__exact=api_key).first()
+            found_key = (
+                (found_data.pk, found_data.user_id, found_data.is_active)
+                if found_data
+                else None
+            )
+            auth_cache.set(
+                "api_key", api_key, found_key, user_id=found_key and found_key[1]
+            )
+        if not found_key:
+            return None
+        api_key_id, user_id, is_active = found_key
+        if not is_active:
+            return None
+
+        if session_key:
+            session = auth_cache.get("session", session_key)
+            if session is MISSING:
+                session = (
+                    MobileSession.objects.filter(key=session_key)
+                    .values_list("api_key_id", "user_id")
+                    .first()
+                )
+                auth_cache.set(
+                    "session", session_key, session, user_id=session and session[1]
+                )
+            # sessions are only valid for the API key that started them
+            if session != (api_key_id, user_id):
+                return None
 
-    def authenticate(self, request, api_key=None, **kwargs):
-        found_data = ApiKey.objects.filter(name__exact=api_key).first()
-        return found_data.user if found_data else None
+        user = self.get_user(user_id)
+        return user if user and user.is_active else None
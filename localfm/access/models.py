@@ -1,3 +1,5 @@
+import secrets
+
 from django.contrib.auth.models import User
 from django.db import models
 from django.db.models import ForeignKey
@@ -10,3 +12,19 @@ class ApiKey(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
     is_active = models.BooleanField()
+
+
+class MobileSession(models.Model):
+    """
+    Session keys issued to players by auth.getMobileSession, sent by the player
+    with each subsequent request.
+    """
+
+    user = ForeignKey(User, on_delete=models.CASCADE, related_name="mobile_sessions")
+    api_key = ForeignKey(ApiKey, on_delete=models.CASCADE, related_name="sessions")
+    key = models.CharField(max_length=32, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    @classmethod
+    def start(cls, user, api_key: ApiKey) -> "MobileSession":
+        return cls.objects.create(user=user, api_key=api_key, key=secrets.token_hex(16))
@@ -0,0 +1,23 @@
+from django.contrib.auth.models import User
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .auth_backend import auth_cache
+from .models import ApiKey, MobileSession
+
+
+@receiver([post_save, post_delete], sender=User)
+def invalidate_user(sender, instance, **kwargs):
+    auth_cache.invalidate_user(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=ApiKey)
+def invalidate_api_key(sender, instance, **kwargs):
+    # the key could have been renamed, so drop everything cached for the user
+    auth_cache.invalidate("api_key", instance.name)
+    auth_cache.invalidate_user(instance.user_id)
+
+
+@receiver([post_save, post_delete], sender=MobileSession)
+def invalidate_session(sender, instance, **kwargs):
+    auth_cache.invalidate("session", instance.key)
@@ -1,2 +1,40 @@
+from django.contrib.auth import authenticate
+
+from localfm.core.responses import lastfm_error_response, lastfm_response
+
+from .models import ApiKey, MobileSession
+
+AUTHENTICATION_FAILED = 4
+
+
 def get_mobile_session(request):
-    pass
+    """
+    Starts a session for the player, authenticated by the user's username and
+    password. The session key is then sent by the player as sk with each request.
+    """
+    user = authenticate(
+        request,
+        username=request.POST.get("username"),
+        password=request.POST.get("password"),
+    )
+    api_key = None
+    if user is not None and user == request.user:
+        api_key = ApiKey.objects.filter(
+            name=request.POST.get("api_key"), user=user
+        ).first()
+    if api_key is None:
+        return lastfm_error_response(
+            request, AUTHENTICATION_FAILED, "Authentication Failed", status=403
+        )
+    session = MobileSession.start(user, api_key)
+    return lastfm_response(
+        request,
+        {
+            "@status": "ok",
+            "session": {
+                "name": user.get_username(),
+                "key": session.key,
+                "subscriber": 0,
+            },
+        },
+    )
@@ -0,0 +1,186 @@
+"""
+Fake of the Last.fm web service for tests, served over HTTP on localhost so that
+the client can be pointed at it (e.g. with LASTFM_API_URL). Only the methods the
+bridge uses are faked, along with Last.fm's rate limiting and failed requests.
+"""
+
+import json
+import threading
+import time
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+from .lastfm import (
+    ERROR_INVALID_PARAMETERS,
+    ERROR_OPERATION_FAILED,
+    ERROR_RATE_LIMIT_EXCEEDED,
+)
+from .scrobbles import Scrobble
+
+
+class FakeLastfm:
+    """
+    Serves the scrobbles and album names it's given, taking the given latency
+    (in seconds) to answer each request. Requests beyond the maximum per second
+    are refused with the rate limit error, sent with the given HTTP status, and
+    pages can be made to fail with fail_page.
+    """
+
+    def __init__(
+        self,
+        scrobbles: list[Scrobble] = (),
+        albums: dict[tuple[str, str], str] | None = None,
+        max_requests_per_second=None,
+        rate_limit_status=429,
+        now_playing: Scrobble | None = None,
+        latency=0,
+    ):
+        self.scrobbles = sorted(
+            scrobbles, key=lambda scrobble: scrobble.occurred_on, reverse=True
+        )
+        self.albums = albums or {}
+        self.max_requests_per_second = max_requests_per_second
+        self.rate_limit_status = rate_limit_status
+        self.now_playing = now_playing
+        self.latency = latency
+        self.requests = []
+        self.rate_limited = 0
+        self._page_failures = {}
+        self._requested_at = deque()
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler_class())
+        self._thread = None
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}/2.0/"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def fail_page(self, page, times=None, code=ERROR_OPERATION_FAILED, status=500):
+        """
+        Fails requests for the page of recent tracks the given number of times, or
+        every time if it isn't given.
+        """
+        with self._lock:
+            self._page_failures[page] = [times, code, status]
+
+    def handle(self, params) -> tuple[int, dict]:
+        with self._lock:
+            self.requests.append(params)
+            if self._is_rate_limited():
+                self.rate_limited += 1
+                return self.rate_limit_status, {
+                    "error": ERROR_RATE_LIMIT_EXCEEDED,
+                    "message": "Rate Limit Exceeded",
+                }
+        if self.latency:
+            time.sleep(self.latency)
+        method = params.get("method")
+        if method == "user.getRecentTracks":
+            return self._get_recent_tracks(params)
+        if method == "track.getInfo":
+            return self._get_track_info(params)
+        return 400, {"error": 3, "message": "Invalid Method"}
+
+    def _is_rate_limited(self):
+        if self.max_requests_per_second is None:
+            return False
+        now = time.monotonic()
+        while self._requested_at and self._requested_at[0] <= now - 1:
+            self._requested_at.popleft()
+        if len(self._requested_at) >= self.max_requests_per_second:
+            return True
+        self._requested_at.append(now)
+        return False
+
+    def _get_recent_tracks(self, params) -> tuple[int, dict]:
+        page = int(params.get("page", 1))
+        with self._lock:
+            failure = self._page_failures.get(page)
+            if failure and failure[0] != 0:
+                if failure[0] is not None:
+                    failure[0] -= 1
+                return failure[2], {"error": failure[1], "message": "Operation failed"}
+        start = int(params.get("from", 0))
+        end = int(params.get("to", 2**31))
+        page_size = int(params.get("limit", 50))
+        scrobbles = [
+            scrobble
+            for scrobble in self.scrobbles
+            if start <= scrobble.occurred_on.timestamp() <= end
+        ]
+        tracks = [
+            to_track_data(scrobble)
+            for scrobble in scrobbles[(page - 1) * page_size : page * page_size]
+        ]
+        if self.now_playing and page == 1:
+            now_playing = to_track_data(self.now_playing)
+            now_playing["@attr"] = {"nowplaying": "true"}
+            del now_playing["date"]
+            tracks.insert(0, now_playing)
+        return 200, {
+            "recenttracks": {
+                "track": tracks,
+                "@attr": {
+                    "page": str(page),
+                    "perPage": str(page_size),
+                    "totalPages": str(max(1, -(-len(scrobbles) // page_size))),
+                    "total": str(len(scrobbles)),
+                },
+            }
+        }
+
+    def _get_track_info(self, params) -> tuple[int, dict]:
+        key = (params.get("artist"), params.get("track"))
+        if key not in self.albums:
+            return 200, {
+                "error": ERROR_INVALID_PARAMETERS,
+                "message": "Track not found",
+            }
+        track = {"name": key[1], "artist": {"name": key[0]}}
+        if self.albums[key]:
+            track["album"] = {"title": self.albums[key]}
+        return 200, {"track": track}
+
+    def _handler_class(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                status, body = fake.handle(dict(parse_qsl(urlparse(self.path).query)))
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def to_track_data(scrobble: Scrobble) -> dict:
+    return {
+        "name": scrobble.track_name,
+        "artist": {"#text": scrobble.artist_name or ""},
+        "album": {"#text": scrobble.album_name or ""},
+        "date": {"uts": str(int(scrobble.occurred_on.timestamp()))},
+    }
@@ -0,0 +1,291 @@
+"""
+Write-behind ingestion of scrobbles sent to the Last.fm bridge.
+
+Accepted scrobbles are appended to a local journal and fsync'd before the request
+is acknowledged, then a background thread drains the journal into the DB in
+batches. The journal is split into segments that are only removed once all of
+their scrobbles have been committed, so anything left over from a crash or a DB
+outage is replayed when the service next drains it. Recording track plays is
+idempotent, so replaying a partly committed segment is harmless. Scrobbles that
+can't be saved even on their own are moved to a dead letter file, so that they
+don't hold up the rest of the journal.
+"""
+
+import json
+import logging
+import os
+import threading
+import time
+from collections.abc import Iterable, Iterator
+from itertools import batched
+from pathlib import Path
+
+from django.conf import settings
+from django.db import InterfaceError, OperationalError, connections, transaction
+
+from localfm.core.runtime import CancellationToken
+from localfm.tracks.matching import resolve_tracks
+from localfm.tracks.models import TrackPlay, UnmatchedScrobble
+
+from .scrobbles import Scrobble, ScrobbleEncoder, to_scrobble
+
+logger = logging.getLogger(__name__)
+
+SEGMENT_SUFFIX = ".jsonl"
+DEAD_LETTER_DIRECTORY = "dead_letter"
+
+
+def record_scrobbles(scrobbles: list[Scrobble]) -> tuple[int, list[Scrobble]]:
+    """
+    Records the scrobbles as track plays in a single transaction, keeping those
+    that can't be matched to a track as unmatched scrobbles. Returns the number
+    of new plays along with the unmatched scrobbles.
+    """
+    track_ids = resolve_tracks(
+        [
+            (scrobble.artist_name, scrobble.track_name, scrobble.album_name)
+            for scrobble in scrobbles
+        ]
+    )
+    plays = []
+    unmatched_scrobbles = []
+    for scrobble, track_id in zip(scrobbles, track_ids):
+        if scrobble.occurred_on is None:
+            logger.warning("Skipping scrobble without a timestamp: %s", scrobble)
+        elif track_id is None:
+            logger.warning("Unable to find track: %s", scrobble)
+            unmatched_scrobbles.append(scrobble)
+        else:
+            plays.append((track_id, scrobble.occurred_on))
+    with transaction.atomic():
+        new_plays = TrackPlay.bulk_record(plays)
+        UnmatchedScrobble.bulk_add(unmatched_scrobbles)
+    return new_plays, unmatched_scrobbles
+
+
+class ScrobbleJournal:
+    """
+    Append-only journal of scrobbles waiting to be saved, kept as numbered
+    segment files of JSON Lines in the journal directory.
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._condition = threading.Condition()
+        self._fd = None
+        self._pending = 0
+        segments = self.segments()
+        self._next_sequence = int(segments[-1].stem) + 1 if segments else 0
+
+    def segments(self) -> list[Path]:
+        return sorted(self.directory.glob(f"*{SEGMENT_SUFFIX}"))
+
+    def append(self, scrobbles: Iterable[Scrobble]):
+        """
+        Durably appends the scrobbles to the current segment, only returning once
+        they've been flushed to disk.
+        """
+        data = self._encode(scrobbles)
+        if not data:
+            return
+        with self._condition:
+            if self._fd is None:
+                self._open_segment()
+            os.write(self._fd, data)
+            os.fsync(self._fd)
+            self._pending += 1
+            self._condition.notify_all()
+
+    def _encode(self, scrobbles: Iterable[Scrobble]) -> bytes:
+        return "".join(
+            json.dumps(scrobble, cls=ScrobbleEncoder, ensure_ascii=False) + "\n"
+            for scrobble in scrobbles
+        ).encode("utf-8")
+
+    def _open_segment(self):
+        segment_path = self.directory / f"{self._next_sequence:012d}{SEGMENT_SUFFIX}"
+        self._next_sequence += 1
+        self._fd = os.open(
+            segment_path, os.O_WRONLY | os.O_CREAT | os.O_APPEND | os.O_EXCL, 0o644
+        )
+        self._sync_directory()
+
+    def _sync_directory(self, directory=None):
+        # the segment's directory entry has to be durable as well as its data
+        directory_fd = os.open(directory or self.directory, os.O_RDONLY)
+        try:
+            os.fsync(directory_fd)
+        finally:
+            os.close(directory_fd)
+
+    def wait(self, timeout) -> bool:
+        """
+        Waits up to the timeout for scrobbles to be appended, returning whether
+        any are pending.
+        """
+        with self._condition:
+            if not self._pending:
+                self._condition.wait(timeout)
+            return bool(self._pending)
+
+    def seal(self) -> list[Path]:
+        """
+        Closes the current segment, so further scrobbles go to a new one, and
+        returns all of the segments waiting to be drained, oldest first.
+        """
+        with self._condition:
+            self._close_segment()
+            self._pending = 0
+            return self.segments()
+
+    def _close_segment(self):
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+    def read(self, segment_path) -> Iterator[Scrobble]:
+        with open(segment_path, encoding="utf-8") as handle:
+            for line_number, line in enumerate(handle, 1):
+                if not line.strip():
+                    continue
+                try:
+                    yield to_scrobble(json.loads(line))
+                except ValueError:
+                    # a torn write from a crash; it was never acknowledged
+                    logger.warning(
+                        "Skipping corrupt line %d of %s", line_number, segment_path
+                    )
+
+    def dead_letter(self, segment_path, scrobbles: list[Scrobble]):
+        """
+        Durably moves the scrobbles out of the segment into its dead letter file,
+        which can be imported with the import_scrobbles command once whatever
+        stopped them being saved has been fixed.
+        """
+        dead_letter_directory = self.directory / DEAD_LETTER_DIRECTORY
+        dead_letter_directory.mkdir(exist_ok=True)
+        fd = os.open(
+            dead_letter_directory / segment_path.name,
+            os.O_WRONLY | os.O_CREAT | os.O_APPEND,
+            0o644,
+        )
+        try:
+            os.write(fd, self._encode(scrobbles))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._sync_directory(dead_letter_directory)
+
+    def remove(self, segment_path):
+        segment_path.unlink()
+        self._sync_directory()
+
+    def close(self):
+        with self._condition:
+            self._close_segment()
+
+
+def record_journalled_scrobbles(
+    scrobbles: list[Scrobble],
+) -> tuple[int, list[Scrobble]]:
+    """
+    Records the scrobbles, falling back to recording them one by one if they fail
+    together. Returns the number of new plays along with the scrobbles that still
+    failed. Losing the connection to the DB is raised instead.
+    """
+    try:
+        new_plays, _ = record_scrobbles(scrobbles)
+        return new_plays, []
+    except (OperationalError, InterfaceError):
+        raise
+    except Exception:
+        if len(scrobbles) == 1:
+            logger.exception("Failed to save journalled scrobble: %s", scrobbles[0])
+            return 0, scrobbles
+        logger.exception(
+            "Failed to save a batch of journalled scrobbles, saving them one by one"
+        )
+    new_plays = 0
+    failed_scrobbles = []
+    for scrobble in scrobbles:
+        scrobble_plays, scrobble_failed = record_journalled_scrobbles([scrobble])
+        new_plays += scrobble_plays
+        failed_scrobbles += scrobble_failed
+    return new_plays, failed_scrobbles
+
+
+def drain_journal(journal: ScrobbleJournal, batch_size=1000):
+    """
+    Saves all of the journalled scrobbles, removing each segment once all of its
+    scrobbles have been committed or dead lettered. Losing the connection to the
+    DB fails the drain instead, leaving the segment to be retried.
+    """
+    for segment_path in journal.seal():
+        new_plays = total = 0
+        failed_scrobbles = []
+        for batch in batched(journal.read(segment_path), batch_size):
+            batch_plays, batch_failed = record_journalled_scrobbles(list(batch))
+            new_plays += batch_plays
+            failed_scrobbles += batch_failed
+            total += len(batch)
+        if failed_scrobbles:
+            journal.dead_letter(segment_path, failed_scrobbles)
+            logger.error(
+                "Moved %d journalled scrobbles that couldn't be saved to the dead "
+                "letter file for %s",
+                len(failed_scrobbles),
+                segment_path.name,
+            )
+        journal.remove(segment_path)
+        logger.info(
+            "Saved %d new track plays from %d journalled scrobbles", new_plays, total
+        )
+
+
+_active_journal: ScrobbleJournal | None = None
+
+
+def get_active_journal() -> ScrobbleJournal | None:
+    """
+    Returns the journal being drained by this process, if there is one.
+    """
+    return _active_journal
+
+
+def ingest_scrobbles(
+    shutdown_token: CancellationToken, drain_interval=0.5, retry_interval=5.0
+):
+    """
+    Drains the scrobble journal into the DB until shutdown, starting with any
+    scrobbles left over from before the last shutdown.
+    """
+    global _active_journal
+    journal = ScrobbleJournal(settings.SCROBBLE_JOURNAL_DIRECTORY)
+    logger.info("Ingesting scrobbles via journal at %s", journal.directory)
+    _active_journal = journal
+    try:
+        # anything left over from before the last shutdown is drained first
+        has_pending = True
+        while not shutdown_token.is_canceled():
+            if has_pending:
+                try:
+                    drain_journal(journal)
+                except Exception:
+                    logger.exception("Failed to drain scrobble journal, will retry")
+                    retry_at = time.monotonic() + retry_interval
+                    while (
+                        time.monotonic() < retry_at and not shutdown_token.is_canceled()
+                    ):
+                        time.sleep(drain_interval)
+                    continue
+            has_pending = journal.wait(drain_interval)
+    finally:
+        # requests from here on are saved directly
+        _active_journal = None
+        try:
+            drain_journal(journal)
+        except Exception:
+            logger.exception("Failed to drain scrobble journal before shutdown")
+        journal.close()
+        connections.close_all()
@@ -0,0 +1,426 @@
+"""
+Lightweight client for the Last.fm web service, along with a persistent cache of
+track → album lookups.
+
+The client talks to whatever API URL it's given (LASTFM_API_URL by default) so it
+can be pointed at a local fake of the web service.
+"""
+
+import hashlib
+import json
+import logging
+import random
+import sqlite3
+import threading
+import time
+from collections import deque
+from collections.abc import Iterator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from urllib.error import HTTPError, URLError
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+from django.conf import settings
+
+from localfm.tracks.models import Track
+
+logger = logging.getLogger(__name__)
+
+# https://www.last.fm/api/errorcodes
+ERROR_INVALID_PARAMETERS = 6
+ERROR_OPERATION_FAILED = 8
+ERROR_SERVICE_OFFLINE = 11
+ERROR_TEMPORARILY_UNAVAILABLE = 16
+ERROR_RATE_LIMIT_EXCEEDED = 29
+RETRYABLE_ERRORS = {
+    ERROR_OPERATION_FAILED,
+    ERROR_SERVICE_OFFLINE,
+    ERROR_TEMPORARILY_UNAVAILABLE,
+    ERROR_RATE_LIMIT_EXCEEDED,
+}
+
+# Last.fm asks for no more than 5 requests per second, averaged over 5 minutes
+MAX_REQUESTS_PER_SECOND = 5
+# the largest page of recent tracks Last.fm will return
+RECENT_TRACKS_PAGE_SIZE = 200
+
+
+class LastfmError(Exception):
+    def __init__(self, message, code=None, status=None):
+        super().__init__(message)
+        self.code = code
+        self.status = status
+
+    @property
+    def is_rate_limited(self):
+        return self.status == 429 or self.code == ERROR_RATE_LIMIT_EXCEEDED
+
+    @property
+    def is_retryable(self):
+        return (
+            self.is_rate_limited
+            or self.code in RETRYABLE_ERRORS
+            or (self.code is None and (self.status is None or self.status >= 500))
+        )
+
+
+class RateLimiter:
+    """
+    Thread-safe token bucket that refills at the current request rate. The rate
+    halves whenever Last.fm says we're going too fast and creeps back up towards
+    the maximum with each successful request.
+    """
+
+    def __init__(self, max_rate=MAX_REQUESTS_PER_SECOND, capacity=1, min_rate=0.2):
+        self.max_rate = max_rate
+        self.min_rate = min_rate
+        self.rate = max_rate
+        # a small bucket spaces requests evenly rather than allowing bursts
+        self.capacity = capacity
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(
+            self.capacity, self._tokens + (now - self._updated_at) * self.rate
+        )
+        self._updated_at = now
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                self._refill(time.monotonic())
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait_period = (1 - self._tokens) / self.rate
+            time.sleep(wait_period)
+
+    def slow_down(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = max(self.min_rate, self.rate / 2)
+            # drain the bucket so the in-flight requests don't burst straight away
+            self._tokens = min(self._tokens, 0)
+            logger.info("Rate limited by Last.fm, slowing to %.2f req/s", self.rate)
+
+    def speed_up(self):
+        with self._lock:
+            if self.rate < self.max_rate:
+                self._refill(time.monotonic())
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+
+class LastfmClient:
+    def __init__(
+        self,
+        api_key,
+        api_secret=None,
+        session_key=None,
+        api_url=None,
+        timeout=20,
+        rate_limiter: RateLimiter | None = None,
+        max_retries=5,
+    ):
+        self.api_key = api_key
+        self.api_secret = api_secret
+        self.session_key = session_key
+        self.api_url = api_url or settings.LASTFM_API_URL
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter or RateLimiter()
+        self.max_retries = max_retries
+
+    def request(self, method, **params) -> dict:
+        """
+        Makes a rate limited request of the API method, retrying with exponential
+        backoff when Last.fm is rate limiting us or is temporarily unavailable.
+        """
+        params = {"method": method, "api_key": self.api_key, **params}
+        if self.session_key and self.api_secret:
+            params["sk"] = self.session_key
+            params["api_sig"] = self.sign(params)
+        query = urlencode({**params, "format": "json"})
+
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire()
+            try:
+                data = self._request(query)
+            except LastfmError as exc:
+                if not exc.is_retryable or attempt >= self.max_retries:
+                    raise
+                if exc.is_rate_limited:
+                    self.rate_limiter.slow_down()
+                wait_period = min(60, 2**attempt) * random.uniform(0.5, 1.5)
+                logger.warning(
+                    "%s request failed (%s), retrying in %.1f seconds",
+                    method,
+                    exc,
+                    wait_period,
+                )
+                time.sleep(wait_period)
+                attempt += 1
+                continue
+            self.rate_limiter.speed_up()
+            return data
+
+    def sign(self, params) -> str:
+        signature = "".join(f"{key}{params[key]}" for key in sorted(params))
+        return hashlib.md5((signature + self.api_secret).encode("utf-8")).hexdigest()
+
+    def _request(self, query) -> dict:
+        try:
+            with urlopen(f"{self.api_url}?{query}", timeout=self.timeout) as response:
+                data = json.load(response)
+        except HTTPError as exc:
+            # Last.fm still sends its error document with most error statuses
+            try:
+                data = json.load(exc)
+            except ValueError:
+                raise LastfmError(str(exc), status=exc.code) from exc
+            raise LastfmError(
+                data.get("message", str(exc)), code=data.get("error"), status=exc.code
+            ) from exc
+        except (URLError, TimeoutError) as exc:
+            raise LastfmError(str(getattr(exc, "reason", exc))) from exc
+
+        if "error" in data:
+            raise LastfmError(data.get("message"), code=data["error"])
+        return data
+
+    def get_track_album(self, artist_name, track_name) -> str | None:
+        try:
+            data = self.request(
+                "track.getInfo", artist=artist_name, track=track_name, autocorrect=0
+            )
+        except LastfmError as exc:
+            if exc.code == ERROR_INVALID_PARAMETERS:
+                # Last.fm doesn't know the track at all
+                return None
+            raise
+        album = data.get("track", {}).get("album")
+        return album.get("title") if album else None
+
+    def get_recent_tracks(
+        self,
+        username,
+        start_datetime: datetime,
+        end_datetime: datetime,
+        page=1,
+        page_size=RECENT_TRACKS_PAGE_SIZE,
+    ) -> tuple[list[dict], int]:
+        """
+        Returns a page of the user's scrobbled tracks in the date range, newest
+        first, along with the total number of pages.
+        """
+        data = self.request(
+            "user.getRecentTracks",
+            user=username,
+            limit=page_size,
+            page=page,
+            extended=0,
+            **{
+                "from": int(start_datetime.timestamp()),
+                "to": int(end_datetime.timestamp()),
+            },
+        )
+        recent_tracks = data.get("recenttracks", {})
+        tracks = recent_tracks.get("track", [])
+        if isinstance(tracks, dict):
+            tracks = [tracks]
+        total_pages = int(recent_tracks.get("@attr", {}).get("totalPages", 0))
+        # the currently playing track is included no matter the date range
+        return [
+            track
+            for track in tracks
+            if track.get("@attr", {}).get("nowplaying") != "true"
+        ], total_pages
+
+
+def fetch_recent_tracks(
+    client: LastfmClient,
+    username,
+    start_datetime: datetime,
+    end_datetime: datetime,
+    max_in_flight=4,
+) -> Iterator[dict]:
+    """
+    Yields all of the user's scrobbled tracks in the date range, oldest first.
+    Last.fm lists the newest tracks first, so the first page is only requested
+    for the total number of pages; the rest are fetched from the last page back,
+    concurrently, with no more than the given number of requests in flight.
+    """
+    newest_tracks, total_pages = client.get_recent_tracks(
+        username, start_datetime, end_datetime
+    )
+    logger.info("Fetching %d pages of recent tracks", total_pages)
+    pages = iter(range(total_pages, 1, -1))
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        pending = deque()
+
+        def fetch_next_page():
+            page = next(pages, None)
+            if page is not None:
+                pending.append(
+                    executor.submit(
+                        client.get_recent_tracks,
+                        username,
+                        start_datetime,
+                        end_datetime,
+                        page=page,
+                    )
+                )
+
+        for _ in range(max_in_flight):
+            fetch_next_page()
+        while pending:
+            tracks, _ = pending.popleft().result()
+            fetch_next_page()
+            yield from reversed(tracks)
+    yield from reversed(newest_tracks)
+
+
+class AlbumLookupCache:
+    """
+    On-disk cache of the album names Last.fm gives for each (artist, track) pair,
+    including tracks without an album. Entries expire after the TTL and the least
+    recently used entries are evicted once the cache grows past its maximum size.
+    """
+
+    def __init__(self, file_path, ttl=timedelta(days=90), max_entries=100_000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.connection = sqlite3.connect(file_path)
+        self.connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS album_lookups (
+                artist_name TEXT NOT NULL,
+                track_name TEXT NOT NULL,
+                album_name TEXT,
+                looked_up_on REAL NOT NULL,
+                used_on REAL NOT NULL,
+                PRIMARY KEY (artist_name, track_name)
+            )
+            """
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS album_lookups_used_on "
+            "ON album_lookups (used_on)"
+        )
+
+    def get_many(self, keys, chunk_size=400) -> dict[tuple[str, str], str | None]:
+        """
+        Returns the cached album names for the given (artist, track) keys. Keys
+        that aren't cached (or have expired) are left out.
+        """
+        keys = [normalise_key(key) for key in keys]
+        now = time.time()
+        expired_before = now - self.ttl.total_seconds()
+        found = {}
+        with self.connection:
+            for index in range(0, len(keys), chunk_size):
+                chunk = keys[index : index + chunk_size]
+                values = ", ".join(["(?, ?)"] * len(chunk))
+                key_params = [part for key in chunk for part in key]
+                rows = self.connection.execute(
+                    f"""
+                    SELECT artist_name, track_name, album_name FROM album_lookups
+                    WHERE (artist_name, track_name) IN (VALUES {values})
+                    AND looked_up_on >= ?
+                    """,
+                    [*key_params, expired_before],
+                ).fetchall()
+                for artist_name, track_name, album_name in rows:
+                    found[(artist_name, track_name)] = album_name
+                self.connection.execute(
+                    f"""
+                    UPDATE album_lookups SET used_on = ?
+                    WHERE (artist_name, track_name) IN (VALUES {values})
+                    """,
+                    [now, *key_params],
+                )
+        return found
+
+    def set_many(self, album_names: dict[tuple[str, str], str | None]):
+        now = time.time()
+        with self.connection:
+            self.connection.executemany(
+                """
+                INSERT OR REPLACE INTO album_lookups
+                (artist_name, track_name, album_name, looked_up_on, used_on)
+                VALUES (?, ?, ?, ?, ?)
+                """,
+                [
+                    (*normalise_key(key), album_name, now, now)
+                    for key, album_name in album_names.items()
+                ],
+            )
+            self._evict(now)
+
+    def _evict(self, now):
+        self.connection.execute(
+            "DELETE FROM album_lookups WHERE looked_up_on < ?",
+            [now - self.ttl.total_seconds()],
+        )
+        self.connection.execute(
+            """
+            DELETE FROM album_lookups WHERE rowid IN (
+                SELECT rowid FROM album_lookups ORDER BY used_on DESC
+                LIMIT -1 OFFSET ?
+            )
+            """,
+            [self.max_entries],
+        )
+
+    def close(self):
+        self.connection.close()
+
+
+def normalise_key(key):
+    # Last.fm doesn't retain capitalisation consistently, so neither do we
+    artist_name, track_name = key
+    return artist_name.lower(), track_name.lower()
+
+
+def resolve_album_names(
+    keys, client: LastfmClient, cache: AlbumLookupCache
+) -> dict[tuple[str, str], str | None]:
+    """
+    Resolves the album names of the given (artist, track) keys, in order of
+    preference from: the lookup cache, the local library (if the track only
+    belongs to one album) and finally Last.fm itself. Each distinct key is only
+    looked up on Last.fm once and the results are cached for subsequent imports.
+    """
+    keys = set(keys)
+    if not keys:
+        return {}
+    cached_albums = cache.get_many(keys)
+    album_names = {
+        key: cached_albums[normalise_key(key)]
+        for key in keys
+        if normalise_key(key) in cached_albums
+    }
+    remaining_keys = keys - album_names.keys()
+    album_names.update(Track.find_album_names(remaining_keys))
+    remaining_keys -= album_names.keys()
+    logger.info(
+        "Resolved %d albums without Last.fm, looking up %d remaining",
+        len(album_names),
+        len(remaining_keys),
+    )
+
+    looked_up_albums = {}
+    for artist_name, track_name in remaining_keys:
+        try:
+            looked_up_albums[(artist_name, track_name)] = client.get_track_album(
+                artist_name, track_name
+            )
+        except LastfmError as exc:
+            logger.warning(
+                "Failed to look up album for %s - %s: %s", artist_name, track_name, exc
+            )
+    cache.set_many(looked_up_albums)
+    album_names.update(looked_up_albums)
+    return album_names
@@ -0,0 +1,111 @@
+"""
+Benchmarks fetching scrobbles from Last.fm against a local fake of the service,
+which answers each request after the given latency and rate limits requests the
+way Last.fm does
+"""
+
+import logging
+import time
+from datetime import UTC, datetime, timedelta
+
+from django.core.management import BaseCommand
+
+from localfm.bridge.fake_lastfm import FakeLastfm
+from localfm.bridge.lastfm import (
+    MAX_REQUESTS_PER_SECOND,
+    LastfmClient,
+    RateLimiter,
+    fetch_recent_tracks,
+)
+from localfm.bridge.scrobbles import Scrobble
+
+logger = logging.getLogger(__name__)
+
+START = datetime(2025, 1, 1, tzinfo=UTC)
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--scrobbles",
+            help="Number of scrobbles to fetch, spread over a year",
+            default=20000,
+            type=int,
+        )
+        parser.add_argument(
+            "--latency",
+            help="Seconds the fake takes to answer each request",
+            default=0.25,
+            type=float,
+        )
+        parser.add_argument(
+            "--rate-limit",
+            help="Requests per second above which the fake refuses requests",
+            default=MAX_REQUESTS_PER_SECOND,
+            type=float,
+        )
+        parser.add_argument(
+            "--requests-per-second",
+            help="Maximum rate of requests made to the fake",
+            default=MAX_REQUESTS_PER_SECOND,
+            type=float,
+        )
+        parser.add_argument(
+            "--max-requests-in-flight",
+            help="Maximum number of concurrent requests made to the fake",
+            default=4,
+            type=int,
+        )
+        parser.add_argument(
+            "--log-level", default="WARNING", help="Log level for the script"
+        )
+
+    def handle(
+        self,
+        scrobbles,
+        latency,
+        rate_limit,
+        requests_per_second,
+        max_requests_in_flight,
+        log_level="WARNING",
+        *args,
+        **options,
+    ):
+        logging.basicConfig(level=log_level)
+        interval = timedelta(days=365) / scrobbles
+        fake_scrobbles = [
+            Scrobble(
+                f"Artist {index % 97}",
+                f"Album {index % 389}",
+                f"Track {index}",
+                START + index * interval,
+            )
+            for index in range(scrobbles)
+        ]
+        with FakeLastfm(
+            fake_scrobbles, max_requests_per_second=rate_limit, latency=latency
+        ) as fake:
+            client = LastfmClient(
+                "key",
+                api_url=fake.url,
+                rate_limiter=RateLimiter(max_rate=requests_per_second),
+            )
+            start_time = time.monotonic()
+            fetched = sum(
+                1
+                for _ in fetch_recent_tracks(
+                    client,
+                    "user",
+                    START,
+                    START + timedelta(days=366),
+                    max_in_flight=max_requests_in_flight,
+                )
+            )
+            elapsed = time.monotonic() - start_time
+        if fetched != scrobbles:
+            logger.error("Fetched %d of %d scrobbles", fetched, scrobbles)
+        self.stdout.write(
+            f"Fetched {fetched} scrobbles in {elapsed:.1f} seconds "
+            f"({fetched / elapsed:.0f} per second) with {len(fake.requests)} "
+            f"requests, {fake.rate_limited} of them rate limited"
+        )
@@ -1,99 +1,104 @@
-import json
 import logging
 import os
 import pprint
-import random
+import queue
 import sys
-import time
-from collections import namedtuple
+import threading
+from collections.abc import Iterable, Iterator
 from datetime import UTC, datetime, timedelta
+from itertools import batched
 
 import pylast
 from dateutil.parser import parse as date_parse
+from django.conf import settings
 from django.core.management import BaseCommand
-from django.db import transaction
-from pylast import PlayedTrack, User
+from django.db import connections, transaction
 
-from localfm.tracks.models import Track, TrackPlay
+from localfm.bridge.ingest import record_scrobbles
+from localfm.bridge.lastfm import (
+    MAX_REQUESTS_PER_SECOND,
+    AlbumLookupCache,
+    LastfmClient,
+    RateLimiter,
+    fetch_recent_tracks,
+    resolve_album_names,
+)
+from localfm.bridge.scrobbles import Scrobble, read_scrobbles, write_scrobbles
+from localfm.core.runtime import CancellationToken
+from localfm.tracks.models import ScrobbleSync
 
 logger = logging.getLogger(__name__)
 
 
-Scrobble = namedtuple("Scrobble", "artist_name, album_name, track_name, occurred_on")
-
-
-class ScrobbleEncoder(json.JSONEncoder):
-    def default(self, obj):
-        if isinstance(obj, datetime):
-            return obj.isoformat()
-        return super().default(obj)
+def save_scrobbles(scrobbles, batch_size=5000, on_saved=None) -> int:
+    """
+    Saves the scrobbles as track plays in batches. Scrobbles that can't be matched
+    to a track are kept as unmatched scrobbles, to be retried after the next
+    library import; the number of them is returned. on_saved is called with each
+    batch in the same transaction that saves its plays.
+    """
+    total_unmatched = 0
+    for batch in batched(scrobbles, batch_size):
+        with transaction.atomic():
+            new_plays, unmatched_scrobbles = record_scrobbles(list(batch))
+            if on_saved:
+                on_saved(batch)
+        total_unmatched += len(unmatched_scrobbles)
+        logger.info(
+            "Saved %d new track plays and %d unmatched scrobbles from %d scrobbles",
+            new_plays,
+            len(unmatched_scrobbles),
+            len(batch),
+        )
+    return total_unmatched
 
 
-def save_scrobble(scrobble: Scrobble) -> bool:
-    logger.debug("Importing track with scrobble %s", scrobble)
-    persisted_track = Track.get_by_identifier(
-        scrobble.track_name,
-        artist_name=scrobble.artist_name,
-        album_name=scrobble.album_name,
+def to_scrobble(track_data: dict) -> Scrobble:
+    timestamp = track_data.get("date", {}).get("uts")
+    return Scrobble(
+        artist_name=track_data.get("artist", {}).get("#text") or None,
+        album_name=track_data.get("album", {}).get("#text") or None,
+        track_name=track_data.get("name") or None,
+        occurred_on=(
+            datetime.fromtimestamp(int(timestamp), tz=UTC) if timestamp else None
+        ),
     )
-    if persisted_track is None:
-        logger.warning("Unable to find track: %s", scrobble)
-        return False
-    with transaction.atomic():
-        _, created = TrackPlay.objects.get_or_create(
-            track=persisted_track,
-            occurred_on=scrobble.occurred_on,
-        )
-        if created:
-            persisted_track.play_count += 1
-            persisted_track.save()
-    return True
 
 
-def load_lastfm_scrobbles(user: User, start_datetime, end_datetime) -> list[Scrobble]:
-    logger.info("Importing scrobbles for range %s to %s", start_datetime, end_datetime)
-    track_data: list[PlayedTrack] = user.get_recent_tracks(
-        limit=None,
-        time_from=int(start_datetime.timestamp()),
-        time_to=int(end_datetime.timestamp()),
+def load_lastfm_scrobbles(
+    track_data: list[dict],
+    client: LastfmClient,
+    album_cache: AlbumLookupCache,
+) -> list[Scrobble]:
+    logger.info("Converting %d tracks to scrobbles", len(track_data))
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Track data:\n%s", pprint.pformat(track_data))
+    scrobbles = [to_scrobble(track) for track in track_data]
+
+    # look up all the missing albums at once, rather than one request per scrobble
+    album_names = resolve_album_names(
+        {
+            (scrobble.artist_name, scrobble.track_name)
+            for scrobble in scrobbles
+            if scrobble.album_name is None
+            and scrobble.artist_name
+            and scrobble.track_name
+        },
+        client,
+        album_cache,
     )
-    logger.info("Found %d tracks", len(track_data))
-    logger.debug("Track data:\n%s", pprint.pformat(track_data))
-
-    # convert the tracks to scrobbles
-    scrobbles = []
-    for played_track in track_data:
-        track = played_track.track
-        artist = track.get_artist()
-        album_name = played_track.album
+    for index, scrobble in enumerate(scrobbles):
+        album_name = scrobble.album_name
         if album_name is None:
-            album = track.get_album()
-            album_name = album.get_name() if album else None
+            album_name = album_names.get((scrobble.artist_name, scrobble.track_name))
         if album_name == "Untitled Album":
             album_name = ""
-        timestamp = int(played_track.timestamp) if played_track.timestamp else None
-        occurred_on = (
-            datetime.fromtimestamp(timestamp).replace(tzinfo=UTC) if timestamp else None
-        )
-        scrobbles.append(
-            Scrobble(
-                artist_name=artist.get_name() if artist else None,
-                album_name=album_name,
-                track_name=track.get_title(),
-                occurred_on=occurred_on,
-            )
-        )
+        scrobbles[index] = scrobble._replace(album_name=album_name)
     return scrobbles
 
 
-def load_from_file(scrobbles_file, **kwargs) -> list[Scrobble]:
-    scrobbles = []
-    with open(scrobbles_file, "r", encoding="utf-8") as handle:
-        raw_scrobbles = json.load(handle)
-        for raw_scrobble in raw_scrobbles:
-            raw_scrobble[3] = datetime.fromisoformat(raw_scrobble[3])
-            scrobbles.append(Scrobble(*raw_scrobble))
-    return scrobbles
+def load_from_file(scrobbles_file, **kwargs) -> Iterator[Scrobble]:
+    return read_scrobbles(scrobbles_file)
 
 
 def load_from_lastfm(
@@ -103,10 +108,11 @@ def load_from_lastfm(
     lastfm_password=None,
     start_datetime=None,
     end_datetime=None,
-    hour_delta=24,
-    chunk_jitter=60,
+    requests_per_second=MAX_REQUESTS_PER_SECOND,
+    max_requests_in_flight=4,
+    batch_size=1000,
     **kwargs,
-) -> list[Scrobble]:
+) -> Iterator[Scrobble]:
     cur_datetime = datetime.now(tz=UTC)
     start_datetime = (
         date_parse(start_datetime)
@@ -134,50 +140,132 @@ def load_from_lastfm(
         username=lastfm_username,
         password_hash=pylast.md5(lastfm_password),
     )
-    user = network.get_authenticated_user()
-
-    # chunk the date range so we don't attempt to import too large a track listing;
-    # we're not going to support parallel requests because that could fall
-    # foul of rate limiting
-    chunk_delta = timedelta(hours=hour_delta)
-    scrobbles = []
-    next_start_datetime = start_datetime
-    while next_start_datetime < end_datetime:
-        next_end_datetime = next_start_datetime + chunk_delta
-        if next_end_datetime >= end_datetime:
-            next_end_datetime = end_datetime
-
-        scrobbles.extend(
-            load_lastfm_scrobbles(user, next_start_datetime, next_end_datetime)
+    client = LastfmClient(
+        lastfm_api_key,
+        api_secret=lastfm_api_secret,
+        session_key=network.session_key,
+        rate_limiter=RateLimiter(max_rate=requests_per_second),
+    )
+    album_cache = AlbumLookupCache(settings.LASTFM_CACHE_FILE)
+
+    logger.info("Importing scrobbles for range %s to %s", start_datetime, end_datetime)
+    total = 0
+    try:
+        track_data = fetch_recent_tracks(
+            client,
+            lastfm_username,
+            start_datetime,
+            end_datetime,
+            max_in_flight=max_requests_in_flight,
         )
+        for batch in batched(track_data, batch_size):
+            yield from load_lastfm_scrobbles(list(batch), client, album_cache)
+            total += len(batch)
+    finally:
+        album_cache.close()
+    logger.info("Found %d scrobbles", total)
 
-        next_start_datetime = next_end_datetime
-        if chunk_jitter > 0 and next_start_datetime < end_datetime:
-            wait_period = random.randint(
-                chunk_jitter // 5, chunk_jitter + chunk_jitter // 5
-            )
-            logger.info("Waiting %s seconds before next request", wait_period)
-            time.sleep(wait_period)
 
-    return scrobbles
+def stream_in_background(
+    scrobbles: Iterable[Scrobble], batch_size=1000, max_pending_batches=4
+) -> Iterator[Scrobble]:
+    """
+    Reads the scrobbles on a background thread, so loading later scrobbles (e.g.
+    fetching pages from Last.fm) overlaps with saving the earlier ones. No more
+    than the given number of batches are held in memory at once.
+    """
+    pending_batches = queue.Queue(maxsize=max_pending_batches)
+    stop_token = CancellationToken()
+
+    def put(item):
+        while not stop_token.is_canceled():
+            try:
+                pending_batches.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    scrobbles = iter(scrobbles)
+    # marks the end of the scrobbles, however the producer stopped
+    done = object()
+
+    def produce():
+        try:
+            for batch in batched(scrobbles, batch_size):
+                if not put(batch):
+                    return
+        except Exception as exc:  # noqa: BLE001 - re-raised by the consumer
+            put(exc)
+        finally:
+            put(done)
+            # close generators on this thread, e.g. so their DB connections are too
+            if hasattr(scrobbles, "close"):
+                scrobbles.close()
+            connections.close_all()
+
+    producer_thread = threading.Thread(target=produce, daemon=True)
+    producer_thread.start()
+    try:
+        while (batch := pending_batches.get()) is not done:
+            if isinstance(batch, Exception):
+                raise batch
+            yield from batch
+    finally:
+        stop_token.cancel()
+        producer_thread.join()
+
+
+def sync_from_lastfm(lastfm_username=None, **kwargs):
+    """
+    Imports the scrobbles made since the user's watermark, which is moved forward
+    as each batch of scrobbles is committed. The first sync of a user imports the
+    scrobbles since the given start instead.
+    """
+    start_datetime = ScrobbleSync.get_watermark(lastfm_username)
+    if start_datetime:
+        # the watermark scrobble itself has already been saved
+        kwargs["start_datetime"] = (start_datetime + timedelta(seconds=1)).isoformat()
+    elif not kwargs.get("start_datetime"):
+        logger.error(
+            "%s hasn't been synced before, so --start-datetime is required",
+            lastfm_username,
+        )
+        sys.exit(2)
+    scrobbles = stream_in_background(
+        load_from_lastfm(lastfm_username=lastfm_username, **kwargs)
+    )
+
+    def advance_watermark(batch):
+        occurred_on = max(
+            (scrobble.occurred_on for scrobble in batch if scrobble.occurred_on),
+            default=None,
+        )
+        if occurred_on:
+            ScrobbleSync.advance(lastfm_username, occurred_on)
+
+    save_scrobbles(scrobbles, on_saved=advance_watermark)
+    logger.info(
+        "Synced scrobbles up to %s", ScrobbleSync.get_watermark(lastfm_username)
+    )
 
 
 def save_scrobbles_to_file(file_path, scrobbles):
     output_file = file_path.format(dated=datetime.now().strftime("%Y%m%dT%H%M%S"))
-    with open(output_file, "w", encoding="utf-8") as handle:
-        json.dump(
-            scrobbles, handle, cls=ScrobbleEncoder, ensure_ascii=False, indent="\t"
-        )
+    total = write_scrobbles(output_file, scrobbles)
+    logger.info("Saved %d scrobbles to %s", total, output_file)
 
 
 class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument(
             "source",
-            help="source of the scrobbles to import",
+            help="source of the scrobbles to import, either a file, lastfm or sync "
+            "to import new Last.fm scrobbles since the last sync",
         )
         parser.add_argument(
             "target",
+            nargs="?",
             default="database",
             help="target where the scrobbles will be saved",
         )
@@ -187,15 +275,15 @@ class Command(BaseCommand):
         parser.add_argument("--start-datetime", help="Start of the export date range")
         parser.add_argument("--end-datetime", help="End of the export date range")
         parser.add_argument(
-            "--hour-delta",
-            help="Number of hours between each chunk imported",
-            default=24,
-            type=int,
+            "--requests-per-second",
+            help="Maximum rate of requests made to Last.fm",
+            default=MAX_REQUESTS_PER_SECOND,
+            type=float,
         )
         parser.add_argument(
-            "--chunk-jitter",
-            help="Number of approximate seconds between each chunk import",
-            default=60,
+            "--max-requests-in-flight",
+            help="Maximum number of concurrent requests made to Last.fm",
+            default=4,
             type=int,
         )
         parser.add_argument(
@@ -218,11 +306,6 @@ class Command(BaseCommand):
             default=os.environ.get("LASTFM_PASSWORD"),
             help="Password for Last.fm",
         )
-        parser.add_argument(
-            "--failed-scrobbles-file",
-            default="failed_scrobbles_{dated}.json",
-            help="File for storing failed scrobble imports, if they exist.",
-        )
 
     def handle(
         self,
@@ -233,17 +316,17 @@ class Command(BaseCommand):
         **import_kwargs,
     ):
         logging.basicConfig(level=log_level)
+        if source == "sync":
+            sync_from_lastfm(**import_kwargs)
+            return
+
         if source == "lastfm":
             scrobbles = load_from_lastfm(**import_kwargs)
         else:
             scrobbles = load_from_file(source, **import_kwargs)
+        scrobbles = stream_in_background(scrobbles)
 
         if target == "database":
-            failed_scrobbles = []
-            for scrobble in scrobbles:
-                if not save_scrobble(scrobble):
-                    failed_scrobbles.append(scrobble)
-            if failed_scrobbles:
-                save_scrobbles_to_file(failed_scrobbles_file, failed_scrobbles)
+            save_scrobbles(scrobbles)
         else:
             save_scrobbles_to_file(target, scrobbles)
@@ -0,0 +1,86 @@
+"""
+Streaming reads and writes of scrobble dump files.
+
+Dumps are written as JSON Lines (one scrobble array per line) so they can be
+appended to and read in constant memory. Files ending in .gz or .zst are
+compressed accordingly. The legacy format of a single JSON array is still read.
+"""
+
+import gzip
+import json
+from collections import namedtuple
+from collections.abc import Iterable, Iterator
+from datetime import datetime
+
+try:
+    from compression import zstd
+except ImportError:  # zstd is only part of the standard library from Python 3.14
+    zstd = None
+
+Scrobble = namedtuple("Scrobble", "artist_name, album_name, track_name, occurred_on")
+
+
+class ScrobbleEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, datetime):
+            return obj.isoformat()
+        return super().default(obj)
+
+
+def open_scrobble_file(file_path, mode="rt"):
+    file_path = str(file_path)
+    if file_path.endswith(".gz"):
+        return gzip.open(file_path, mode, encoding="utf-8")
+    if file_path.endswith(".zst"):
+        if zstd is None:
+            raise ValueError("zstd compressed scrobble files require Python 3.14+")
+        return zstd.open(file_path, mode, encoding="utf-8")
+    return open(file_path, mode, encoding="utf-8")
+
+
+def to_scrobble(raw_scrobble) -> Scrobble:
+    artist_name, album_name, track_name, occurred_on = raw_scrobble
+    return Scrobble(
+        artist_name=artist_name,
+        album_name=album_name,
+        track_name=track_name,
+        occurred_on=datetime.fromisoformat(occurred_on) if occurred_on else None,
+    )
+
+
+def is_legacy_dump(first_line):
+    # legacy dumps are a single JSON array of scrobble arrays, normally indented
+    # so the first line is just the opening bracket
+    try:
+        first_value = json.loads(first_line)
+    except json.JSONDecodeError:
+        return True
+    return not first_value or isinstance(first_value[0], list)
+
+
+def read_scrobbles(file_path) -> Iterator[Scrobble]:
+    with open_scrobble_file(file_path) as handle:
+        first_line = handle.readline()
+        if not first_line.strip():
+            return
+        if is_legacy_dump(first_line):
+            for raw_scrobble in json.loads(first_line + handle.read()):
+                yield to_scrobble(raw_scrobble)
+            return
+        yield to_scrobble(json.loads(first_line))
+        for line in handle:
+            if line.strip():
+                yield to_scrobble(json.loads(line))
+
+
+def write_scrobbles(file_path, scrobbles: Iterable[Scrobble], append=True) -> int:
+    """
+    Writes the scrobbles to the file as JSON Lines, returning the number written.
+    """
+    total = 0
+    with open_scrobble_file(file_path, "at" if append else "wt") as handle:
+        for scrobble in scrobbles:
+            handle.write(json.dumps(scrobble, cls=ScrobbleEncoder, ensure_ascii=False))
+            handle.write("\n")
+            total += 1
+    return total
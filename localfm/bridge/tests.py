@@ -0,0 +1,402 @@
+import json
+import logging
+import tempfile
+from datetime import UTC, datetime, timedelta
+from pathlib import Path
+from unittest import mock, skipIf
+
+from django.db import OperationalError
+from django.test import SimpleTestCase, TestCase, override_settings
+
+from localfm.bridge.fake_lastfm import FakeLastfm
+from localfm.bridge.ingest import ScrobbleJournal, drain_journal, record_scrobbles
+from localfm.bridge.lastfm import (
+    ERROR_RATE_LIMIT_EXCEEDED,
+    LastfmClient,
+    LastfmError,
+    RateLimiter,
+    fetch_recent_tracks,
+)
+from localfm.bridge.management.commands.import_scrobbles import (
+    sync_from_lastfm,
+    to_scrobble,
+)
+from localfm.bridge.scrobbles import (
+    Scrobble,
+    read_scrobbles,
+    write_scrobbles,
+    zstd,
+)
+from localfm.tracks.models import ScrobbleSync, TrackPlay, UnmatchedScrobble
+from localfm.tracks.tests import create_track
+
+START = datetime(2025, 1, 1, tzinfo=UTC)
+
+
+def make_scrobbles(count, start=START) -> list[Scrobble]:
+    return [
+        Scrobble(
+            f"Artist {index % 7}",
+            f"Album {index % 11}",
+            f"Track {index}",
+            start + timedelta(minutes=index),
+        )
+        for index in range(count)
+    ]
+
+
+def no_backoff():
+    # retry straight away rather than waiting seconds between attempts
+    return mock.patch("localfm.bridge.lastfm.random.uniform", return_value=0.001)
+
+
+class RateLimitTests(SimpleTestCase):
+    def test_slow_down_halves_rate(self):
+        limiter = RateLimiter(max_rate=4, min_rate=0.5)
+        limiter.slow_down()
+        self.assertEqual(limiter.rate, 2)
+        for _ in range(5):
+            limiter.slow_down()
+        self.assertEqual(limiter.rate, 0.5)
+
+    def test_rate_limited_request_slows_down(self):
+        for status in (429, 200):
+            with self.subTest(status=status):
+                with (
+                    FakeLastfm(
+                        make_scrobbles(3),
+                        max_requests_per_second=1,
+                        rate_limit_status=status,
+                    ) as fake,
+                    no_backoff(),
+                ):
+                    limiter = RateLimiter(max_rate=50)
+                    client = LastfmClient("key", api_url=fake.url, rate_limiter=limiter)
+                    with mock.patch.object(
+                        limiter, "slow_down", wraps=limiter.slow_down
+                    ) as slow_down:
+                        client.get_recent_tracks("user", START, START + timedelta(1))
+                        client.get_recent_tracks("user", START, START + timedelta(1))
+                    self.assertGreater(fake.rate_limited, 0)
+                    self.assertEqual(slow_down.call_count, fake.rate_limited)
+                    self.assertLess(limiter.rate, 50)
+
+    def test_rate_limit_error_code(self):
+        with FakeLastfm(max_requests_per_second=0) as fake, no_backoff():
+            client = LastfmClient("key", api_url=fake.url, max_retries=1)
+            with self.assertRaises(LastfmError) as context:
+                client.get_recent_tracks("user", START, START + timedelta(1))
+        self.assertEqual(context.exception.code, ERROR_RATE_LIMIT_EXCEEDED)
+        self.assertTrue(context.exception.is_rate_limited)
+        self.assertEqual(fake.rate_limited, 2)
+
+    def test_no_pages_lost_or_duplicated_when_rate_limited(self):
+        scrobbles = make_scrobbles(2000)
+        with (
+            FakeLastfm(
+                scrobbles, max_requests_per_second=4, now_playing=scrobbles[0]
+            ) as fake,
+            no_backoff(),
+        ):
+            limiter = RateLimiter(max_rate=20)
+            client = LastfmClient(
+                "key", api_url=fake.url, rate_limiter=limiter, max_retries=20
+            )
+            tracks = list(
+                fetch_recent_tracks(
+                    client, "user", START, START + timedelta(days=2), max_in_flight=4
+                )
+            )
+        self.assertGreater(fake.rate_limited, 0)
+        self.assertLess(limiter.rate, 20)
+        self.assertEqual([to_scrobble(track) for track in tracks], scrobbles)
+
+
+class FetchRecentTracksTests(SimpleTestCase):
+    def fetch(self, fake, max_in_flight=4) -> list[Scrobble]:
+        client = LastfmClient("key", api_url=fake.url, max_retries=2)
+        return [
+            to_scrobble(track)
+            for track in fetch_recent_tracks(
+                client,
+                "user",
+                START,
+                START + timedelta(days=2),
+                max_in_flight=max_in_flight,
+            )
+        ]
+
+    def test_oldest_first(self):
+        scrobbles = make_scrobbles(1050)
+        for max_in_flight in (1, 4):
+            with self.subTest(max_in_flight=max_in_flight):
+                with FakeLastfm(scrobbles, now_playing=scrobbles[0]) as fake:
+                    self.assertEqual(self.fetch(fake, max_in_flight), scrobbles)
+                # the first page is fetched first, for the number of pages
+                self.assertEqual(
+                    [int(params["page"]) for params in fake.requests][0], 1
+                )
+                self.assertEqual(len(fake.requests), 6)
+
+    def test_retried_page(self):
+        scrobbles = make_scrobbles(1050)
+        with FakeLastfm(scrobbles) as fake, no_backoff():
+            fake.fail_page(3, times=2)
+            self.assertEqual(self.fetch(fake), scrobbles)
+
+    def test_page_failing_partway(self):
+        scrobbles = make_scrobbles(2000)
+        with FakeLastfm(scrobbles) as fake, no_backoff():
+            fake.fail_page(4)
+            fetched = []
+            with self.assertRaises(LastfmError):
+                for track in fetch_recent_tracks(
+                    LastfmClient("key", api_url=fake.url, max_retries=2),
+                    "user",
+                    START,
+                    START + timedelta(days=2),
+                ):
+                    fetched.append(to_scrobble(track))
+        # the pages older than the failed one, and nothing newer
+        self.assertEqual(fetched, scrobbles[:1200])
+
+
+class SyncFromLastfmTests(TestCase):
+    def setUp(self):
+        cache_directory = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_directory.cleanup)
+        self.cache_file = str(Path(cache_directory.name) / "lastfm_cache.sqlite3")
+        network = mock.patch(
+            "localfm.bridge.management.commands.import_scrobbles.pylast.LastFMNetwork"
+        )
+        network.start().return_value.session_key = "session"
+        self.addCleanup(network.stop)
+        # every scrobble is unmatched in an empty library
+        logging.disable(logging.WARNING)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def sync(self, fake, start=START):
+        with override_settings(
+            LASTFM_API_URL=fake.url, LASTFM_CACHE_FILE=self.cache_file
+        ):
+            sync_from_lastfm(
+                lastfm_username="user",
+                lastfm_api_key="key",
+                lastfm_api_secret="secret",
+                lastfm_password="password",
+                start_datetime=start and start.isoformat(),
+            )
+
+    def test_first_sync_needs_a_start(self):
+        # plays scrobbled to the bridge don't stand in for a watermark
+        track = create_track("Bridged")
+        TrackPlay.bulk_record([(track.pk, START + timedelta(days=30))])
+        scrobbles = make_scrobbles(10)
+        with FakeLastfm(scrobbles) as fake:
+            with self.assertRaises(SystemExit):
+                self.sync(fake, start=None)
+            self.assertEqual(fake.requests, [])
+            self.sync(fake)
+        self.assertEqual(UnmatchedScrobble.objects.count(), 10)
+        self.assertEqual(ScrobbleSync.get_watermark("user"), scrobbles[-1].occurred_on)
+
+    def test_watermark_stops_at_saved_scrobbles(self):
+        # the scrobbles are saved in batches of 5000, so the first batch is saved
+        # before the fetch fails
+        scrobbles = make_scrobbles(6000)
+        with FakeLastfm(scrobbles) as fake, no_backoff():
+            fake.fail_page(4)
+            with self.assertRaises(LastfmError):
+                self.sync(fake)
+        watermark = ScrobbleSync.get_watermark("user")
+        self.assertEqual(watermark, scrobbles[4999].occurred_on)
+        self.assertEqual(UnmatchedScrobble.objects.count(), 5000)
+        self.assertFalse(
+            UnmatchedScrobble.objects.filter(occurred_on__gt=watermark).exists()
+        )
+
+        with FakeLastfm(scrobbles) as fake:
+            self.sync(fake)
+        self.assertEqual(ScrobbleSync.get_watermark("user"), scrobbles[-1].occurred_on)
+        self.assertEqual(UnmatchedScrobble.objects.count(), 6000)
+        # only the scrobbles after the watermark were fetched
+        self.assertEqual(
+            {int(params["from"]) for params in fake.requests},
+            {int(scrobbles[4999].occurred_on.timestamp()) + 1},
+        )
+
+
+class ScrobbleFileTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        self.scrobbles = [
+            *make_scrobbles(3),
+            Scrobble("Sigur Rós", None, "Hoppípolla", START),
+            Scrobble("Artist", "Album", "Undated", None),
+        ]
+
+    def test_round_trip(self):
+        for name in ("scrobbles.jsonl", "scrobbles.jsonl.gz"):
+            with self.subTest(name=name):
+                file_path = self.directory / name
+                self.assertEqual(write_scrobbles(file_path, self.scrobbles), 5)
+                self.assertEqual(list(read_scrobbles(file_path)), self.scrobbles)
+
+    @skipIf(zstd is None, "zstd needs Python 3.14+")
+    def test_zstd_round_trip(self):
+        file_path = self.directory / "scrobbles.jsonl.zst"
+        write_scrobbles(file_path, self.scrobbles)
+        self.assertEqual(list(read_scrobbles(file_path)), self.scrobbles)
+
+    @skipIf(zstd is not None, "zstd is available")
+    def test_zstd_unavailable(self):
+        with self.assertRaises(ValueError):
+            write_scrobbles(self.directory / "scrobbles.jsonl.zst", self.scrobbles)
+
+    def test_append(self):
+        file_path = self.directory / "scrobbles.jsonl.gz"
+        write_scrobbles(file_path, self.scrobbles[:2])
+        write_scrobbles(file_path, self.scrobbles[2:])
+        self.assertEqual(list(read_scrobbles(file_path)), self.scrobbles)
+        write_scrobbles(file_path, self.scrobbles[:1], append=False)
+        self.assertEqual(list(read_scrobbles(file_path)), self.scrobbles[:1])
+
+    def test_legacy_array(self):
+        raw_scrobbles = [
+            [
+                scrobble.artist_name,
+                scrobble.album_name,
+                scrobble.track_name,
+                scrobble.occurred_on.isoformat() if scrobble.occurred_on else None,
+            ]
+            for scrobble in self.scrobbles
+        ]
+        for indent in (2, None):
+            with self.subTest(indent=indent):
+                file_path = self.directory / "legacy.json"
+                file_path.write_text(
+                    json.dumps(raw_scrobbles, indent=indent), encoding="utf-8"
+                )
+                self.assertEqual(list(read_scrobbles(file_path)), self.scrobbles)
+
+    def test_empty(self):
+        for content in ("", "[]"):
+            with self.subTest(content=content):
+                file_path = self.directory / "empty.json"
+                file_path.write_text(content, encoding="utf-8")
+                self.assertEqual(list(read_scrobbles(file_path)), [])
+
+
+class ScrobbleJournalTests(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        self.journal = ScrobbleJournal(self.directory)
+        self.addCleanup(self.journal.close)
+        self.scrobbles = make_scrobbles(5)
+
+    def test_seal_and_read(self):
+        self.assertFalse(self.journal.wait(0))
+        self.journal.append(self.scrobbles[:2])
+        self.journal.append(self.scrobbles[2:3])
+        self.assertTrue(self.journal.wait(0))
+        segments = self.journal.seal()
+        self.assertEqual([segment.name for segment in segments], ["000000000000.jsonl"])
+        self.assertFalse(self.journal.wait(0))
+        # appends after sealing go to a new segment
+        self.journal.append(self.scrobbles[3:])
+        self.assertEqual(
+            [list(self.journal.read(segment)) for segment in self.journal.seal()],
+            [self.scrobbles[:3], self.scrobbles[3:]],
+        )
+
+    def test_read_skips_torn_writes(self):
+        self.journal.append(self.scrobbles[:2])
+        (segment,) = self.journal.seal()
+        with open(segment, "a", encoding="utf-8") as handle:
+            handle.write('["Artist", "Album", "Tra')
+        self.assertEqual(list(self.journal.read(segment)), self.scrobbles[:2])
+
+    def test_remove(self):
+        self.journal.append(self.scrobbles)
+        (segment,) = self.journal.seal()
+        self.journal.remove(segment)
+        self.assertEqual(self.journal.seal(), [])
+        self.assertFalse(segment.exists())
+
+    def test_reopened_journal_keeps_segments(self):
+        self.journal.append(self.scrobbles[:2])
+        self.journal.close()
+        journal = ScrobbleJournal(self.directory)
+        self.addCleanup(journal.close)
+        journal.append(self.scrobbles[2:])
+        self.assertEqual(
+            [segment.name for segment in journal.seal()],
+            ["000000000000.jsonl", "000000000001.jsonl"],
+        )
+
+    def test_dead_letter(self):
+        self.journal.append(self.scrobbles)
+        (segment,) = self.journal.seal()
+        self.journal.dead_letter(segment, self.scrobbles[1:3])
+        self.journal.dead_letter(segment, self.scrobbles[4:])
+        dead_letter_file = self.directory / "dead_letter" / segment.name
+        self.assertEqual(
+            list(read_scrobbles(dead_letter_file)),
+            [*self.scrobbles[1:3], *self.scrobbles[4:]],
+        )
+        # dead letter files aren't segments
+        self.assertEqual(self.journal.seal(), [segment])
+
+
+class DrainJournalTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.journal = ScrobbleJournal(directory.name)
+        self.addCleanup(self.journal.close)
+        # the process-wide match index could hold tracks of earlier tests
+        match_index = mock.patch("localfm.tracks.matching._match_index", None)
+        match_index.start()
+        self.addCleanup(match_index.stop)
+        logging.disable(logging.CRITICAL)
+        self.addCleanup(logging.disable, logging.NOTSET)
+
+    def test_dead_letters_failing_scrobbles(self):
+        scrobbles = make_scrobbles(3)
+        failing = Scrobble("Artist", None, "Failing", START)
+
+        def record_or_fail(batch):
+            if failing in batch:
+                raise ValueError("Unable to save scrobble")
+            return record_scrobbles(batch)
+
+        self.journal.append([scrobbles[0], failing, *scrobbles[1:]])
+        with mock.patch(
+            "localfm.bridge.ingest.record_scrobbles", side_effect=record_or_fail
+        ):
+            drain_journal(self.journal, batch_size=2)
+        self.assertEqual(self.journal.seal(), [])
+        self.assertEqual(
+            sorted(UnmatchedScrobble.objects.values_list("track_name", flat=True)),
+            [scrobble.track_name for scrobble in scrobbles],
+        )
+        (dead_letter_file,) = (self.journal.directory / "dead_letter").iterdir()
+        self.assertEqual(list(read_scrobbles(dead_letter_file)), [failing])
+
+    def test_keeps_segment_when_db_is_unavailable(self):
+        self.journal.append(make_scrobbles(3))
+        with mock.patch(
+            "localfm.bridge.ingest.record_scrobbles",
+            side_effect=OperationalError("connection lost"),
+        ):
+            with self.assertRaises(OperationalError):
+                drain_journal(self.journal)
+        self.assertEqual(len(self.journal.seal()), 1)
+        self.assertFalse((self.journal.directory / "dead_letter").exists())
+        drain_journal(self.journal)
+        self.assertEqual(self.journal.seal(), [])
+        self.assertEqual(UnmatchedScrobble.objects.count(), 3)
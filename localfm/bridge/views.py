@@ -4,6 +4,7 @@ from django.http import (
     HttpResponseForbidden,
     HttpResponseNotFound,
 )
+from django.views.decorators.csrf import csrf_exempt
 
 from localfm.access import views as sessions_views
 from localfm.tracks import views as tracks_views
@@ -11,6 +12,7 @@ from localfm.tracks import views as tracks_views
 SUPPORTED_ENDPOINTS = {
     "track.updateNowPlaying": tracks_views.update_now_playing,
     "track.scrobble": tracks_views.scrobble,
+    "auth.getMobileSession": sessions_views.get_mobile_session,
     "access.getMobileSession": sessions_views.get_mobile_session,
 }
 
@@ -21,10 +23,12 @@ def is_authenticated(request_data):
     return True
 
 
+@csrf_exempt
 def process(request):
     """
     Processes all Last.fm API requests. Authenticates using the expected format
-    then routes to the relevant API function
+    then routes to the relevant API function. Requests come from players rather
+    than browsers, so there's no CSRF token to check.
     """
     if request.method != "POST":
         return HttpResponseBadRequest()
@@ -35,7 +39,11 @@ def process(request):
     if not request_process_fn:
         return HttpResponseNotFound()
 
-    user = authenticate(request, api_key=request_data.get("api_key"))
+    user = authenticate(
+        request,
+        api_key=request_data.get("api_key"),
+        session_key=request_data.get("sk"),
+    )
     if not user or not is_authenticated(request_data):
         return HttpResponseForbidden()
 
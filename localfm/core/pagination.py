@@ -0,0 +1,186 @@
+import base64
+import binascii
+import json
+from collections import namedtuple
+from datetime import datetime, time
+from typing import Any
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import F, Q
+from ninja import Field, Schema
+from ninja.conf import settings
+from ninja.errors import HttpError
+from ninja.pagination import PaginationBase
+
+CURSOR_PREFIX = "_cursor_"
+
+SortKey = namedtuple("SortKey", "field, descending, nullable")
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    """
+    Encodes times with their full precision, which DjangoJSONEncoder truncates to
+    milliseconds, so that a cursor matches the row it came from exactly.
+    """
+
+    def default(self, o):
+        if isinstance(o, (datetime, time)):
+            return o.isoformat()
+        return super().default(o)
+
+
+def encode_cursor(values, reverse=False) -> str:
+    data = json.dumps({"v": values, "r": reverse}, cls=CursorEncoder)
+    return base64.urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, key_count) -> tuple[list, bool]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        data = json.loads(base64.urlsafe_b64decode(padded))
+        values, reverse = data["v"], bool(data["r"])
+    except (binascii.Error, ValueError, TypeError, KeyError):
+        raise HttpError(400, "Invalid cursor")
+    if not isinstance(values, list) or len(values) != key_count:
+        raise HttpError(400, "Invalid cursor")
+    return values, reverse
+
+
+def after_key(key: SortKey, value) -> Q:
+    """
+    Returns the filter for rows sorted after the value of the key. Postgres sorts
+    nulls last in ascending order and first in descending order.
+    """
+    if value is None:
+        return Q(**{f"{key.field}__isnull": False}) if key.descending else Q(pk__in=[])
+    after = Q(**{f"{key.field}__lt" if key.descending else f"{key.field}__gt": value})
+    if key.nullable and not key.descending:
+        after |= Q(**{f"{key.field}__isnull": True})
+    return after
+
+
+def equal_key(key: SortKey, value) -> Q:
+    if value is None:
+        return Q(**{f"{key.field}__isnull": True})
+    return Q(**{key.field: value})
+
+
+def after_keys(ordering: list[SortKey], values) -> Q:
+    """
+    Returns the filter for rows sorted after the given sort key values, i.e.
+    (a > x) or (a = x and b > y) and so on. The first key is also bounded on its
+    own so that the sort index can be range scanned.
+    """
+    condition = Q(pk__in=[])
+    equal_so_far = Q()
+    for key, value in zip(ordering, values):
+        condition |= equal_so_far & after_key(key, value)
+        equal_so_far &= equal_key(key, value)
+    key, value = ordering[0], values[0]
+    if value is not None:
+        bound = Q(
+            **{f"{key.field}__lte" if key.descending else f"{key.field}__gte": value}
+        )
+        if key.nullable and not key.descending:
+            bound |= Q(**{f"{key.field}__isnull": True})
+        condition &= bound
+    return condition
+
+
+def is_nullable(model, path) -> bool:
+    """
+    Returns whether the field at the lookup path can be null, either because it's
+    nullable or because a relation on the way to it is.
+    """
+    for name in path.split("__"):
+        field = model._meta.pk if name == "pk" else model._meta.get_field(name)
+        if field.null:
+            return True
+        model = field.related_model
+    return False
+
+
+class KeysetPagination(PaginationBase):
+    """
+    Paginates by the values of the queryset's sort keys rather than an offset, so
+    every page is fetched with the same range scan however deep it is. The pages
+    either side are fetched with the opaque next and previous cursors, and there's
+    no total count. The primary key is added as the last sort key so that the
+    ordering is unique.
+    """
+
+    class Input(Schema):
+        cursor: str | None = None
+        limit: int = Field(settings.PAGINATION_PER_PAGE, ge=1)
+
+    class Output(Schema):
+        items: list[Any]
+        next: str | None
+        previous: str | None
+
+    def paginate_queryset(self, queryset, pagination: Input, request, **params):
+        limit = min(pagination.limit, settings.PAGINATION_MAX_LIMIT)
+        ordering = self._ordering(queryset)
+        if pagination.cursor:
+            values, reverse = decode_cursor(pagination.cursor, len(ordering))
+        else:
+            values, reverse = None, False
+        if reverse:
+            # fetch the previous page by walking the ordering backwards
+            page_ordering = [
+                key._replace(descending=not key.descending) for key in ordering
+            ]
+        else:
+            page_ordering = ordering
+
+        queryset = queryset.annotate(
+            **{
+                f"{CURSOR_PREFIX}{index}": F(key.field)
+                for index, key in enumerate(ordering)
+            }
+        ).order_by(
+            *(f"-{key.field}" if key.descending else key.field for key in page_ordering)
+        )
+        if values is not None:
+            queryset = queryset.filter(after_keys(page_ordering, values))
+        items = list(queryset[: limit + 1])
+        has_more = len(items) > limit
+        items = items[:limit]
+        if reverse:
+            items.reverse()
+
+        first_keys = self._keys(items[0], ordering) if items else values
+        last_keys = self._keys(items[-1], ordering) if items else values
+        if reverse:
+            has_next, has_previous = values is not None, has_more
+        else:
+            has_next, has_previous = has_more, values is not None
+        return {
+            "items": items,
+            "next": encode_cursor(last_keys) if has_next and last_keys else None,
+            "previous": (
+                encode_cursor(first_keys, reverse=True)
+                if has_previous and first_keys
+                else None
+            ),
+        }
+
+    def _ordering(self, queryset) -> list[SortKey]:
+        model = queryset.model
+        ordering = []
+        for order in queryset.query.order_by or model._meta.ordering:
+            if not isinstance(order, str):
+                raise TypeError(f"Unable to paginate by expression {order!r}")
+            field = order.lstrip("-")
+            ordering.append(
+                SortKey(field, order.startswith("-"), is_nullable(model, field))
+            )
+        if not ordering or ordering[-1].field not in ("pk", "id"):
+            descending = ordering[-1].descending if ordering else False
+            ordering.append(SortKey("pk", descending, False))
+        return ordering
+
+    def _keys(self, item, ordering) -> list:
+        return [
+            getattr(item, f"{CURSOR_PREFIX}{index}") for index in range(len(ordering))
+        ]
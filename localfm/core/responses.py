@@ -1,35 +1,59 @@
 from io import StringIO
 
+from django.http import HttpResponse
 from django.utils.encoding import force_str
 from django.utils.xmlutils import SimplerXMLGenerator
 from ninja.renderers import BaseRenderer
 
 
 class XMLRenderer(BaseRenderer):
+    """
+    Renders data as XML under the root element. Dict keys prefixed with @ are
+    rendered as attributes of their element and a #text key as its text, as in
+    Last.fm's JSON responses. A list under a dict key repeats the key's element
+    for each item; any other list wraps each of its items in an item element.
+    """
+
     media_type = "text/xml"
 
+    def __init__(self, root_element="data"):
+        self.root_element = root_element
+
     def render(self, request, data, *, response_status):
         stream = StringIO()
         xml = SimplerXMLGenerator(stream, "utf-8")
         xml.startDocument()
-        xml.startElement("data", {})
-        self._to_xml(xml, data)
-        xml.endElement("data")
+        self._element_to_xml(xml, self.root_element, data)
         xml.endDocument()
         return stream.getvalue()
 
+    def _element_to_xml(self, xml, name, data):
+        attributes = {}
+        if isinstance(data, dict):
+            attributes = {
+                key[1:]: force_str(value)
+                for key, value in data.items()
+                if key.startswith("@") and value is not None
+            }
+            data = {key: value for key, value in data.items() if key[0] != "@"}
+        xml.startElement(name, attributes)
+        self._to_xml(xml, data)
+        xml.endElement(name)
+
     def _to_xml(self, xml, data):
         if isinstance(data, (list, tuple)):
             for item in data:
-                xml.startElement("item", {})
-                self._to_xml(xml, item)
-                xml.endElement("item")
+                self._element_to_xml(xml, "item", item)
 
         elif isinstance(data, dict):
             for key, value in data.items():
-                xml.startElement(key, {})
-                self._to_xml(xml, value)
-                xml.endElement(key)
+                if key == "#text":
+                    self._to_xml(xml, value)
+                elif isinstance(value, (list, tuple)):
+                    for item in value:
+                        self._element_to_xml(xml, key, item)
+                else:
+                    self._element_to_xml(xml, key, value)
 
         elif data is None:
             # Don't output any value
@@ -37,3 +61,23 @@ class XMLRenderer(BaseRenderer):
 
         else:
             xml.characters(force_str(data))
+
+
+def lastfm_response(request, data, status=200) -> HttpResponse:
+    """
+    Renders the data as a Last.fm API XML response.
+    """
+    renderer = XMLRenderer(root_element="lfm")
+    return HttpResponse(
+        renderer.render(request, data, response_status=status),
+        content_type=renderer.media_type,
+        status=status,
+    )
+
+
+def lastfm_error_response(request, code, message, status=400) -> HttpResponse:
+    return lastfm_response(
+        request,
+        {"@status": "failed", "error": {"@code": code, "#text": message}},
+        status=status,
+    )
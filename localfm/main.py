@@ -3,6 +3,8 @@ import logging
 import threading
 import time
 
+import django
+
 from localfm.core.runtime import register_shutdown_token
 from localfm.tracks.library import listen_for_changes
 from localfm.wsgi import run_wsgi_server
@@ -14,11 +16,21 @@ def run_service():
     parser = argparse.ArgumentParser(description="Starts local FM service")
     parser.add_argument("--port", default=8011, type=int)
     parser.add_argument("--host", default="*")
+    parser.add_argument(
+        "--threads", type=int, help="Defaults to the SERVER_THREADS setting"
+    )
     parser.add_argument("--log-level", default="INFO")
     args = parser.parse_args()
     logging.basicConfig(level=args.log_level)
+    django.setup()
+    # imported here since the ingestion module needs Django to be set up
+    from localfm.bridge.ingest import ingest_scrobbles
+
     shutdown_token = register_shutdown_token()
 
+    ingest_thread = threading.Thread(target=ingest_scrobbles, args=(shutdown_token,))
+    ingest_thread.start()
+
     library_listen_thread = threading.Thread(
         target=listen_for_changes, args=(shutdown_token,)
     )
@@ -29,6 +41,7 @@ def run_service():
         args=(
             shutdown_token,
             listen_address,
+            args.threads,
         ),
     )
     wsgi_thread.start()
@@ -39,6 +52,8 @@ def run_service():
     shutdown_token.cancel()
     library_listen_thread.join(timeout=1)
     wsgi_thread.join(timeout=1)
+    # the last scrobbles are drained before shutting down
+    ingest_thread.join()
 
 
 if __name__ == "__main__":
@@ -30,6 +30,21 @@ APPEND_SLASH = False
 
 MUSIC_LIBRARY_DIRECTORY = environ.get("LIBRARY_DIRECTORY", "e:/Music")
 
+LASTFM_API_URL = environ.get("LASTFM_API_URL", "https://ws.audioscrobbler.com/2.0/")
+LASTFM_CACHE_FILE = environ.get(
+    "LASTFM_CACHE_FILE", str(BASE_DIR / "lastfm_cache.sqlite3")
+)
+# scrobbles sent to the bridge are journalled here until they're saved to the DB
+SCROBBLE_JOURNAL_DIRECTORY = environ.get(
+    "SCROBBLE_JOURNAL_DIRECTORY", str(BASE_DIR / "scrobble_journal")
+)
+# threads serving requests, of which now playing long polls and event streams can
+# hold at most NOW_PLAYING_MAX_WAITERS while they wait
+SERVER_THREADS = int(environ.get("LOCALFM_SERVER_THREADS", 16))
+NOW_PLAYING_MAX_WAITERS = int(
+    environ.get("LOCALFM_NOW_PLAYING_MAX_WAITERS", SERVER_THREADS // 2)
+)
+
 
 # Application definition
 
@@ -40,6 +55,7 @@ INSTALLED_APPS = [
     "django.contrib.sessions",
     "django.contrib.messages",
     "django.contrib.staticfiles",
+    "django.contrib.postgres",
     "localfm.bridge",
     "localfm.access",
     "localfm.tracks",
@@ -65,6 +81,7 @@ TEMPLATES = [
         "OPTIONS": {
             "context_processors": [
                 "django.template.context_processors.request",
+                "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
             ],
         },
@@ -89,8 +106,8 @@ DATABASES = {
 }
 
 AUTHENTICATION_BACKENDS = [
-    "django.contrib.access.backends.ModelBackend",
-    "localfm.access.auth_backend.ApiKeyBackend",
+    "django.contrib.auth.backends.ModelBackend",
+    "localfm.access.auth_backend.ApiKeyAuthBackend",
 ]
 
 # Password validation
@@ -98,16 +115,16 @@ AUTHENTICATION_BACKENDS = [
 
 AUTH_PASSWORD_VALIDATORS = [
     {
-        "NAME": "django.contrib.access.password_validation.UserAttributeSimilarityValidator",
+        "NAME": "django.contrib.auth.password_validation.UserAttributeSimilarityValidator",
     },
     {
-        "NAME": "django.contrib.access.password_validation.MinimumLengthValidator",
+        "NAME": "django.contrib.auth.password_validation.MinimumLengthValidator",
     },
     {
-        "NAME": "django.contrib.access.password_validation.CommonPasswordValidator",
+        "NAME": "django.contrib.auth.password_validation.CommonPasswordValidator",
     },
     {
-        "NAME": "django.contrib.access.password_validation.NumericPasswordValidator",
+        "NAME": "django.contrib.auth.password_validation.NumericPasswordValidator",
     },
 ]
 
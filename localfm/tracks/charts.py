@@ -0,0 +1,89 @@
+"""
+Charts of the most played tracks, albums and artists over a window of days.
+
+Plays are summed from the daily and monthly play buckets rather than the plays
+themselves: whole months in the window are read from monthly buckets and only
+the days either side of them from daily ones.
+"""
+
+from collections import namedtuple
+from datetime import date, timedelta
+
+from django.db.models import CharField, F, Q, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from .models import AlbumPlayBucket, ArtistPlayBucket, BucketPeriod, TrackPlayBucket
+
+ChartEntry = namedtuple("ChartEntry", "id, name, artist_name, play_count")
+
+# the buckets of each chart along with how their names are looked up
+CHARTS = {
+    "tracks": (TrackPlayBucket, F("track__name"), F("track__artist__name")),
+    "albums": (
+        AlbumPlayBucket,
+        F("album__name"),
+        Coalesce("album__album_artist__name", "album__artist__name"),
+    ),
+    "artists": (
+        ArtistPlayBucket,
+        F("artist__name"),
+        Value(None, output_field=CharField()),
+    ),
+}
+
+
+def next_month(month_start: date) -> date:
+    return (month_start + timedelta(days=32)).replace(day=1)
+
+
+def window_buckets(start: date, end: date) -> Q:
+    """
+    Returns the filter for the fewest buckets covering the days from the start
+    up to (but not including) the end.
+    """
+    first_month = start if start.day == 1 else next_month(start.replace(day=1))
+    months_end = first_month
+    while next_month(months_end) <= end:
+        months_end = next_month(months_end)
+    if months_end == first_month:
+        return Q(period=BucketPeriod.DAY, starts_on__gte=start, starts_on__lt=end)
+    return (
+        Q(
+            period=BucketPeriod.MONTH,
+            starts_on__gte=first_month,
+            starts_on__lt=months_end,
+        )
+        | Q(period=BucketPeriod.DAY, starts_on__gte=start, starts_on__lt=first_month)
+        | Q(period=BucketPeriod.DAY, starts_on__gte=months_end, starts_on__lt=end)
+    )
+
+
+def top_played(chart, start: date, end: date, limit=20) -> list[ChartEntry]:
+    """
+    Returns the most played tracks, albums or artists from the start date up to
+    (but not including) the end date, most played first.
+    """
+    bucket, name, artist_name = CHARTS[chart]
+    if start >= end:
+        return []
+    entries = (
+        bucket.objects.filter(window_buckets(start, end))
+        .values(bucket.key_field)
+        .annotate(
+            chart_name=name,
+            chart_artist_name=artist_name,
+            total_plays=Sum("play_count"),
+        )
+        .order_by("-total_plays", bucket.key_field)
+        .values_list(bucket.key_field, "chart_name", "chart_artist_name", "total_plays")
+    )
+    return [ChartEntry(*entry) for entry in entries[:limit]]
+
+
+def last_days(days) -> tuple[date, date]:
+    """
+    Returns the window of the given number of days up to and including today.
+    """
+    tomorrow = timezone.localdate() + timedelta(days=1)
+    return tomorrow - timedelta(days=days), tomorrow
@@ -0,0 +1,359 @@
+"""
+Batched import of tagged music files into the tracks DB
+"""
+
+import logging
+import os
+import uuid
+from itertools import batched
+from pathlib import Path
+
+from django.db import DatabaseError, transaction
+from django.utils import timezone
+
+from .matching import identifier_cache, refresh_match_index
+from .models import (
+    Album,
+    Artist,
+    Genre,
+    LibraryFile,
+    ManifestEntry,
+    Track,
+    UnmatchedScrobble,
+    refresh_rollups,
+    rollup_keys,
+    stat_inode,
+)
+from .tags import TaggedFile, is_supported_file, read_tagged_files
+
+logger = logging.getLogger(__name__)
+
+
+class LibraryImporter:
+    """
+    Gathers tagged files into batches and writes each batch with a handful of
+    bulk upserts. Artists, genres and albums are resolved through in-memory caches
+    that live as long as the importer, so a warm importer only needs to write the
+    tracks and the file manifest.
+    """
+
+    def __init__(self, batch_size=1000, on_flush=None):
+        self.batch_size = batch_size
+        self.on_flush = on_flush
+        self.artist_ids: dict[str, int] = {}
+        self.genre_ids: dict[str, int] = {}
+        self.album_ids: dict[uuid.UUID, int] = {}
+        self.saved_track_ids: set[int] = set()
+        self._pending = []
+
+    def add(self, file_stat: os.stat_result, tagged_file: TaggedFile):
+        self._pending.append(
+            (
+                tagged_file.file_path,
+                file_stat,
+                tagged_file,
+                tagged_file.tag_digest,
+                None,
+            )
+        )
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def refresh(self, file_path, file_stat: os.stat_result, entry: ManifestEntry):
+        """
+        Updates the manifest for a file whose tags are unchanged.
+        """
+        self._pending.append(
+            (str(file_path), file_stat, None, entry.tag_digest, entry.track_id)
+        )
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        try:
+            self._save(batch)
+        except DatabaseError as exc:
+            # a single bad file shouldn't lose the whole batch, so isolate it
+            logger.warning(
+                "Failed to import batch, retrying files individually: %s", exc
+            )
+            for item in batch:
+                try:
+                    self._save([item])
+                except DatabaseError as item_exc:
+                    logger.error("Failed to import file %s: %s", item[0], str(item_exc))
+        if self.on_flush:
+            self.on_flush()
+
+    def _save(self, batch):
+        # work on copies of the caches so a rolled back batch can't leave
+        # references to rows that were never committed
+        artist_ids = dict(self.artist_ids)
+        genre_ids = dict(self.genre_ids)
+        album_ids = dict(self.album_ids)
+        imported_on = timezone.now()
+        with transaction.atomic():
+            tagged_batch = [item for item in batch if item[2] is not None]
+            track_ids = self._save_tracks(
+                tagged_batch, artist_ids, genre_ids, album_ids
+            )
+            Track.update_search_vectors(set(track_ids.values()))
+            library_files = {}
+            for file_path, file_stat, tagged_file, tag_digest, track_id in batch:
+                if tagged_file is not None:
+                    # files that weren't imported are kept in the manifest too, so
+                    # they aren't read again until they change
+                    track_id = track_ids.get(file_path)
+                library_files[file_path] = LibraryFile(
+                    file_path=file_path,
+                    size=file_stat.st_size,
+                    mtime_ns=file_stat.st_mtime_ns,
+                    inode=stat_inode(file_stat),
+                    tag_digest=tag_digest,
+                    track_id=track_id,
+                    is_missing=False,
+                    imported_on=imported_on,
+                )
+            LibraryFile.objects.bulk_create(
+                library_files.values(),
+                update_conflicts=True,
+                unique_fields=["file_path"],
+                update_fields=[
+                    "size",
+                    "mtime_ns",
+                    "inode",
+                    "tag_digest",
+                    "track",
+                    "is_missing",
+                    "imported_on",
+                ],
+            )
+        self.artist_ids = artist_ids
+        self.genre_ids = genre_ids
+        self.album_ids = album_ids
+        self.saved_track_ids.update(track_ids.values())
+        refresh_match_index(track_ids.values())
+
+    def _save_tracks(self, batch, artist_ids, genre_ids, album_ids) -> dict[str, int]:
+        """
+        Upserts the tracks (and their artists, genres and albums) for the batch,
+        returning the track ID for each imported file path.
+        """
+        artist_names = set()
+        genre_names = set()
+        for file_path, _, tagged_file, _, _ in batch:
+            if tagged_file.artist:
+                artist_names.add(tagged_file.artist)
+            if tagged_file.album:
+                if tagged_file.albumartist:
+                    artist_names.add(tagged_file.albumartist)
+                if tagged_file.genre:
+                    genre_names.add(tagged_file.genre)
+        resolve_names(Artist, artist_names, artist_ids)
+        resolve_names(Genre, genre_names, genre_ids)
+
+        new_albums = {}
+        tracks = {}
+        track_paths = {}
+        for file_path, _, tagged_file, _, _ in batch:
+            album_identifier = None
+            if not tagged_file.album:
+                logger.warning("No album data for tagged data %s", file_path)
+            elif not tagged_file.artist:
+                logger.error("Failed to import file %s: album has no artist", file_path)
+                continue
+            else:
+                album_identifier = Album.generate_identifier(
+                    tagged_file.album,
+                    album_artist_name=tagged_file.albumartist,
+                    artist_name=tagged_file.artist,
+                    genre=tagged_file.genre,
+                    disc_number=tagged_file.disc,
+                )
+                if (
+                    album_identifier not in album_ids
+                    and album_identifier not in new_albums
+                ):
+                    new_albums[album_identifier] = Album(
+                        name=tagged_file.album,
+                        disc_number=tagged_file.disc,
+                        artist_id=artist_ids[tagged_file.artist],
+                        album_artist_id=artist_ids.get(tagged_file.albumartist),
+                        genre_id=genre_ids.get(tagged_file.genre),
+                        hashed_identifier=album_identifier,
+                    )
+            if not tagged_file.artist:
+                logger.warning("Failed to generate artist name for track %s", file_path)
+
+            track_identifier = Track.generate_identifier(
+                track_name=tagged_file.title,
+                artist_name=tagged_file.artist,
+                album_name=tagged_file.album,
+            )
+            # upserts can't touch the same row twice, so the first file wins
+            if track_identifier not in tracks:
+                tracks[track_identifier] = (
+                    Track(
+                        name=tagged_file.title,
+                        track_number=tagged_file.track,
+                        artist_id=artist_ids.get(tagged_file.artist),
+                        file_path=file_path,
+                        hashed_identifier=track_identifier,
+                        is_missing=False,
+                    ),
+                    album_identifier,
+                )
+            track_paths[file_path] = track_identifier
+
+        if new_albums:
+            persisted_albums = Album.objects.bulk_create(
+                new_albums.values(),
+                update_conflicts=True,
+                unique_fields=["hashed_identifier"],
+                update_fields=["name"],
+            )
+            album_ids.update(
+                (album.hashed_identifier, album.pk) for album in persisted_albums
+            )
+
+        # a track can be imported from several files, e.g. copies in different
+        # formats, so an existing track is only updated from the file it was
+        # imported from, or from another file once that one has gone missing
+        track_ids = {}
+        stored_tracks = Track.objects.filter(
+            hashed_identifier__in=tracks.keys(), is_missing=False
+        ).values_list("hashed_identifier", "pk", "file_path")
+        for track_identifier, track_id, stored_file_path in stored_tracks:
+            if tracks[track_identifier][0].file_path != stored_file_path:
+                track_ids[track_identifier] = track_id
+                del tracks[track_identifier]
+        for track, album_identifier in tracks.values():
+            track.album_id = album_ids.get(album_identifier)
+        persisted_tracks = Track.objects.bulk_create(
+            [track for track, _ in tracks.values()],
+            update_conflicts=True,
+            unique_fields=["hashed_identifier"],
+            update_fields=[
+                "name",
+                "track_number",
+                "artist",
+                "album",
+                "file_path",
+                "is_missing",
+            ],
+        )
+        track_ids.update(
+            (track.hashed_identifier, track.pk) for track in persisted_tracks
+        )
+        # cached lookups made before the commit could miss the new tracks
+        transaction.on_commit(lambda: identifier_cache.invalidate(track_ids.keys()))
+        return {
+            file_path: track_ids[track_identifier]
+            for file_path, track_identifier in track_paths.items()
+        }
+
+
+def resolve_names(model, names, name_ids: dict[str, int]):
+    """
+    Populates the name → ID cache with the given names, creating any names that
+    don't exist yet.
+    """
+    missing_names = sorted(names - name_ids.keys())
+    if not missing_names:
+        return
+    persisted_objects = model.objects.bulk_create(
+        [model(name=name) for name in missing_names],
+        update_conflicts=True,
+        unique_fields=["name"],
+        update_fields=["name"],
+    )
+    name_ids.update((obj.name, obj.pk) for obj in persisted_objects)
+
+
+def save_tagged_files(importer: LibraryImporter, chunk, results):
+    for (file_path, file_stat, manifest_entry), tagged_file in zip(chunk, results):
+        if isinstance(tagged_file, Exception):
+            logger.error("Failed to import file %s: %s", file_path, str(tagged_file))
+        elif manifest_entry and manifest_entry.tag_digest == tagged_file.tag_digest:
+            # file was touched but the tags are the same, so just refresh the manifest
+            importer.refresh(file_path, file_stat, manifest_entry)
+        else:
+            importer.add(file_stat, tagged_file)
+
+
+def import_paths(paths, chunk_size=50):
+    """
+    Re-imports the given library files and directories in the current thread,
+    marking any that no longer exist as missing.
+    """
+    file_paths = []
+    vanished_paths = set()
+    for path in paths:
+        if os.path.isdir(path):
+            for current_root, dirs, files in Path(path).walk():
+                file_paths.extend(
+                    str(current_root / name)
+                    for name in files
+                    if is_supported_file(name)
+                )
+        elif os.path.isfile(path):
+            if is_supported_file(path):
+                file_paths.append(path)
+        else:
+            # could be a single file or an entire directory that was removed
+            vanished_paths.add(path)
+            vanished_paths.update(LibraryFile.load_manifest(path).keys())
+
+    # files can be queued on their own as well as within a new directory
+    file_paths = list(dict.fromkeys(file_paths))
+    manifest = LibraryFile.load_file_manifest(file_paths)
+    scanned_files = []
+    for file_path in file_paths:
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            vanished_paths.add(file_path)
+            continue
+        manifest_entry = manifest.get(file_path)
+        if manifest_entry and LibraryFile.is_unchanged(manifest_entry, file_stat):
+            continue
+        scanned_files.append((file_path, file_stat, manifest_entry))
+
+    # re-tagged tracks can move to other albums, artists or genres, so the rollups
+    # they're moving from are refreshed as well as those they're moving to
+    touched_keys = rollup_keys(
+        manifest_entry.track_id
+        for _, _, manifest_entry in scanned_files
+        if manifest_entry and manifest_entry.track_id
+    )
+    importer = LibraryImporter()
+    for chunk in batched(scanned_files, chunk_size):
+        file_paths = [file_path for file_path, _, _ in chunk]
+        save_tagged_files(importer, chunk, read_tagged_files(file_paths))
+    importer.flush()
+    if vanished_paths:
+        LibraryFile.mark_missing(vanished_paths)
+    logger.info(
+        "Imported %d changed library files, %d removed",
+        len(scanned_files),
+        len(vanished_paths),
+    )
+    if scanned_files:
+        for rollup, keys in rollup_keys(importer.saved_track_ids).items():
+            touched_keys[rollup] |= keys
+        refresh_rollups(touched_keys)
+        UnmatchedScrobble.resolve_pending()
+
+
+def move_paths(moves):
+    """
+    Applies the given moves of library files and directories to the manifest and
+    tracks, in order.
+    """
+    moved_files = 0
+    for src_path, dest_path, is_directory in moves:
+        moved_files += LibraryFile.move(src_path, dest_path, is_directory=is_directory)
+    logger.info("Moved %d library files", moved_files)
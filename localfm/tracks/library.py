@@ -1,34 +1,201 @@
 import logging
+import os
+import threading
+import time
+from collections import namedtuple
 
 from django.conf import settings
-from watchdog.events import DirModifiedEvent, FileModifiedEvent, FileSystemEventHandler
+from django.db import connections
+from watchdog.events import (
+    EVENT_TYPE_CREATED,
+    EVENT_TYPE_DELETED,
+    EVENT_TYPE_MODIFIED,
+    DirMovedEvent,
+    FileMovedEvent,
+    FileSystemEvent,
+    FileSystemEventHandler,
+)
 from watchdog.observers import Observer
 
 from localfm.core.runtime import CancellationToken
 
+from .tags import is_supported_file
+
 logger = logging.getLogger(__name__)
 
+LibraryChanges = namedtuple("LibraryChanges", "moves, paths")
+LibraryMove = namedtuple("LibraryMove", "src_path, dest_path, is_directory")
+
+
+class LibraryChangeQueue:
+    """
+    Collects the paths of changed library files, coalescing bursts of events into
+    a single batch that's only released once the library has been quiet for the
+    debounce period (or the oldest change has waited for the maximum delay).
+
+    Moves are kept separately, in order, so they can be applied to the DB without
+    re-reading the tags of the moved files.
+    """
+
+    def __init__(self, debounce_seconds=2.0, max_delay_seconds=30.0):
+        self.debounce_seconds = debounce_seconds
+        self.max_delay_seconds = max_delay_seconds
+        self._condition = threading.Condition()
+        # dict rather than set to retain the order of the changes
+        self._paths: dict[str, None] = {}
+        self._moves: list[LibraryMove] = []
+        self._first_change_at = None
+        self._last_change_at = None
+
+    def put(self, path):
+        with self._condition:
+            self._paths[path] = None
+            self._record_change()
+
+    def put_move(self, src_path, dest_path, is_directory=False):
+        with self._condition:
+            if not self._is_implied_move(src_path, dest_path):
+                self._moves.append(LibraryMove(src_path, dest_path, is_directory))
+            # any changes queued under the old path now apply to the new one
+            src_prefix = os.path.join(src_path, "")
+            self._paths = {
+                moved_path(path, src_path, dest_path)
+                if path == src_path or path.startswith(src_prefix)
+                else path: None
+                for path in self._paths
+            }
+            self._record_change()
+
+    def _is_implied_move(self, src_path, dest_path):
+        # directory moves can be followed by events for each of the moved files
+        # but those are already covered by the move of the directory
+        for move in self._moves:
+            if (
+                move.is_directory
+                and src_path.startswith(os.path.join(move.src_path, ""))
+                and moved_path(src_path, move.src_path, move.dest_path) == dest_path
+            ):
+                return True
+        return False
+
+    def _record_change(self):
+        now = time.monotonic()
+        if self._first_change_at is None:
+            self._first_change_at = now
+        self._last_change_at = now
+        self._condition.notify()
+
+    def take(self, timeout) -> LibraryChanges | None:
+        """
+        Waits up to the timeout for a batch of changes to settle, returning None
+        if none are ready.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                wake_at = deadline
+                if self._paths or self._moves:
+                    ready_at = min(
+                        self._last_change_at + self.debounce_seconds,
+                        self._first_change_at + self.max_delay_seconds,
+                    )
+                    if now >= ready_at:
+                        changes = LibraryChanges(self._moves, list(self._paths))
+                        self._moves = []
+                        self._paths = {}
+                        self._first_change_at = self._last_change_at = None
+                        return changes
+                    wake_at = min(ready_at, deadline)
+                if now >= deadline:
+                    return None
+                self._condition.wait(wake_at - now)
+
 
 class LibraryEventHandler(FileSystemEventHandler):
     """
     Update localfm state as appropriate when library data changes.
     """
 
-    def on_modified(self, event: DirModifiedEvent | FileModifiedEvent) -> None:
-        super().on_modified(event)
+    # moves are handled separately by on_moved
+    QUEUED_EVENT_TYPES = {
+        EVENT_TYPE_CREATED,
+        EVENT_TYPE_MODIFIED,
+        EVENT_TYPE_DELETED,
+    }
+
+    def __init__(self, change_queue: LibraryChangeQueue):
+        super().__init__()
+        self.change_queue = change_queue
+
+    def on_any_event(self, event: FileSystemEvent) -> None:
+        if event.event_type not in self.QUEUED_EVENT_TYPES:
+            return
+        if event.is_directory and event.event_type == EVENT_TYPE_MODIFIED:
+            # the events for the files within the directory cover any changes
+            return
+
+        if event.is_directory or is_supported_file(event.src_path):
+            logger.debug("Queueing %s of %s", event.event_type, event.src_path)
+            self.change_queue.put(event.src_path)
+
+    def on_moved(self, event: DirMovedEvent | FileMovedEvent) -> None:
+        super().on_moved(event)
+
+        src_path, dest_path = event.src_path, event.dest_path
+        if event.is_directory or (
+            is_supported_file(src_path) and is_supported_file(dest_path)
+        ):
+            logger.debug("Queueing move of %s to %s", src_path, dest_path)
+            self.change_queue.put_move(
+                src_path, dest_path, is_directory=event.is_directory
+            )
+        elif is_supported_file(dest_path):
+            # e.g. a temporary file being renamed to its final name
+            self.change_queue.put(dest_path)
+        elif is_supported_file(src_path):
+            self.change_queue.put(src_path)
 
-        # TODO: update the library to account for any music file changes
-        # ignore any files other than mp3 or aac
-        # if the music file is new or has changed, attempt to import it
-        # should it be done sync or async? Unclear what the process model
-        # for watchdog library is and how it varies by platform.
-        what = "directory" if event.is_directory else "file"
-        logger.info("Modified %s: %s", what, event.src_path)
+
+def moved_path(path, src_path, dest_path):
+    return dest_path + path[len(src_path) :]
+
+
+def process_changes(change_queue: LibraryChangeQueue, stop_token: CancellationToken):
+    # imported here since the listener module is loaded before Django is set up
+    from .importer import import_paths, move_paths
+
+    try:
+        while not stop_token.is_canceled():
+            changes = change_queue.take(timeout=0.5)
+            if not changes:
+                continue
+            logger.info(
+                "Importing %d moves and %d changed paths in the library",
+                len(changes.moves),
+                len(changes.paths),
+            )
+            try:
+                if changes.moves:
+                    move_paths(changes.moves)
+                if changes.paths:
+                    import_paths(changes.paths)
+            except Exception:
+                logger.exception("Failed to import library changes")
+    finally:
+        connections.close_all()
 
 
 def listen_for_changes(shutdown_token: CancellationToken):
     logger.info("Listening for library changes at %s", settings.MUSIC_LIBRARY_DIRECTORY)
-    event_handler = LibraryEventHandler()
+    change_queue = LibraryChangeQueue()
+    # the processing thread has its own token so it also stops if the observer dies
+    process_token = CancellationToken()
+    process_thread = threading.Thread(
+        target=process_changes, args=(change_queue, process_token)
+    )
+    process_thread.start()
+    event_handler = LibraryEventHandler(change_queue)
     observer = Observer()
     observer.schedule(event_handler, settings.MUSIC_LIBRARY_DIRECTORY, recursive=True)
     observer.start()
@@ -38,3 +205,5 @@ def listen_for_changes(shutdown_token: CancellationToken):
     finally:
         observer.stop()
         observer.join()
+        process_token.cancel()
+        process_thread.join()
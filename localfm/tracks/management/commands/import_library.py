@@ -5,14 +5,22 @@ Imports the entire music library into the tracks DB
 import logging
 import os
 import time
-from concurrent.futures import ThreadPoolExecutor
+from collections import Counter
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from itertools import batched
 from pathlib import Path
 
 from django.conf import settings
 from django.core.management import BaseCommand
-from tinytag import TinyTag
 
-from localfm.tracks.models import Track
+from localfm.tracks.importer import LibraryImporter, save_tagged_files
+from localfm.tracks.models import (
+    LibraryFile,
+    LibraryImport,
+    UnmatchedScrobble,
+    refresh_rollups,
+)
+from localfm.tracks.tags import is_supported_file, read_tagged_files
 
 logger = logging.getLogger(__name__)
 
@@ -30,38 +38,69 @@ class Command(BaseCommand):
         parser.add_argument(
             "--parallel-workers",
             type=int,
-            default=2,
-            help="Number of parallel processes for importing",
+            default=os.cpu_count(),
+            help="Number of parallel processes for reading file tags",
         )
         parser.add_argument(
             "--name-filter", help="Filter to specific directories by name"
         )
+        parser.add_argument(
+            "--incremental",
+            action="store_true",
+            help="Only read the tags of files that are new or changed since the "
+            "last import",
+        )
+        parser.add_argument(
+            "--resume",
+            action="store_true",
+            help="Resume the last interrupted import, skipping the work it committed",
+        )
 
     def handle(
         self,
         library_directory,
         log_level=logging.INFO,
-        parallel_workers=5,
+        parallel_workers=None,
         name_filter=None,
+        incremental=False,
+        resume=False,
         *args,
         **options,
     ):
         logging.basicConfig(level=log_level)
 
         root_dir = Path(library_directory)
+        library_import = LibraryImport.start(root_dir, resume=resume)
+        completed_directories = set(library_import.completed_directories)
         base_directories = [
             directory
             for directory in root_dir.iterdir()
             if directory.is_dir()
             and is_filtered(directory.name, name_filter=name_filter)
+            and directory.name not in completed_directories
         ]
+        parallel_workers = parallel_workers or os.cpu_count()
         start_time = time.time()
-        with ThreadPoolExecutor(max_workers=parallel_workers) as executor:
-            _results = [
-                result
-                for result in executor.map(import_from_directory, base_directories)
-            ]
-        logger.info(f"Imported tracks in %s seconds", time.time() - start_time)
+        progress = ImportProgress(library_import)
+        importer = LibraryImporter(on_flush=progress.commit)
+        with ProcessPoolExecutor(max_workers=parallel_workers) as executor:
+            import_files(
+                executor,
+                importer,
+                progress,
+                scan_directories(
+                    base_directories,
+                    progress,
+                    incremental=incremental,
+                    # files committed by the interrupted import can be skipped
+                    imported_since=library_import.started_on if resume else None,
+                ),
+                max_pending=parallel_workers * 4,
+            )
+        library_import.complete()
+        logger.info("Imported tracks in %s seconds", time.time() - start_time)
+        refresh_rollups()
+        UnmatchedScrobble.resolve_pending()
 
 
 def is_filtered(name, name_filter=None):
@@ -70,15 +109,128 @@ def is_filtered(name, name_filter=None):
     return name
 
 
-def import_from_directory(base_directory):
-    logger.debug("Importing from directory: %s", base_directory)
-    for current_root, dirs, files in base_directory.walk():
-        for name in files:
-            file_path = current_root / name
-            file_extension = os.path.splitext(name)[1]
-            if file_extension in TinyTag.SUPPORTED_FILE_EXTENSIONS:
-                tagged_data = TinyTag.get(file_path)
+class ImportProgress:
+    """
+    Checkpoints each base directory of the import once all of its files have been
+    committed, so an interrupted import can be resumed.
+    """
+
+    def __init__(self, library_import: LibraryImport):
+        self.library_import = library_import
+        self._file_directories: dict[str, str] = {}
+        self._remaining_files = Counter()
+        self._scanned_directories = set()
+        self._processed_directories = []
+
+    def add_file(self, base_directory, file_path):
+        self._file_directories[file_path] = base_directory.name
+        self._remaining_files[base_directory.name] += 1
+
+    def finish_scan(self, base_directory):
+        self._scanned_directories.add(base_directory.name)
+        self._check_directory(base_directory.name)
+
+    def process_files(self, file_paths):
+        """
+        Records that the files have been handed to the importer, so they'll be
+        committed by its next flush.
+        """
+        for file_path in file_paths:
+            directory_name = self._file_directories.pop(file_path)
+            self._remaining_files[directory_name] -= 1
+            self._check_directory(directory_name)
+
+    def _check_directory(self, directory_name):
+        if (
+            directory_name in self._scanned_directories
+            and self._remaining_files[directory_name] == 0
+        ):
+            self._scanned_directories.remove(directory_name)
+            del self._remaining_files[directory_name]
+            self._processed_directories.append(directory_name)
+
+    def commit(self):
+        if self._processed_directories:
+            self.library_import.complete_directories(self._processed_directories)
+            self._processed_directories = []
+
+
+def scan_directories(
+    base_directories, progress: ImportProgress, incremental=False, imported_since=None
+):
+    """
+    Walks the given directories, yielding every music file whose tags need to be
+    read along with its stat and manifest entry (if any).
+    """
+    for base_directory in base_directories:
+        logger.debug("Importing from directory: %s", base_directory)
+        manifest = LibraryFile.load_manifest(base_directory)
+        found_paths = set()
+        for current_root, dirs, files in base_directory.walk():
+            for name in files:
+                if not is_supported_file(name):
+                    continue
+                file_path = str(current_root / name)
+                found_paths.add(file_path)
                 try:
-                    Track.get_or_create_by_tagged_data(file_path, tagged_data)
-                except Exception as exc:
+                    file_stat = os.stat(file_path)
+                except OSError as exc:
                     logger.error("Failed to import file %s: %s", file_path, str(exc))
+                    continue
+                manifest_entry = manifest.get(file_path)
+                if (
+                    imported_since
+                    and manifest_entry
+                    and manifest_entry.imported_on
+                    and manifest_entry.imported_on >= imported_since
+                ):
+                    continue
+                if not incremental:
+                    manifest_entry = None
+                elif manifest_entry and LibraryFile.is_unchanged(
+                    manifest_entry, file_stat
+                ):
+                    continue
+                progress.add_file(base_directory, file_path)
+                yield file_path, file_stat, manifest_entry
+
+        vanished_paths = manifest.keys() - found_paths
+        if vanished_paths:
+            logger.info(
+                "Marking %d missing files in directory %s",
+                len(vanished_paths),
+                base_directory,
+            )
+            LibraryFile.mark_missing(vanished_paths)
+        progress.finish_scan(base_directory)
+
+
+def import_files(
+    executor,
+    importer: LibraryImporter,
+    progress: ImportProgress,
+    scanned_files,
+    chunk_size=50,
+    max_pending=8,
+):
+    """
+    Reads the tags of the scanned files in the executor's worker processes and
+    feeds the results to the importer, which is the only writer to the DB.
+    """
+    pending = {}
+    for chunk in batched(scanned_files, chunk_size):
+        file_paths = [file_path for file_path, _, _ in chunk]
+        pending[executor.submit(read_tagged_files, file_paths)] = chunk
+        if len(pending) >= max_pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                save_results(importer, progress, pending.pop(future), future.result())
+    for future in pending:
+        save_results(importer, progress, pending[future], future.result())
+    importer.flush()
+    progress.commit()
+
+
+def save_results(importer: LibraryImporter, progress: ImportProgress, chunk, results):
+    save_tagged_files(importer, chunk, results)
+    progress.process_files(file_path for file_path, _, _ in chunk)
@@ -0,0 +1,31 @@
+"""
+Recounts the play counts of all tracks from their plays and recalculates the
+album, artist and genre rollups and the daily and monthly play buckets
+"""
+
+import logging
+import time
+
+from django.core.management import BaseCommand
+from django.db import transaction
+
+from localfm.tracks.models import Track, rebuild_buckets, refresh_rollups
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--log-level", default="INFO", help="Log level for the script"
+        )
+
+    def handle(self, log_level=logging.INFO, *args, **options):
+        logging.basicConfig(level=log_level)
+
+        start_time = time.time()
+        with transaction.atomic():
+            Track.recount_play_counts()
+            refresh_rollups()
+            rebuild_buckets()
+        logger.info("Rebuilt rollups in %s seconds", time.time() - start_time)
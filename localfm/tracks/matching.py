@@ -0,0 +1,418 @@
+"""
+In-memory index for fuzzy matching of scrobbled names to library tracks.
+
+Scrobbles and library tags often disagree on details that the exact track
+identifiers can't ignore: "feat." vs "ft.", Unicode punctuation, "(Remastered
+2011)" suffixes and so on. Names are normalised to drop those details, and names
+that still differ are matched by the similarity of their trigrams.
+"""
+
+import logging
+import re
+import threading
+import time
+import unicodedata
+import uuid
+from collections import OrderedDict, defaultdict, namedtuple
+
+from .models import Track
+
+logger = logging.getLogger(__name__)
+
+NOISE_WORDS = (
+    r"remaster(?:ed)?|live|version|edit|mono|stereo|deluxe|bonus|explicit|demo"
+    r"|mix|remix|single|edition|anniversary|expanded"
+)
+# bracketed noise, e.g. "(Remastered 2011)" or "[Deluxe Edition]"
+BRACKETED_NOISE_PATTERN = re.compile(rf"[(\[][^)\]]*\b(?:{NOISE_WORDS})\b[^)\]]*[)\]]")
+# dashed noise suffixes, e.g. " - 2011 Remaster" or " - Live at Wembley"
+DASHED_NOISE_PATTERN = re.compile(rf"\s[-–]\s[^-–]*\b(?:{NOISE_WORDS})\b.*$")
+# featured artists, e.g. "(feat. Someone)" or "ft. Someone"
+FEATURING_PATTERN = re.compile(r"[(\[]?\b(?:feat|ft|featuring)\b\.?\s.*$")
+APOSTROPHE_PATTERN = re.compile(r"['’`]")
+NON_WORD_PATTERN = re.compile(r"[^\w]+")
+LEADING_ARTICLE_PATTERN = re.compile(r"^the\s+")
+DIGITS_PATTERN = re.compile(r"\d+")
+ROMAN_NUMERAL_PATTERN = re.compile(
+    r"m{0,3}(?:cm|cd|d?c{0,3})(?:xc|xl|l?x{0,3})(?:ix|iv|v?i{0,3})"
+)
+ROMAN_NUMERAL_VALUES = {"i": 1, "v": 5, "x": 10, "l": 50, "c": 100, "d": 500, "m": 1000}
+
+# the index is kept up to date with the tracks this process saves, and rebuilt
+# after this many seconds to pick up those saved by others, e.g. library imports
+MATCH_INDEX_TTL = 3600
+
+MatchEntry = namedtuple("MatchEntry", "track_id, name, trigrams, numbers, album_name")
+
+
+def normalise_name(name) -> str:
+    """
+    Normalises the name for matching: Unicode compatibility forms and case are
+    folded, noise such as remaster or featured artist suffixes is stripped and
+    all punctuation is dropped.
+    """
+    if not name:
+        return ""
+    folded = unicodedata.normalize("NFKC", name).casefold()
+    normalised = BRACKETED_NOISE_PATTERN.sub(" ", folded)
+    normalised = DASHED_NOISE_PATTERN.sub("", normalised)
+    normalised = FEATURING_PATTERN.sub("", normalised)
+    normalised = normalised.replace("&", " and ")
+    normalised = APOSTROPHE_PATTERN.sub("", normalised)
+    normalised = NON_WORD_PATTERN.sub(" ", normalised).strip()
+    normalised = LEADING_ARTICLE_PATTERN.sub("", normalised)
+    # a name that's all noise is better matched as it is
+    return normalised or NON_WORD_PATTERN.sub(" ", folded).strip()
+
+
+def roman_numeral_value(numeral) -> int:
+    values = [ROMAN_NUMERAL_VALUES[letter] for letter in numeral]
+    return sum(
+        -value if value < next_value else value
+        for value, next_value in zip(values, values[1:] + [0])
+    )
+
+
+def numbers(normalised_name) -> tuple[int, ...]:
+    """
+    Returns the numbers in the normalised name, written in digits or as Roman
+    numerals, e.g. (2, 5) for "symphony no 5 part ii".
+    """
+    found = [int(digits) for digits in DIGITS_PATTERN.findall(normalised_name)]
+    found.extend(
+        roman_numeral_value(word)
+        for word in normalised_name.split()
+        if ROMAN_NUMERAL_PATTERN.fullmatch(word)
+    )
+    return tuple(sorted(found))
+
+
+def trigrams(normalised_name) -> frozenset[str]:
+    padded = f"  {normalised_name} "
+    return frozenset(padded[index : index + 3] for index in range(len(padded) - 2))
+
+
+def similarity(trigrams_a, trigrams_b) -> float:
+    if not trigrams_a or not trigrams_b:
+        return 0.0
+    shared = len(trigrams_a & trigrams_b)
+    return shared / (len(trigrams_a) + len(trigrams_b) - shared)
+
+
+class TrackMatchIndex:
+    """
+    Finds the library track best matching scrobbled artist, track and album
+    names. Artists are matched first, by normalised name or failing that by
+    trigram similarity, then the tracks of the matched artists are matched the
+    same way, with the album name used to pick between tracks of the same name.
+    Tracks are only matched by similarity if their names have the same numbers,
+    so that e.g. "Part 1" doesn't match "Part 2".
+    """
+
+    def __init__(self, artist_threshold=0.6, track_threshold=0.5):
+        self.artist_threshold = artist_threshold
+        self.track_threshold = track_threshold
+        self._lock = threading.Lock()
+        self._artist_tracks: dict[str, dict[int, MatchEntry]] = defaultdict(dict)
+        self._artist_trigrams: dict[str, frozenset[str]] = {}
+        self._trigram_artists: dict[str, set[str]] = defaultdict(set)
+        self._track_artists: dict[int, str] = {}
+        self.built_at = time.monotonic()
+
+    @classmethod
+    def build(cls, **kwargs) -> "TrackMatchIndex":
+        index = cls(**kwargs)
+        index._load(Track.objects.all())
+        logger.info("Built match index of %d tracks", len(index))
+        return index
+
+    def __len__(self):
+        return len(self._track_artists)
+
+    def update(self, track_ids):
+        """
+        Reloads the given tracks into the index, dropping those that no longer
+        exist.
+        """
+        track_ids = set(track_ids)
+        self._load(Track.objects.filter(pk__in=track_ids), removed_track_ids=track_ids)
+
+    def _load(self, tracks, removed_track_ids=()):
+        rows = list(tracks.values_list("pk", "name", "artist__name", "album__name"))
+        with self._lock:
+            for track_id in removed_track_ids:
+                self._remove(track_id)
+            for track_id, name, artist_name, album_name in rows:
+                self._remove(track_id)
+                self._add(track_id, name, artist_name, album_name)
+
+    def remove(self, track_ids):
+        with self._lock:
+            for track_id in track_ids:
+                self._remove(track_id)
+
+    def _add(self, track_id, name, artist_name, album_name):
+        artist_key = normalise_name(artist_name)
+        if artist_key not in self._artist_trigrams:
+            artist_trigrams = trigrams(artist_key)
+            self._artist_trigrams[artist_key] = artist_trigrams
+            for trigram in artist_trigrams:
+                self._trigram_artists[trigram].add(artist_key)
+        track_name = normalise_name(name)
+        self._artist_tracks[artist_key][track_id] = MatchEntry(
+            track_id,
+            track_name,
+            trigrams(track_name),
+            numbers(track_name),
+            normalise_name(album_name),
+        )
+        self._track_artists[track_id] = artist_key
+
+    def _remove(self, track_id):
+        artist_key = self._track_artists.pop(track_id, None)
+        if artist_key is None:
+            return
+        artist_tracks = self._artist_tracks[artist_key]
+        artist_tracks.pop(track_id, None)
+        if not artist_tracks:
+            del self._artist_tracks[artist_key]
+            for trigram in self._artist_trigrams.pop(artist_key):
+                self._trigram_artists[trigram].discard(artist_key)
+
+    def _match_artists(self, artist_name) -> list[str]:
+        artist_key = normalise_name(artist_name)
+        if artist_key in self._artist_tracks:
+            return [artist_key]
+        artist_trigrams = trigrams(artist_key)
+        candidates = set()
+        for trigram in artist_trigrams:
+            candidates.update(self._trigram_artists.get(trigram, ()))
+        scores = {
+            candidate: similarity(artist_trigrams, self._artist_trigrams[candidate])
+            for candidate in candidates
+        }
+        best_score = max(scores.values(), default=0)
+        if best_score < self.artist_threshold:
+            return []
+        return [candidate for candidate, score in scores.items() if score == best_score]
+
+    def match(self, artist_name, track_name, album_name=None) -> int | None:
+        """
+        Returns the ID of the track best matching the names, or None if there's no
+        close enough match or the best matches can't be told apart.
+        """
+        if not artist_name or not track_name:
+            return None
+        track_key = normalise_name(track_name)
+        track_trigrams = trigrams(track_key)
+        track_numbers = numbers(track_key)
+        album_key = normalise_name(album_name)
+        with self._lock:
+            entries = [
+                entry
+                for artist_key in self._match_artists(artist_name)
+                for entry in self._artist_tracks[artist_key].values()
+            ]
+        exact_entries = [entry for entry in entries if entry.name == track_key]
+        if exact_entries:
+            candidates = exact_entries
+        else:
+            scores = {
+                entry: similarity(track_trigrams, entry.trigrams)
+                for entry in entries
+                if entry.numbers == track_numbers
+            }
+            best_score = max(scores.values(), default=0)
+            if best_score < self.track_threshold:
+                return None
+            candidates = [
+                entry for entry, score in scores.items() if score == best_score
+            ]
+
+        if len(candidates) > 1 and album_key:
+            album_trigrams = trigrams(album_key)
+            album_scores = {
+                entry: (
+                    1.0
+                    if entry.album_name == album_key
+                    else similarity(album_trigrams, trigrams(entry.album_name))
+                )
+                for entry in candidates
+            }
+            best_score = max(album_scores.values())
+            candidates = [
+                entry for entry, score in album_scores.items() if score == best_score
+            ]
+        if len({entry.track_id for entry in candidates}) != 1:
+            return None
+        return candidates[0].track_id
+
+
+_match_index: TrackMatchIndex | None = None
+_match_index_lock = threading.Lock()
+
+
+def get_match_index() -> TrackMatchIndex:
+    """
+    Returns the process-wide match index, building it on first use and
+    rebuilding it once it's expired.
+    """
+    global _match_index
+    with _match_index_lock:
+        if (
+            _match_index is None
+            or _match_index.built_at + MATCH_INDEX_TTL <= time.monotonic()
+        ):
+            _match_index = TrackMatchIndex.build()
+        return _match_index
+
+
+def refresh_match_index(track_ids):
+    """
+    Updates the given tracks in the process-wide match index, if it's been built.
+    """
+    if _match_index is not None and track_ids:
+        _match_index.update(track_ids)
+
+
+def remove_from_match_index(track_ids):
+    """
+    Removes the given tracks from the process-wide match index, if it's been
+    built.
+    """
+    if _match_index is not None:
+        _match_index.remove(track_ids)
+
+
+class IdentifierCache:
+    """
+    Bounded, thread-safe LRU cache of track identifiers and the IDs of their
+    tracks, including identifiers with no track. Entries are dropped when their
+    tracks are saved or deleted (see signals) or re-imported, and otherwise
+    expire: identifiers with no track expire sooner, so tracks imported by
+    another process are picked up quickly.
+    """
+
+    def __init__(self, max_size=50000, ttl=3600, missing_ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.missing_ttl = missing_ttl
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[uuid.UUID, tuple[float, int | None]] = OrderedDict()
+        # the cached identifiers of each track, so they can be dropped together
+        self._track_identifiers: dict[int, set[uuid.UUID]] = defaultdict(set)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get_many(self, identifiers) -> dict[uuid.UUID, int | None]:
+        """
+        Returns the cached track ID (or None for no track) of each of the given
+        identifiers that's cached.
+        """
+        now = time.monotonic()
+        found = {}
+        with self._lock:
+            for identifier in identifiers:
+                entry = self._entries.get(identifier)
+                if entry is None:
+                    continue
+                expires_at, track_id = entry
+                if expires_at <= now:
+                    self._remove(identifier)
+                    continue
+                self._entries.move_to_end(identifier)
+                found[identifier] = track_id
+        return found
+
+    def set_many(self, track_ids: dict[uuid.UUID, int | None]):
+        now = time.monotonic()
+        with self._lock:
+            for identifier, track_id in track_ids.items():
+                self._remove(identifier)
+                ttl = self.missing_ttl if track_id is None else self.ttl
+                self._entries[identifier] = (now + ttl, track_id)
+                if track_id is not None:
+                    self._track_identifiers[track_id].add(identifier)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, identifier):
+        entry = self._entries.pop(identifier, None)
+        if entry is None or entry[1] is None:
+            return
+        track_identifiers = self._track_identifiers.get(entry[1])
+        if track_identifiers is not None:
+            track_identifiers.discard(identifier)
+            if not track_identifiers:
+                del self._track_identifiers[entry[1]]
+
+    def invalidate(self, identifiers):
+        with self._lock:
+            for identifier in identifiers:
+                self._remove(identifier)
+
+    def invalidate_tracks(self, track_ids):
+        """
+        Drops the entries of the given tracks, whatever their identifiers were
+        when they were cached.
+        """
+        with self._lock:
+            for track_id in track_ids:
+                for identifier in self._track_identifiers.pop(track_id, ()):
+                    self._entries.pop(identifier, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._track_identifiers.clear()
+
+
+identifier_cache = IdentifierCache()
+
+
+def resolve_identifiers(identifiers) -> dict[uuid.UUID, int | None]:
+    """
+    Returns the track ID (or None for no track) of each of the given identifiers,
+    only querying for those that aren't cached.
+    """
+    track_ids = identifier_cache.get_many(identifiers)
+    missing_identifiers = set(identifiers) - track_ids.keys()
+    if missing_identifiers:
+        found_ids = Track.resolve_identifiers(missing_identifiers)
+        found_ids = {
+            identifier: found_ids.get(identifier) for identifier in missing_identifiers
+        }
+        identifier_cache.set_many(found_ids)
+        track_ids.update(found_ids)
+    return track_ids
+
+
+def resolve_tracks(names) -> list[int | None]:
+    """
+    Returns the ID of the track matching each of the given (artist, track, album)
+    names, or None where there's no match. Exact matches are resolved from the
+    identifier cache or failing that with one query; the rest fall back to the
+    match index.
+    """
+    identifiers = [
+        Track.generate_identifier(
+            track_name, artist_name=artist_name, album_name=album_name
+        )
+        for artist_name, track_name, album_name in names
+    ]
+    track_ids = resolve_identifiers(set(identifiers))
+    resolved_ids = []
+    for (artist_name, track_name, album_name), identifier in zip(names, identifiers):
+        track_id = track_ids.get(identifier)
+        if track_id is None:
+            track_id = get_match_index().match(artist_name, track_name, album_name)
+            if track_id is not None:
+                logger.debug(
+                    "Matched %s - %s to track %d by name",
+                    artist_name,
+                    track_name,
+                    track_id,
+                )
+        resolved_ids.append(track_id)
+    return resolved_ids
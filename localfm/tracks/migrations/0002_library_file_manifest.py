@@ -0,0 +1,56 @@
+# Generated by Django 5.2.8 on 2026-10-18 13:38
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+import localfm.tracks.models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tracks", "0001_initial"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="track",
+            name="is_missing",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name="LibraryFile",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "file_path",
+                    models.FilePathField(
+                        max_length=2048,
+                        path=localfm.tracks.models.library_directory,
+                        unique=True,
+                    ),
+                ),
+                ("size", models.PositiveBigIntegerField()),
+                ("mtime_ns", models.PositiveBigIntegerField()),
+                ("inode", models.PositiveBigIntegerField()),
+                ("tag_digest", models.CharField(max_length=64)),
+                ("is_missing", models.BooleanField(default=False)),
+                (
+                    "track",
+                    models.ForeignKey(
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        related_name="library_files",
+                        to="tracks.track",
+                    ),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 5.2.8 on 2026-10-18 13:43
+
+from django.db import migrations, models
+
+import localfm.tracks.models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tracks", "0002_library_file_manifest"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="track",
+            name="file_path",
+            field=models.FilePathField(
+                db_index=True,
+                max_length=2048,
+                path=localfm.tracks.models.library_directory,
+            ),
+        ),
+    ]
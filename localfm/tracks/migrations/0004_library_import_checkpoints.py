@@ -0,0 +1,35 @@
+# Generated by Django 5.2.8 on 2026-10-18 13:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tracks", "0003_track_file_path_index"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="LibraryImport",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("library_directory", models.CharField(max_length=2048)),
+                ("started_on", models.DateTimeField(auto_now_add=True)),
+                ("completed_on", models.DateTimeField(null=True)),
+                ("completed_directories", models.JSONField(default=list)),
+            ],
+        ),
+        migrations.AddField(
+            model_name="libraryfile",
+            name="imported_on",
+            field=models.DateTimeField(null=True),
+        ),
+    ]
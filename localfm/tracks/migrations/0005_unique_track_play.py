@@ -0,0 +1,30 @@
+# Generated by Django 5.2.8 on 2026-10-18 13:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tracks", "0004_library_import_checkpoints"),
+    ]
+
+    operations = [
+        # plays were previously only deduplicated by get_or_create, so drop any
+        # duplicates that slipped through before enforcing uniqueness
+        migrations.RunSQL(
+            """
+            DELETE FROM tracks_trackplay plays
+            USING tracks_trackplay duplicates
+            WHERE plays.track_id = duplicates.track_id
+              AND plays.occurred_on = duplicates.occurred_on
+              AND plays.id > duplicates.id;
+            """,
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.AddConstraint(
+            model_name="trackplay",
+            constraint=models.UniqueConstraint(
+                fields=("track", "occurred_on"), name="unique_track_play"
+            ),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.8 on 2026-10-18 13:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tracks", "0005_unique_track_play"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ScrobbleSync",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("username", models.CharField(max_length=255, unique=True)),
+                ("synced_until", models.DateTimeField()),
+                ("updated_on", models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
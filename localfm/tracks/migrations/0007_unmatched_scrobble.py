@@ -0,0 +1,40 @@
+# Generated by Django 5.2.8 on 2026-10-18 13:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tracks", "0006_scrobble_sync"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="UnmatchedScrobble",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                ("artist_name", models.CharField(max_length=2048, null=True)),
+                ("album_name", models.CharField(max_length=2048, null=True)),
+                ("track_name", models.CharField(max_length=2048, null=True)),
+                ("occurred_on", models.DateTimeField()),
+                ("hashed_identifier", models.CharField(db_index=True, max_length=64)),
+                ("created_on", models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("hashed_identifier", "occurred_on"),
+                        name="unique_unmatched_scrobble",
+                    )
+                ],
+            },
+        ),
+    ]
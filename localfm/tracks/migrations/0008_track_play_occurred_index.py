@@ -0,0 +1,18 @@
+# Generated by Django 5.2.8 on 2026-10-18 14:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tracks", "0007_unmatched_scrobble"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="trackplay",
+            index=models.Index(
+                fields=["occurred_on", "id"], name="track_play_occurred_idx"
+            ),
+        ),
+    ]
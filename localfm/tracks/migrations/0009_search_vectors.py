@@ -0,0 +1,73 @@
+# Generated by Django 5.2.8 on 2026-10-18 14:12
+
+import django.contrib.postgres.indexes
+import django.contrib.postgres.search
+from django.db import migrations, models
+
+# the same as Track.update_search_vectors, for all of the existing tracks
+POPULATE_TRACK_SEARCH_VECTORS = """
+UPDATE tracks_track tracks
+SET search_vector =
+    setweight(to_tsvector('simple', tracks.name), 'A') ||
+    setweight(to_tsvector('simple', coalesce(artists.name, '')), 'B') ||
+    setweight(to_tsvector('simple', coalesce(albums.name, '')), 'C')
+FROM tracks_track named_tracks
+LEFT JOIN tracks_artist artists ON artists.id = named_tracks.artist_id
+LEFT JOIN tracks_album albums ON albums.id = named_tracks.album_id
+WHERE named_tracks.id = tracks.id;
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tracks", "0008_track_play_occurred_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="album",
+            name="search_vector",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.contrib.postgres.search.SearchVector(
+                    "name", config="simple", weight="A"
+                ),
+                output_field=django.contrib.postgres.search.SearchVectorField(),
+            ),
+        ),
+        migrations.AddField(
+            model_name="artist",
+            name="search_vector",
+            field=models.GeneratedField(
+                db_persist=True,
+                expression=django.contrib.postgres.search.SearchVector(
+                    "name", config="simple", weight="A"
+                ),
+                output_field=django.contrib.postgres.search.SearchVectorField(),
+            ),
+        ),
+        migrations.AddField(
+            model_name="track",
+            name="search_vector",
+            field=django.contrib.postgres.search.SearchVectorField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name="album",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_vector"], name="album_search_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="artist",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_vector"], name="artist_search_idx"
+            ),
+        ),
+        migrations.AddIndex(
+            model_name="track",
+            index=django.contrib.postgres.indexes.GinIndex(
+                fields=["search_vector"], name="track_search_idx"
+            ),
+        ),
+        migrations.RunSQL(POPULATE_TRACK_SEARCH_VECTORS, migrations.RunSQL.noop),
+    ]
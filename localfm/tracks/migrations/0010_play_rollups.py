@@ -0,0 +1,158 @@
+# Generated by Django 5.2.8 on 2026-10-18 14:13
+
+import django.db.models.deletion
+import django.db.models.expressions
+import django.db.models.functions.comparison
+from django.db import migrations, models
+
+# the same as PlayRollup.refresh, for the existing tracks
+POPULATE_ROLLUPS = """
+INSERT INTO tracks_albumrollup (album_id, play_count, track_count)
+SELECT album_id, sum(play_count), count(*)
+FROM tracks_track
+WHERE album_id IS NOT NULL
+GROUP BY album_id;
+
+INSERT INTO tracks_artistrollup (artist_id, play_count, track_count)
+SELECT artist_id, sum(play_count), count(*)
+FROM tracks_track
+WHERE artist_id IS NOT NULL
+GROUP BY artist_id;
+
+INSERT INTO tracks_genrerollup (genre_id, play_count, track_count)
+SELECT albums.genre_id, sum(tracks.play_count), count(*)
+FROM tracks_track tracks
+INNER JOIN tracks_album albums ON albums.id = tracks.album_id
+WHERE albums.genre_id IS NOT NULL
+GROUP BY albums.genre_id;
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tracks", "0009_search_vectors"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AlbumRollup",
+            fields=[
+                ("play_count", models.PositiveBigIntegerField(default=0)),
+                ("track_count", models.PositiveIntegerField(default=0)),
+                (
+                    "approx_play_count",
+                    models.GeneratedField(
+                        db_persist=True,
+                        expression=django.db.models.expressions.CombinedExpression(
+                            models.F("play_count"),
+                            "/",
+                            django.db.models.functions.comparison.NullIf(
+                                models.F("track_count"), 0
+                            ),
+                        ),
+                        output_field=models.BigIntegerField(null=True),
+                    ),
+                ),
+                (
+                    "album",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="rollup",
+                        serialize=False,
+                        to="tracks.album",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+                "indexes": [
+                    models.Index(
+                        models.OrderBy(models.F("approx_play_count"), descending=True),
+                        name="albumrollup_approx_play_idx",
+                    )
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="ArtistRollup",
+            fields=[
+                ("play_count", models.PositiveBigIntegerField(default=0)),
+                ("track_count", models.PositiveIntegerField(default=0)),
+                (
+                    "approx_play_count",
+                    models.GeneratedField(
+                        db_persist=True,
+                        expression=django.db.models.expressions.CombinedExpression(
+                            models.F("play_count"),
+                            "/",
+                            django.db.models.functions.comparison.NullIf(
+                                models.F("track_count"), 0
+                            ),
+                        ),
+                        output_field=models.BigIntegerField(null=True),
+                    ),
+                ),
+                (
+                    "artist",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="rollup",
+                        serialize=False,
+                        to="tracks.artist",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+                "indexes": [
+                    models.Index(
+                        models.OrderBy(models.F("approx_play_count"), descending=True),
+                        name="artistrollup_approx_play_idx",
+                    )
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="GenreRollup",
+            fields=[
+                ("play_count", models.PositiveBigIntegerField(default=0)),
+                ("track_count", models.PositiveIntegerField(default=0)),
+                (
+                    "approx_play_count",
+                    models.GeneratedField(
+                        db_persist=True,
+                        expression=django.db.models.expressions.CombinedExpression(
+                            models.F("play_count"),
+                            "/",
+                            django.db.models.functions.comparison.NullIf(
+                                models.F("track_count"), 0
+                            ),
+                        ),
+                        output_field=models.BigIntegerField(null=True),
+                    ),
+                ),
+                (
+                    "genre",
+                    models.OneToOneField(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        primary_key=True,
+                        related_name="rollup",
+                        serialize=False,
+                        to="tracks.genre",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+                "indexes": [
+                    models.Index(
+                        models.OrderBy(models.F("approx_play_count"), descending=True),
+                        name="genrerollup_approx_play_idx",
+                    )
+                ],
+            },
+        ),
+        migrations.RunSQL(POPULATE_ROLLUPS, migrations.RunSQL.noop),
+    ]
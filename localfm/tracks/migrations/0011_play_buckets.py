@@ -0,0 +1,175 @@
+# Generated by Django 5.2.8 on 2026-10-18 14:15
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+# the same as PlayBucket.rebuild, for the existing plays
+POPULATE_BUCKETS = """
+INSERT INTO tracks_{name}playbucket ({name}_id, period, starts_on, play_count)
+SELECT tracks.{track_column}, %s,
+       date_trunc(%s, plays.occurred_on AT TIME ZONE %s)::date, count(*)
+FROM tracks_trackplay plays
+INNER JOIN tracks_track tracks ON tracks.id = plays.track_id
+WHERE tracks.{track_column} IS NOT NULL
+GROUP BY 1, 3;
+"""
+
+
+def populate_buckets(apps, schema_editor):
+    with schema_editor.connection.cursor() as cursor:
+        for name, track_column in [
+            ("track", "id"),
+            ("album", "album_id"),
+            ("artist", "artist_id"),
+        ]:
+            for period in ["day", "month"]:
+                cursor.execute(
+                    POPULATE_BUCKETS.format(name=name, track_column=track_column),
+                    [period, period, settings.TIME_ZONE],
+                )
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tracks", "0010_play_rollups"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="AlbumPlayBucket",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "period",
+                    models.CharField(
+                        choices=[("day", "Day"), ("month", "Month")], max_length=8
+                    ),
+                ),
+                ("starts_on", models.DateField()),
+                ("play_count", models.PositiveIntegerField(default=0)),
+                (
+                    "album",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="buckets",
+                        to="tracks.album",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+                "indexes": [
+                    models.Index(
+                        fields=["period", "starts_on"],
+                        name="albumplaybucket_period_idx",
+                    )
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("album", "period", "starts_on"),
+                        name="unique_album_bucket",
+                    )
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="ArtistPlayBucket",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "period",
+                    models.CharField(
+                        choices=[("day", "Day"), ("month", "Month")], max_length=8
+                    ),
+                ),
+                ("starts_on", models.DateField()),
+                ("play_count", models.PositiveIntegerField(default=0)),
+                (
+                    "artist",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="buckets",
+                        to="tracks.artist",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+                "indexes": [
+                    models.Index(
+                        fields=["period", "starts_on"],
+                        name="artistplaybucket_period_idx",
+                    )
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("artist", "period", "starts_on"),
+                        name="unique_artist_bucket",
+                    )
+                ],
+            },
+        ),
+        migrations.CreateModel(
+            name="TrackPlayBucket",
+            fields=[
+                (
+                    "id",
+                    models.BigAutoField(
+                        auto_created=True,
+                        primary_key=True,
+                        serialize=False,
+                        verbose_name="ID",
+                    ),
+                ),
+                (
+                    "period",
+                    models.CharField(
+                        choices=[("day", "Day"), ("month", "Month")], max_length=8
+                    ),
+                ),
+                ("starts_on", models.DateField()),
+                ("play_count", models.PositiveIntegerField(default=0)),
+                (
+                    "track",
+                    models.ForeignKey(
+                        on_delete=django.db.models.deletion.CASCADE,
+                        related_name="buckets",
+                        to="tracks.track",
+                    ),
+                ),
+            ],
+            options={
+                "abstract": False,
+                "indexes": [
+                    models.Index(
+                        fields=["period", "starts_on"],
+                        name="trackplaybucket_period_idx",
+                    )
+                ],
+                "constraints": [
+                    models.UniqueConstraint(
+                        fields=("track", "period", "starts_on"),
+                        name="unique_track_bucket",
+                    )
+                ],
+            },
+        ),
+        migrations.RunPython(populate_buckets, migrations.RunPython.noop),
+    ]
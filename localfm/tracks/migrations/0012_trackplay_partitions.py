@@ -0,0 +1,113 @@
+# Generated by Django 5.2.8 on 2026-10-18 14:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+# Rebuilds the plays table as one partitioned by the year the plays occurred in,
+# with partitions from the year of the first play (2002 at the earliest) up to next
+# year, and a default partition for plays outside those years. Partitioned
+# tables need the partition key in their primary key, so it's (id, occurred_on)
+# while Django carries on treating id as the primary key.
+PARTITION_TRACK_PLAYS = """
+CREATE TABLE tracks_trackplay_partitioned (
+    id bigint NOT NULL,
+    occurred_on timestamp with time zone NOT NULL,
+    track_id bigint NOT NULL
+) PARTITION BY RANGE (occurred_on);
+
+DO $$
+DECLARE
+    year integer;
+BEGIN
+    FOR year IN
+        SELECT generate_series(
+            least(greatest(coalesce(first_year, this_year), 2002), this_year),
+            this_year + 1
+        )
+        FROM (
+            SELECT extract(year FROM min(occurred_on) AT TIME ZONE 'UTC')::integer,
+                   extract(year FROM now() AT TIME ZONE 'UTC')::integer
+            FROM tracks_trackplay
+        ) AS bounds (first_year, this_year)
+    LOOP
+        EXECUTE format(
+            'CREATE TABLE tracks_trackplay_y%s PARTITION OF tracks_trackplay_partitioned '
+            'FOR VALUES FROM (%L) TO (%L)',
+            year,
+            make_timestamptz(year, 1, 1, 0, 0, 0, 'UTC'),
+            make_timestamptz(year + 1, 1, 1, 0, 0, 0, 'UTC')
+        );
+    END LOOP;
+END $$;
+CREATE TABLE tracks_trackplay_default PARTITION OF tracks_trackplay_partitioned DEFAULT;
+
+INSERT INTO tracks_trackplay_partitioned (id, occurred_on, track_id)
+SELECT id, occurred_on, track_id FROM tracks_trackplay;
+
+DROP TABLE tracks_trackplay;
+ALTER TABLE tracks_trackplay_partitioned RENAME TO tracks_trackplay;
+
+ALTER TABLE tracks_trackplay
+    ADD CONSTRAINT tracks_trackplay_pkey PRIMARY KEY (id, occurred_on),
+    ADD CONSTRAINT unique_track_play UNIQUE (track_id, occurred_on),
+    ADD CONSTRAINT tracks_trackplay_track_id_fk_tracks_track_id
+        FOREIGN KEY (track_id) REFERENCES tracks_track (id)
+        DEFERRABLE INITIALLY DEFERRED;
+CREATE INDEX track_play_occurred_idx ON tracks_trackplay (occurred_on, id);
+
+CREATE SEQUENCE tracks_trackplay_id_seq OWNED BY tracks_trackplay.id;
+SELECT setval(
+    'tracks_trackplay_id_seq', coalesce((SELECT max(id) FROM tracks_trackplay), 0) + 1, false
+);
+ALTER TABLE tracks_trackplay
+    ALTER COLUMN id SET DEFAULT nextval('tracks_trackplay_id_seq');
+"""
+
+UNPARTITION_TRACK_PLAYS = """
+CREATE TABLE tracks_trackplay_unpartitioned (
+    id bigint NOT NULL GENERATED BY DEFAULT AS IDENTITY,
+    occurred_on timestamp with time zone NOT NULL,
+    track_id bigint NOT NULL
+);
+
+INSERT INTO tracks_trackplay_unpartitioned (id, occurred_on, track_id)
+SELECT id, occurred_on, track_id FROM tracks_trackplay;
+
+DROP TABLE tracks_trackplay;
+ALTER TABLE tracks_trackplay_unpartitioned RENAME TO tracks_trackplay;
+ALTER SEQUENCE tracks_trackplay_unpartitioned_id_seq RENAME TO tracks_trackplay_id_seq;
+
+ALTER TABLE tracks_trackplay
+    ADD CONSTRAINT tracks_trackplay_pkey PRIMARY KEY (id),
+    ADD CONSTRAINT unique_track_play UNIQUE (track_id, occurred_on),
+    ADD CONSTRAINT tracks_trackplay_track_id_fk_tracks_track_id
+        FOREIGN KEY (track_id) REFERENCES tracks_track (id)
+        DEFERRABLE INITIALLY DEFERRED;
+CREATE INDEX track_play_occurred_idx ON tracks_trackplay (occurred_on, id);
+
+SELECT setval(
+    pg_get_serial_sequence('tracks_trackplay', 'id'),
+    coalesce((SELECT max(id) FROM tracks_trackplay), 0) + 1,
+    false
+);
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tracks", "0011_play_buckets"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="trackplay",
+            name="track",
+            field=models.ForeignKey(
+                db_index=False,
+                on_delete=django.db.models.deletion.CASCADE,
+                related_name="plays",
+                to="tracks.track",
+            ),
+        ),
+        migrations.RunSQL(PARTITION_TRACK_PLAYS, UNPARTITION_TRACK_PLAYS),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 5.2.8 on 2026-10-18 14:18
+
+from django.db import migrations, models
+
+# Existing hex digests are cast to uuid as they are, since they're the same 16
+# bytes. Casting back gives hyphenated strings though, so those are turned back
+# into plain hex digests when reverting.
+REVERT_TO_HEX_DIGESTS = """
+UPDATE tracks_album SET hashed_identifier = replace(hashed_identifier, '-', '');
+UPDATE tracks_track SET hashed_identifier = replace(hashed_identifier, '-', '');
+UPDATE tracks_unmatchedscrobble
+SET hashed_identifier = replace(hashed_identifier, '-', '');
+"""
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("tracks", "0012_trackplay_partitions"),
+    ]
+
+    operations = [
+        migrations.RunSQL(migrations.RunSQL.noop, REVERT_TO_HEX_DIGESTS),
+        migrations.AlterField(
+            model_name="album",
+            name="hashed_identifier",
+            field=models.UUIDField(unique=True),
+        ),
+        migrations.AlterField(
+            model_name="track",
+            name="hashed_identifier",
+            field=models.UUIDField(unique=True),
+        ),
+        migrations.AlterField(
+            model_name="unmatchedscrobble",
+            name="hashed_identifier",
+            field=models.UUIDField(db_index=True),
+        ),
+    ]
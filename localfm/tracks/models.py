@@ -1,11 +1,18 @@
 import hashlib
 import logging
 import os
-from pathlib import Path
+import uuid
+from collections import Counter, defaultdict, namedtuple
+from datetime import UTC, date, datetime
+from itertools import batched
 
 from django.conf import settings
-from django.db import models
-from tinytag import TinyTag
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector, SearchVectorField
+from django.db import DatabaseError, connection, models, transaction
+from django.db.models import Count, Exists, F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Concat, Lower, NullIf, Substr
+from django.utils import timezone
 
 logger = logging.getLogger(__name__)
 
@@ -14,17 +21,45 @@ def library_directory():
     return settings.MUSIC_LIBRARY_DIRECTORY
 
 
-def generate_identifier(*args):
+def generate_identifier(*args) -> uuid.UUID:
     hasher = hashlib.md5(usedforsecurity=False)
     for arg in args:
         # force all text to lower-case (if applicable to the language)
         # since Last.fm has a weird way of not retaining capitalisation correctly
         hasher.update(str(arg).lower().encode())
-    return hasher.hexdigest()
+    # the digest is stored as a 16 byte uuid rather than as hex
+    return uuid.UUID(bytes=hasher.digest())
+
+
+def stat_inode(file_stat: os.stat_result):
+    # Windows file IDs can use the full 64 bits (or more on ReFS) so truncate
+    # them to fit into a signed bigint column
+    return file_stat.st_ino & 0x7FFFFFFFFFFFFFFF
+
+
+ManifestEntry = namedtuple(
+    "ManifestEntry", "size, mtime_ns, inode, tag_digest, track_id, imported_on"
+)
+
+
+# names aren't in any one language, so they're indexed without stemming
+SEARCH_CONFIG = "simple"
+
+
+def name_search_vector():
+    return models.GeneratedField(
+        expression=SearchVector("name", config=SEARCH_CONFIG, weight="A"),
+        output_field=SearchVectorField(),
+        db_persist=True,
+    )
 
 
 class Artist(models.Model):
     name = models.CharField(max_length=256, unique=True)
+    search_vector = name_search_vector()
+
+    class Meta:
+        indexes = [GinIndex(fields=["search_vector"], name="artist_search_idx")]
 
 
 class Genre(models.Model):
@@ -41,71 +76,26 @@ class Album(models.Model):
     )
     name = models.CharField(max_length=2048)
     disc_number = models.PositiveIntegerField(null=True)
-    hashed_identifier = models.CharField(max_length=64, unique=True)
+    hashed_identifier = models.UUIDField(unique=True)
+    search_vector = name_search_vector()
+
+    class Meta:
+        indexes = [GinIndex(fields=["search_vector"], name="album_search_idx")]
 
     @classmethod
     def list_with_play_count(cls, limit=30):
-        raw_query = """
-        SELECT albums.*,
-               artists.name as artist_name,
-               (album_listens.total_album_listens /
-                album_totals.total_tracks) as approx_play_count
-        FROM tracks_album albums
-        INNER JOIN tracks_artist artists ON artists.id = albums.album_artist_id
-        INNER JOIN (
-            SELECT albums.id as album_id, count(*) as total_tracks
-            FROM tracks_track tracks
-            INNER JOIN tracks_album albums ON albums.id = tracks.album_id
-            GROUP BY albums.id
-        ) album_totals ON album_totals.album_id = albums.id
-        INNER JOIN (
-            SELECT albums.id as album_id, albums.name, count(*) as total_album_listens
-            FROM tracks_trackplay plays
-            INNER JOIN tracks_track tracks ON tracks.id = plays.track_id
-            INNER JOIN tracks_album albums ON albums.id = tracks.album_id
-            GROUP BY albums.id, albums.name
-        ) album_listens ON album_listens.album_id = albums.id
-        ORDER BY approx_play_count DESC
-        LIMIT %s;
-        """
-        return Album.objects.raw(raw_query, [limit])
-
-    @classmethod
-    def get_or_create_by_tagged_data(cls, tagged_data: TinyTag):
-        if not tagged_data.album:
-            logger.warning("No album data for tagged data %s", tagged_data.filename)
-            return None
-        album_identifier = cls.generate_identifier(
-            tagged_data.album,
-            album_artist_name=tagged_data.albumartist,
-            artist_name=tagged_data.artist,
-            genre=tagged_data.genre,
-            disc_number=tagged_data.disc,
-        )
-        persisted_album = cls.objects.filter(hashed_identifier=album_identifier).first()
-        if not persisted_album:
-            persisted_genre = None
-            if tagged_data.genre:
-                persisted_genre = Genre.objects.get_or_create(name=tagged_data.genre)[0]
-            persisted_artist = None
-            if tagged_data.artist:
-                persisted_artist = Artist.objects.get_or_create(
-                    name=tagged_data.artist
-                )[0]
-            persisted_album_artist = None
-            if tagged_data.albumartist:
-                persisted_album_artist = Artist.objects.get_or_create(
-                    name=tagged_data.albumartist
-                )[0]
-            persisted_album = cls.objects.create(
-                name=tagged_data.album,
-                disc_number=tagged_data.disc,
-                artist=persisted_artist,
-                album_artist=persisted_album_artist,
-                genre=persisted_genre,
-                hashed_identifier=album_identifier,
+        """
+        Returns the albums with the most plays per track, read from their
+        rollups.
+        """
+        return (
+            cls.objects.filter(rollup__approx_play_count__gt=0)
+            .annotate(
+                artist_name=Coalesce("album_artist__name", "artist__name"),
+                approx_play_count=F("rollup__approx_play_count"),
             )
-        return persisted_album
+            .order_by("-rollup__approx_play_count")[:limit]
+        )
 
     @classmethod
     def generate_identifier(
@@ -135,9 +125,17 @@ class Track(models.Model):
     )
     track_number = models.PositiveIntegerField(null=True)
     name = models.CharField(max_length=2048)
-    file_path = models.FilePathField(path=library_directory, max_length=2048)
+    file_path = models.FilePathField(
+        path=library_directory, max_length=2048, db_index=True
+    )
     play_count = models.PositiveIntegerField(default=0)
-    hashed_identifier = models.CharField(max_length=64, unique=True)
+    hashed_identifier = models.UUIDField(unique=True)
+    is_missing = models.BooleanField(default=False)
+    # covers the artist and album names as well, see update_search_vectors
+    search_vector = SearchVectorField(null=True)
+
+    class Meta:
+        indexes = [GinIndex(fields=["search_vector"], name="track_search_idx")]
 
     @classmethod
     def get_by_identifier(cls, track_name=None, **track_data):
@@ -146,33 +144,101 @@ class Track(models.Model):
         return cls.objects.filter(hashed_identifier=track_identifier).first()
 
     @classmethod
-    def get_or_create_by_tagged_data(cls, file_path: Path, tagged_data: TinyTag):
-        track_identifier = cls.generate_identifier(
-            track_name=tagged_data.title,
-            artist_name=tagged_data.artist,
-            album_name=tagged_data.album,
-        )
-        persisted_track = cls.objects.filter(hashed_identifier=track_identifier).first()
-        if not persisted_track:
-            persisted_artist = None
-            if tagged_data.artist:
-                persisted_artist = Artist.objects.get_or_create(
-                    name=tagged_data.artist
-                )[0]
-            else:
-                logger.warning(
-                    "Failed to generate artist name for track %s", tagged_data
+    def resolve_identifiers(cls, identifiers, chunk_size=5000) -> dict[uuid.UUID, int]:
+        """
+        Returns the IDs of the tracks matching the given identifiers, keyed by
+        identifier. Unmatched identifiers are left out.
+        """
+        identifiers = list(identifiers)
+        track_ids = {}
+        for index in range(0, len(identifiers), chunk_size):
+            chunk = identifiers[index : index + chunk_size]
+            track_ids.update(
+                cls.objects.filter(hashed_identifier__in=chunk).values_list(
+                    "hashed_identifier", "id"
                 )
-            persisted_album = Album.get_or_create_by_tagged_data(tagged_data)
-            persisted_track = cls.objects.create(
-                name=tagged_data.title,
-                track_number=tagged_data.track,
-                artist=persisted_artist,
-                album=persisted_album,
-                file_path=file_path,
-                hashed_identifier=track_identifier,
             )
-        return persisted_track
+        return track_ids
+
+    @classmethod
+    def find_album_names(cls, artist_track_names) -> dict[tuple[str, str], str]:
+        """
+        Returns the album name for each of the given (artist, track) name pairs
+        that matches tracks from exactly one album, ignoring case.
+        """
+        keys = {
+            (artist_name.lower(), track_name.lower()): (artist_name, track_name)
+            for artist_name, track_name in artist_track_names
+        }
+        if not keys:
+            return {}
+        album_names = defaultdict(set)
+        matching_tracks = (
+            cls.objects.annotate(
+                lower_artist_name=Lower("artist__name"), lower_name=Lower("name")
+            )
+            .filter(
+                lower_artist_name__in={artist_name for artist_name, _ in keys},
+                lower_name__in={track_name for _, track_name in keys},
+                album__isnull=False,
+            )
+            .values_list("lower_artist_name", "lower_name", "album__name")
+        )
+        for artist_name, track_name, album_name in matching_tracks:
+            key = keys.get((artist_name, track_name))
+            if key:
+                album_names[key].add(album_name)
+        return {
+            key: names.pop() for key, names in album_names.items() if len(names) == 1
+        }
+
+    @classmethod
+    def update_search_vectors(cls, track_ids):
+        """
+        Rebuilds the search vectors of the given tracks from their names and the
+        names of their artists and albums, in that order of importance.
+        """
+        raw_query = """
+        UPDATE tracks_track tracks
+        SET search_vector =
+            setweight(to_tsvector(%s, tracks.name), 'A') ||
+            setweight(to_tsvector(%s, coalesce(artists.name, '')), 'B') ||
+            setweight(to_tsvector(%s, coalesce(albums.name, '')), 'C')
+        FROM tracks_track named_tracks
+        LEFT JOIN tracks_artist artists ON artists.id = named_tracks.artist_id
+        LEFT JOIN tracks_album albums ON albums.id = named_tracks.album_id
+        WHERE named_tracks.id = tracks.id AND tracks.id = ANY(%s);
+        """
+        with connection.cursor() as cursor:
+            for chunk in batched(track_ids, 5000):
+                cursor.execute(raw_query, [SEARCH_CONFIG] * 3 + [list(chunk)])
+
+    @classmethod
+    def recount_play_counts(cls):
+        """
+        Recounts the play counts of all tracks from their plays.
+        """
+        plays = (
+            TrackPlay.objects.filter(track=OuterRef("pk"))
+            .values("track")
+            .annotate(play_count=Count("pk"))
+            .values("play_count")
+        )
+        cls.objects.update(play_count=Coalesce(Subquery(plays), 0))
+
+    @classmethod
+    def bump_play_counts(cls, play_counts: dict[int, int]):
+        """
+        Adds the given number of plays to each track, with one update for each
+        distinct number of plays.
+        """
+        track_ids_by_count = defaultdict(list)
+        for track_id, play_count in play_counts.items():
+            track_ids_by_count[play_count].append(track_id)
+        for play_count, track_ids in track_ids_by_count.items():
+            cls.objects.filter(pk__in=track_ids).update(
+                play_count=F("play_count") + play_count
+            )
 
     @classmethod
     def generate_identifier(
@@ -192,6 +258,734 @@ class Track(models.Model):
         return generate_identifier(*valid_args)
 
 
+# the year Last.fm started, plays from before it are taken to be bogus
+FIRST_PLAY_YEAR = 2002
+# years that plays table partitions are known to exist for, or have been detached
+# for, see ensure_partitions
+_partition_years = set()
+
+
 class TrackPlay(models.Model):
-    track = models.ForeignKey(Track, on_delete=models.CASCADE, related_name="plays")
+    """
+    The plays table is partitioned by the year the plays occurred in (see the
+    trackplay_partitions migration), so its primary key is (id, occurred_on) in
+    the DB. Partitions are created as plays for new years are recorded.
+    """
+
+    # lookups by track are covered by the unique constraint
+    track = models.ForeignKey(
+        Track, on_delete=models.CASCADE, related_name="plays", db_index=False
+    )
     occurred_on = models.DateTimeField()
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["track", "occurred_on"], name="unique_track_play"
+            ),
+        ]
+        indexes = [
+            # the order plays are listed in, see KeysetPagination
+            models.Index(fields=["occurred_on", "id"], name="track_play_occurred_idx"),
+        ]
+
+    @classmethod
+    def bulk_record(cls, plays) -> int:
+        """
+        Records the given (track ID, occurred on) plays, skipping any that already
+        exist, and bumps the play counts of their tracks by the plays the insert
+        returns as new. Returns the number of new plays recorded.
+        """
+        plays = set(plays)
+        if not plays:
+            return 0
+        track_ids, occurred_ons = zip(*plays)
+        table = cls._meta.db_table
+        raw_query = f"""
+        INSERT INTO {table} (track_id, occurred_on)
+        SELECT * FROM unnest(%s::bigint[], %s::timestamptz[])
+        ON CONFLICT (track_id, occurred_on) DO NOTHING
+        RETURNING track_id, occurred_on;
+        """
+        with transaction.atomic():
+            cls.ensure_partitions(occurred_ons)
+            with connection.cursor() as cursor:
+                cursor.execute(raw_query, [list(track_ids), list(occurred_ons)])
+                new_plays = cursor.fetchall()
+            play_counts = Counter(track_id for track_id, _ in new_plays)
+            Track.bump_play_counts(play_counts)
+            bump_rollups(play_counts)
+            bump_buckets(new_plays)
+        return len(new_plays)
+
+    @classmethod
+    def ensure_partitions(cls, occurred_ons):
+        """
+        Creates the yearly partitions that plays at the given times belong in, if
+        they don't exist yet. Plays from before Last.fm existed or after next year
+        are left to the default partition rather than getting partitions of their
+        own, as are plays from years whose partitions have been detached.
+        """
+        last_year = timezone.now().astimezone(UTC).year + 1
+        years = {occurred_on.astimezone(UTC).year for occurred_on in occurred_ons}
+        missing_years = sorted(
+            year
+            for year in years - _partition_years
+            if FIRST_PLAY_YEAR <= year <= last_year
+        )
+        if not missing_years:
+            return
+        table = cls._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT child.relname, parent.relname IS NOT NULL "
+                "FROM pg_class child "
+                "LEFT JOIN pg_inherits ON pg_inherits.inhrelid = child.oid "
+                "LEFT JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+                "AND parent.relname = %s "
+                "WHERE child.relname = ANY(%s)",
+                [table, [f"{table}_y{year}" for year in missing_years]],
+            )
+            existing = dict(cursor.fetchall())
+            for year in missing_years:
+                partition = f"{table}_y{year}"
+                if partition in existing:
+                    if not existing[partition]:
+                        logger.info(
+                            "Partition %s is detached, recording its plays in the "
+                            "default partition",
+                            partition,
+                        )
+                    continue
+                try:
+                    with transaction.atomic():
+                        cursor.execute(
+                            f"CREATE TABLE {partition} PARTITION OF {table} "
+                            "FOR VALUES FROM (%s) TO (%s);",
+                            [
+                                datetime(year, 1, 1, tzinfo=UTC),
+                                datetime(year + 1, 1, 1, tzinfo=UTC),
+                            ],
+                        )
+                except DatabaseError:
+                    # e.g. the default partition already has plays in the year
+                    logger.warning(
+                        "Unable to create partition %s, recording its plays in the "
+                        "default partition",
+                        partition,
+                        exc_info=True,
+                    )
+        # a rolled back partition doesn't exist after all
+        transaction.on_commit(lambda: _partition_years.update(missing_years))
+
+
+class PlayRollup(models.Model):
+    """
+    Play and track counts of all the tracks grouped under an album, artist or
+    genre, so the most played of them can be read from an index. Play counts are
+    bumped as plays are recorded, while track counts are refreshed after library
+    imports.
+    """
+
+    # the lookup from a track to what its tracks are grouped by
+    track_path = None
+
+    play_count = models.PositiveBigIntegerField(default=0)
+    track_count = models.PositiveIntegerField(default=0)
+    approx_play_count = models.GeneratedField(
+        expression=F("play_count") / NullIf(F("track_count"), 0),
+        output_field=models.BigIntegerField(null=True),
+        db_persist=True,
+    )
+
+    class Meta:
+        abstract = True
+        indexes = [
+            models.Index(
+                F("approx_play_count").desc(), name="%(class)s_approx_play_idx"
+            ),
+        ]
+
+    @classmethod
+    def bump(cls, play_counts: dict[int, int]):
+        """
+        Adds the given number of plays to the rollup of each album, artist or
+        genre ID.
+        """
+        if not play_counts:
+            return
+        key_field = cls._meta.pk.attname
+        cls.objects.bulk_create(
+            [cls(**{key_field: key}) for key in play_counts], ignore_conflicts=True
+        )
+        keys_by_count = defaultdict(list)
+        for key, play_count in play_counts.items():
+            keys_by_count[play_count].append(key)
+        for play_count, keys in keys_by_count.items():
+            cls.objects.filter(pk__in=keys).update(
+                play_count=F("play_count") + play_count
+            )
+
+    @classmethod
+    def refresh(cls, keys=None, batch_size=5000):
+        """
+        Recalculates the rollups of the given album, artist or genre IDs, or of all
+        of them, from the play counts of their tracks. The given rollups (or the
+        whole table) are locked first, so that plays recorded meanwhile are bumped
+        on top of the recalculated counts rather than lost.
+        """
+        key_field = cls._meta.pk.attname
+        tracks = Track.objects.filter(**{f"{cls.track_path}__isnull": False})
+        rollups = cls.objects.all()
+        if keys is not None:
+            keys = sorted(set(keys))
+            if not keys:
+                return
+            tracks = tracks.filter(**{f"{cls.track_path}__in": keys})
+            rollups = rollups.filter(pk__in=keys)
+        totals = (
+            tracks.values(cls.track_path)
+            .annotate(total_plays=Sum("play_count"), total_tracks=Count("pk"))
+            .values_list(cls.track_path, "total_plays", "total_tracks")
+            .order_by()
+        )
+        with transaction.atomic():
+            if keys is None:
+                # blocks bumps, but not reads, until the refresh is committed
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f"LOCK TABLE {cls._meta.db_table} IN EXCLUSIVE MODE;"
+                    )
+            else:
+                cls.objects.bulk_create(
+                    [cls(**{key_field: key}) for key in keys], ignore_conflicts=True
+                )
+                list(rollups.order_by("pk").select_for_update().values_list("pk"))
+            for batch in batched(totals.iterator(), batch_size):
+                cls.objects.bulk_create(
+                    [
+                        cls(
+                            **{key_field: key},
+                            play_count=play_count,
+                            track_count=track_count,
+                        )
+                        for key, play_count, track_count in batch
+                    ],
+                    update_conflicts=True,
+                    unique_fields=[cls._meta.pk.name],
+                    update_fields=["play_count", "track_count"],
+                )
+            rollups.exclude(pk__in=tracks.values(cls.track_path)).delete()
+
+
+class AlbumRollup(PlayRollup):
+    track_path = "album"
+
+    album = models.OneToOneField(
+        Album, on_delete=models.CASCADE, primary_key=True, related_name="rollup"
+    )
+
+
+class ArtistRollup(PlayRollup):
+    track_path = "artist"
+
+    artist = models.OneToOneField(
+        Artist, on_delete=models.CASCADE, primary_key=True, related_name="rollup"
+    )
+
+
+class GenreRollup(PlayRollup):
+    track_path = "album__genre"
+
+    genre = models.OneToOneField(
+        Genre, on_delete=models.CASCADE, primary_key=True, related_name="rollup"
+    )
+
+
+ROLLUPS = [AlbumRollup, ArtistRollup, GenreRollup]
+
+
+def bump_rollups(play_counts: dict[int, int]):
+    """
+    Adds the given number of plays of each track to the rollups of its album,
+    artist and genre.
+    """
+    rollup_counts = {rollup: Counter() for rollup in ROLLUPS}
+    track_keys = Track.objects.filter(pk__in=play_counts).values_list(
+        "pk", *(rollup.track_path for rollup in ROLLUPS)
+    )
+    for track_id, *keys in track_keys:
+        for rollup, key in zip(ROLLUPS, keys):
+            if key is not None:
+                rollup_counts[rollup][key] += play_counts[track_id]
+    for rollup, counts in rollup_counts.items():
+        rollup.bump(counts)
+
+
+def rollup_keys(track_ids) -> dict[type[PlayRollup], set[int]]:
+    """
+    Returns the IDs of the albums, artists and genres of the given tracks, by the
+    rollup they're kept in.
+    """
+    keys = {rollup: set() for rollup in ROLLUPS}
+    track_keys = Track.objects.filter(pk__in=set(track_ids)).values_list(
+        *(rollup.track_path for rollup in ROLLUPS)
+    )
+    for row in track_keys:
+        for rollup, key in zip(ROLLUPS, row):
+            if key is not None:
+                keys[rollup].add(key)
+    return keys
+
+
+def refresh_rollups(keys: dict[type[PlayRollup], set[int]] | None = None):
+    """
+    Recalculates the given rollups (see rollup_keys), or all of them.
+    """
+    for rollup in ROLLUPS:
+        rollup.refresh(None if keys is None else keys[rollup])
+
+
+class BucketPeriod(models.TextChoices):
+    DAY = "day"
+    MONTH = "month"
+
+
+def bucket_starts(occurred_on) -> dict[str, date]:
+    """
+    Returns the start of each bucket period that the play falls into.
+    """
+    day = timezone.localtime(occurred_on).date()
+    return {BucketPeriod.DAY: day, BucketPeriod.MONTH: day.replace(day=1)}
+
+
+class PlayBucket(models.Model):
+    """
+    Plays of a track, album or artist counted by day and by month, so the plays
+    over any window can be summed from the buckets within it rather than from
+    the plays themselves. Unlike the rollups, album and artist buckets aren't
+    recounted when an import moves a track to another album or artist, so its
+    earlier plays stay where they were until rebuild_rollups is run.
+    """
+
+    # the field counted by and the lookup from a track to it
+    key_field = None
+    track_path = None
+
+    period = models.CharField(max_length=8, choices=BucketPeriod.choices)
+    starts_on = models.DateField()
+    play_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        abstract = True
+        indexes = [
+            models.Index(fields=["period", "starts_on"], name="%(class)s_period_idx"),
+        ]
+
+    @classmethod
+    def bump(cls, play_counts: dict[tuple[int, str, date], int]):
+        """
+        Adds the given number of plays to each (key, period, starts on) bucket.
+        """
+        if not play_counts:
+            return
+        table = cls._meta.db_table
+        key_column = cls._meta.get_field(cls.key_field).column
+        raw_query = f"""
+        INSERT INTO {table} ({key_column}, period, starts_on, play_count)
+        SELECT * FROM unnest(%s::bigint[], %s::varchar[], %s::date[], %s::int[])
+        ON CONFLICT ({key_column}, period, starts_on)
+        DO UPDATE SET play_count = {table}.play_count + EXCLUDED.play_count;
+        """
+        keys, periods, starts_ons = zip(*play_counts)
+        with connection.cursor() as cursor:
+            cursor.execute(
+                raw_query,
+                [
+                    list(keys),
+                    list(periods),
+                    list(starts_ons),
+                    list(play_counts.values()),
+                ],
+            )
+
+    @classmethod
+    def rebuild(cls):
+        """
+        Recounts all of the buckets from the plays. The table is locked first, so
+        that plays recorded meanwhile are bumped on top of the recounts.
+        """
+        table = cls._meta.db_table
+        key_column = cls._meta.get_field(cls.key_field).column
+        track_column = Track._meta.get_field(cls.track_path).column
+        raw_query = f"""
+        INSERT INTO {table} ({key_column}, period, starts_on, play_count)
+        SELECT tracks.{track_column}, %s,
+               date_trunc(%s, plays.occurred_on AT TIME ZONE %s)::date, count(*)
+        FROM tracks_trackplay plays
+        INNER JOIN tracks_track tracks ON tracks.id = plays.track_id
+        WHERE tracks.{track_column} IS NOT NULL
+        GROUP BY 1, 3;
+        """
+        with transaction.atomic(), connection.cursor() as cursor:
+            cursor.execute(f"LOCK TABLE {table} IN EXCLUSIVE MODE;")
+            cursor.execute(f"DELETE FROM {table};")
+            for period in BucketPeriod:
+                cursor.execute(raw_query, [period, period, settings.TIME_ZONE])
+
+
+class TrackPlayBucket(PlayBucket):
+    key_field = "track"
+    track_path = "id"
+
+    track = models.ForeignKey(Track, on_delete=models.CASCADE, related_name="buckets")
+
+    class Meta(PlayBucket.Meta):
+        constraints = [
+            models.UniqueConstraint(
+                fields=["track", "period", "starts_on"], name="unique_track_bucket"
+            ),
+        ]
+
+
+class AlbumPlayBucket(PlayBucket):
+    key_field = "album"
+    track_path = "album"
+
+    album = models.ForeignKey(Album, on_delete=models.CASCADE, related_name="buckets")
+
+    class Meta(PlayBucket.Meta):
+        constraints = [
+            models.UniqueConstraint(
+                fields=["album", "period", "starts_on"], name="unique_album_bucket"
+            ),
+        ]
+
+
+class ArtistPlayBucket(PlayBucket):
+    key_field = "artist"
+    track_path = "artist"
+
+    artist = models.ForeignKey(Artist, on_delete=models.CASCADE, related_name="buckets")
+
+    class Meta(PlayBucket.Meta):
+        constraints = [
+            models.UniqueConstraint(
+                fields=["artist", "period", "starts_on"], name="unique_artist_bucket"
+            ),
+        ]
+
+
+BUCKETS = [TrackPlayBucket, AlbumPlayBucket, ArtistPlayBucket]
+
+
+def bump_buckets(plays):
+    """
+    Adds the given (track ID, occurred on) plays to the buckets of their tracks,
+    albums and artists.
+    """
+    plays = list(plays)
+    if not plays:
+        return
+    bucket_counts = {bucket: Counter() for bucket in BUCKETS}
+    track_keys = {
+        track_id: keys
+        for track_id, *keys in Track.objects.filter(
+            pk__in={track_id for track_id, _ in plays}
+        ).values_list("pk", *(bucket.track_path for bucket in BUCKETS))
+    }
+    for track_id, occurred_on in plays:
+        starts = bucket_starts(occurred_on)
+        for bucket, key in zip(BUCKETS, track_keys.get(track_id, ())):
+            if key is not None:
+                for period, starts_on in starts.items():
+                    bucket_counts[bucket][(key, period, starts_on)] += 1
+    for bucket, counts in bucket_counts.items():
+        bucket.bump(counts)
+
+
+def rebuild_buckets():
+    for bucket in BUCKETS:
+        bucket.rebuild()
+
+
+class UnmatchedScrobble(models.Model):
+    """
+    Scrobbles that couldn't be matched to a library track, kept so they can be
+    recorded as plays once the library has a matching track.
+    """
+
+    artist_name = models.CharField(max_length=2048, null=True)
+    album_name = models.CharField(max_length=2048, null=True)
+    track_name = models.CharField(max_length=2048, null=True)
+    occurred_on = models.DateTimeField()
+    hashed_identifier = models.UUIDField(db_index=True)
+    created_on = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["hashed_identifier", "occurred_on"],
+                name="unique_unmatched_scrobble",
+            ),
+        ]
+
+    @classmethod
+    def bulk_add(cls, scrobbles):
+        """
+        Adds the given scrobbles (with artist, album and track names along with
+        when they occurred), skipping any that are already pending.
+        """
+        cls.objects.bulk_create(
+            [
+                cls(
+                    artist_name=scrobble.artist_name,
+                    album_name=scrobble.album_name,
+                    track_name=scrobble.track_name,
+                    occurred_on=scrobble.occurred_on,
+                    hashed_identifier=Track.generate_identifier(
+                        scrobble.track_name,
+                        artist_name=scrobble.artist_name,
+                        album_name=scrobble.album_name,
+                    ),
+                )
+                for scrobble in scrobbles
+            ],
+            ignore_conflicts=True,
+        )
+
+    @classmethod
+    def resolve_pending(cls, batch_size=5000) -> int:
+        """
+        Records the pending scrobbles that now match a track as plays, matched the
+        same way as new scrobbles (see resolve_tracks). Returns the number of
+        scrobbles resolved.
+        """
+        # matching builds on the models, so is only imported once they're loaded
+        from .matching import resolve_tracks
+
+        resolved = 0
+        last_pk = 0
+        while batch := list(
+            cls.objects.filter(pk__gt=last_pk)
+            .order_by("pk")
+            .values_list(
+                "pk", "artist_name", "track_name", "album_name", "occurred_on"
+            )[:batch_size]
+        ):
+            last_pk = batch[-1][0]
+            track_ids = resolve_tracks(
+                [
+                    (artist_name, track_name, album_name)
+                    for _, artist_name, track_name, album_name, _ in batch
+                ]
+            )
+            matches = [
+                (pk, track_id, occurred_on)
+                for (pk, *_, occurred_on), track_id in zip(batch, track_ids)
+                if track_id is not None
+            ]
+            if not matches:
+                continue
+            with transaction.atomic():
+                TrackPlay.bulk_record(
+                    (track_id, occurred_on) for _, track_id, occurred_on in matches
+                )
+                cls.objects.filter(pk__in=[pk for pk, _, _ in matches]).delete()
+            resolved += len(matches)
+        if resolved:
+            logger.info("Resolved %d unmatched scrobbles", resolved)
+        return resolved
+
+
+class LibraryFile(models.Model):
+    """
+    Manifest of every music file seen by the library import, used to avoid
+    re-reading the tags of files that haven't changed since the last import.
+    """
+
+    file_path = models.FilePathField(
+        path=library_directory, max_length=2048, unique=True
+    )
+    size = models.PositiveBigIntegerField()
+    mtime_ns = models.PositiveBigIntegerField()
+    inode = models.PositiveBigIntegerField()
+    tag_digest = models.CharField(max_length=64)
+    track = models.ForeignKey(
+        Track, on_delete=models.SET_NULL, null=True, related_name="library_files"
+    )
+    is_missing = models.BooleanField(default=False)
+    imported_on = models.DateTimeField(null=True)
+
+    @classmethod
+    def load_manifest(cls, base_directory) -> dict[str, ManifestEntry]:
+        """
+        Returns the manifest entries of all files found within the given directory,
+        keyed by file path.
+        """
+        prefix = os.path.join(str(base_directory), "")
+        return cls._to_manifest(
+            cls.objects.filter(file_path__startswith=prefix, is_missing=False)
+        )
+
+    @classmethod
+    def load_file_manifest(
+        cls, file_paths, chunk_size=1000
+    ) -> dict[str, ManifestEntry]:
+        """
+        Returns the manifest entries of the given files, keyed by file path.
+        """
+        file_paths = list(file_paths)
+        manifest = {}
+        for index in range(0, len(file_paths), chunk_size):
+            chunk = file_paths[index : index + chunk_size]
+            manifest.update(
+                cls._to_manifest(
+                    cls.objects.filter(file_path__in=chunk, is_missing=False)
+                )
+            )
+        return manifest
+
+    @staticmethod
+    def _to_manifest(queryset) -> dict[str, ManifestEntry]:
+        return {
+            file_path: ManifestEntry(*entry)
+            for file_path, *entry in queryset.values_list(
+                "file_path",
+                "size",
+                "mtime_ns",
+                "inode",
+                "tag_digest",
+                "track_id",
+                "imported_on",
+            )
+        }
+
+    @staticmethod
+    def is_unchanged(entry: ManifestEntry, file_stat: os.stat_result):
+        return (
+            entry.size == file_stat.st_size
+            and entry.mtime_ns == file_stat.st_mtime_ns
+            and entry.inode == stat_inode(file_stat)
+        )
+
+    @classmethod
+    def mark_missing(cls, file_paths, chunk_size=1000):
+        """
+        Flags the given files, and the tracks imported from them, as no longer
+        present in the library. Tracks that were also imported from files that are
+        still present, e.g. copies in other formats, move to one of those instead.
+        """
+        file_paths = list(file_paths)
+        other_files = cls.objects.filter(
+            track=OuterRef("pk"), is_missing=False
+        ).order_by("file_path")
+        for index in range(0, len(file_paths), chunk_size):
+            chunk = file_paths[index : index + chunk_size]
+            cls.objects.filter(file_path__in=chunk).update(is_missing=True)
+            Track.objects.filter(file_path__in=chunk).update(
+                file_path=Coalesce(
+                    Subquery(other_files.values("file_path")[:1]), F("file_path")
+                ),
+                is_missing=~Exists(other_files),
+            )
+
+    @classmethod
+    def move(cls, src_path, dest_path, is_directory=False):
+        """
+        Rewrites the paths of a moved file or directory, along with the tracks
+        imported from it, returning the number of files moved.
+        """
+        if is_directory:
+            src_prefix = os.path.join(src_path, "")
+            dest_prefix = os.path.join(dest_path, "")
+            src_filter = {"file_path__startswith": src_prefix}
+            dest_filter = {"file_path__startswith": dest_prefix}
+            moved_path = Concat(
+                Value(dest_prefix), Substr("file_path", len(src_prefix) + 1)
+            )
+        else:
+            src_filter = {"file_path": src_path}
+            dest_filter = {"file_path": dest_path}
+            moved_path = Value(dest_path)
+
+        with transaction.atomic():
+            # anything already at the destination has been replaced by the move
+            Track.objects.filter(**dest_filter).update(is_missing=True)
+            cls.objects.filter(**dest_filter).delete()
+            Track.objects.filter(**src_filter).update(file_path=moved_path)
+            return cls.objects.filter(**src_filter).update(file_path=moved_path)
+
+
+class LibraryImport(models.Model):
+    """
+    Checkpoints of a library import run, so an interrupted import can skip the
+    base directories it already committed.
+    """
+
+    library_directory = models.CharField(max_length=2048)
+    started_on = models.DateTimeField(auto_now_add=True)
+    completed_on = models.DateTimeField(null=True)
+    completed_directories = models.JSONField(default=list)
+
+    @classmethod
+    def start(cls, library_directory, resume=False):
+        if resume:
+            library_import = (
+                cls.objects.filter(library_directory=str(library_directory))
+                .order_by("-started_on")
+                .first()
+            )
+            if library_import and not library_import.completed_on:
+                logger.info(
+                    "Resuming import started on %s with %d completed directories",
+                    library_import.started_on,
+                    len(library_import.completed_directories),
+                )
+                return library_import
+            logger.info("No interrupted import to resume, starting a new import")
+        return cls.objects.create(library_directory=str(library_directory))
+
+    def complete_directories(self, directory_names):
+        self.completed_directories.extend(directory_names)
+        self.save(update_fields=["completed_directories"])
+
+    def complete(self):
+        self.completed_on = timezone.now()
+        self.save(update_fields=["completed_on"])
+
+
+class ScrobbleSync(models.Model):
+    """
+    Watermark of the newest scrobble committed for each Last.fm user, so each
+    sync only needs to fetch the scrobbles that came after it.
+    """
+
+    username = models.CharField(max_length=255, unique=True)
+    synced_until = models.DateTimeField()
+    updated_on = models.DateTimeField(auto_now=True)
+
+    @classmethod
+    def get_watermark(cls, username) -> datetime | None:
+        """
+        Returns the user's watermark, or None if they've never been synced. Plays
+        recorded otherwise, e.g. scrobbled to the bridge, don't count, since
+        older Last.fm scrobbles may still be missing.
+        """
+        return (
+            cls.objects.filter(username=username)
+            .values_list("synced_until", flat=True)
+            .first()
+        )
+
+    @classmethod
+    def advance(cls, username, occurred_on):
+        """
+        Moves the watermark forward to the given time; it never moves backward.
+        """
+        sync, created = cls.objects.select_for_update().get_or_create(
+            username=username, defaults={"synced_until": occurred_on}
+        )
+        if not created and occurred_on > sync.synced_until:
+            sync.synced_until = occurred_on
+            sync.save(update_fields=["synced_until", "updated_on"])
@@ -0,0 +1,90 @@
+"""
+In-memory store of what each user is currently playing.
+
+Now playing updates are frequent and only matter for as long as the track plays,
+so they're never saved to the DB. Each update expires once the track should have
+finished playing, and waiters are woken on every change so the web UI can be
+pushed updates rather than polling.
+"""
+
+import threading
+import time
+from collections import namedtuple
+from datetime import UTC, datetime, timedelta
+
+# used when the player doesn't send the track's duration
+DEFAULT_DURATION = timedelta(minutes=10)
+
+NowPlaying = namedtuple(
+    "NowPlaying",
+    "username, artist_name, track_name, album_name, started_on, expires_on",
+)
+
+
+class NowPlayingStore:
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._now_playing: dict[str, NowPlaying] = {}
+        self._expiry_times: dict[str, float] = {}
+        self.version = 0
+
+    def update(self, username, artist_name, track_name, album_name=None, duration=None):
+        duration = duration or DEFAULT_DURATION
+        started_on = datetime.now(tz=UTC)
+        with self._condition:
+            self._now_playing[username] = NowPlaying(
+                username=username,
+                artist_name=artist_name,
+                track_name=track_name,
+                album_name=album_name,
+                started_on=started_on,
+                expires_on=started_on + duration,
+            )
+            self._expiry_times[username] = time.monotonic() + duration.total_seconds()
+            self._changed()
+
+    def _changed(self):
+        self.version += 1
+        self._condition.notify_all()
+
+    def _expire(self, now) -> float | None:
+        # returns when the next entry expires, so waiters can wake up for it
+        expired = [
+            username
+            for username, expires_at in self._expiry_times.items()
+            if expires_at <= now
+        ]
+        for username in expired:
+            del self._now_playing[username]
+            del self._expiry_times[username]
+        if expired:
+            self._changed()
+        return min(self._expiry_times.values(), default=None)
+
+    def get_all(self) -> tuple[int, list[NowPlaying]]:
+        """
+        Returns the current version of the store along with what's playing.
+        """
+        with self._condition:
+            self._expire(time.monotonic())
+            return self.version, list(self._now_playing.values())
+
+    def wait_for_change(self, since_version, timeout) -> tuple[int, list[NowPlaying]]:
+        """
+        Waits up to the timeout for the store to change from the given version,
+        returning the latest version and what's playing either way.
+        """
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while True:
+                now = time.monotonic()
+                next_expiry = self._expire(now)
+                if self.version != since_version or now >= deadline:
+                    return self.version, list(self._now_playing.values())
+                wake_at = (
+                    deadline if next_expiry is None else min(deadline, next_expiry)
+                )
+                self._condition.wait(wake_at - now)
+
+
+now_playing_store = NowPlayingStore()
@@ -1,33 +1,33 @@
 from datetime import datetime
 from typing import Annotated, Optional
 
-from ninja import FilterLookup, FilterSchema, Schema
+from ninja import Field, FilterLookup, FilterSchema, Schema
 
 
 class ArtistSchema(Schema):
     name: str
-    artist_id: int
+    artist_id: int = Field(alias="id")
 
 
 class GenreSchema(Schema):
     name: str
-    genre_id: int
+    genre_id: int = Field(alias="id")
 
 
 class AlbumSchema(Schema):
-    album_id: int
+    album_id: int = Field(alias="id")
     name: str
     artist_id: int
-    album_artist_id: int
-    genre_id: int
-    disc_number: int
+    album_artist_id: Optional[int]
+    genre_id: Optional[int]
+    disc_number: Optional[int]
 
 
 class TrackSchema(Schema):
-    track_id: int
-    artist_id: int
-    album_id: int
-    track_number: int
+    track_id: int = Field(alias="id")
+    artist_id: Optional[int]
+    album_id: Optional[int]
+    track_number: Optional[int]
     name: str
     play_count: int
 
@@ -46,3 +46,33 @@ class TrackPlaySchema(Schema):
 
 class TrackPlayFilterSchema(FilterSchema):
     track_id: Optional[int] = None
+
+
+class NowPlayingSchema(Schema):
+    username: str
+    artist_name: str
+    track_name: str
+    album_name: Optional[str]
+    started_on: datetime
+    expires_on: datetime
+
+
+class NowPlayingListSchema(Schema):
+    version: int
+    now_playing: list[NowPlayingSchema]
+
+
+class SearchResultSchema(Schema):
+    type: str
+    id: int
+    name: str
+    artist_name: Optional[str]
+    album_name: Optional[str]
+    rank: float
+
+
+class ChartEntrySchema(Schema):
+    id: int
+    name: str
+    artist_name: Optional[str]
+    play_count: int
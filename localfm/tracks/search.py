@@ -0,0 +1,89 @@
+"""
+Ranked search of the library by name, backed by Postgres full-text search.
+
+Artists and albums are searched by their names, and tracks by their own names
+along with those of their artists and albums. Each word searched for is matched
+as a prefix, so results can be shown as the user types. The text searched for is
+split into words by Postgres, the same way as the indexed names, since it keeps
+punctuated words such as "AC/DC" or "R.E.M." whole.
+"""
+
+from collections import namedtuple
+
+from django.contrib.postgres.search import SearchQuery, SearchRank
+from django.db import connection
+from django.db.models import F
+
+from .models import SEARCH_CONFIG, Album, Artist, Track
+
+SearchResult = namedtuple(
+    "SearchResult", "type, id, name, artist_name, album_name, rank"
+)
+
+
+def search_words(text) -> list[str]:
+    """
+    Returns the words (lexemes) Postgres indexes the text as.
+    """
+    if not text.strip():
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT tsvector_to_array(to_tsvector(%s::regconfig, %s))",
+            [SEARCH_CONFIG, text],
+        )
+        return cursor.fetchone()[0]
+
+
+def quote_word(word) -> str:
+    escaped = word.replace("\\", "\\\\").replace("'", "''")
+    return f"'{escaped}'"
+
+
+def to_search_query(text) -> SearchQuery | None:
+    """
+    Returns the query matching all of the words in the text as prefixes, or None
+    if there's nothing to search for.
+    """
+    words = search_words(text)
+    if not words:
+        return None
+    return SearchQuery(
+        " & ".join(f"{quote_word(word)}:*" for word in words),
+        config=SEARCH_CONFIG,
+        search_type="raw",
+    )
+
+
+def search_library(text, limit=20) -> list[SearchResult]:
+    """
+    Returns the artists, albums and tracks best matching the text, best first.
+    """
+    query = to_search_query(text)
+    if query is None:
+        return []
+
+    def ranked(queryset, *fields):
+        return (
+            queryset.filter(search_vector=query)
+            .annotate(rank=SearchRank(F("search_vector"), query))
+            .order_by("-rank", "pk")
+            .values_list("pk", *fields, "rank")[:limit]
+        )
+
+    results = [
+        SearchResult("artist", pk, name, None, None, rank)
+        for pk, name, rank in ranked(Artist.objects, "name")
+    ]
+    results.extend(
+        SearchResult("album", pk, name, artist_name, None, rank)
+        for pk, name, artist_name, rank in ranked(Album.objects, "name", "artist__name")
+    )
+    results.extend(
+        SearchResult("track", pk, name, artist_name, album_name, rank)
+        for pk, name, artist_name, album_name, rank in ranked(
+            Track.objects, "name", "artist__name", "album__name"
+        )
+    )
+    results.sort(key=lambda result: result.rank, reverse=True)
+    return results[:limit]
@@ -0,0 +1,20 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .matching import identifier_cache, refresh_match_index, remove_from_match_index
+from .models import Track
+
+
+@receiver(post_save, sender=Track)
+def track_saved(sender, instance, **kwargs):
+    # the track's identifier could have changed, so its old entry goes too
+    identifier_cache.invalidate([instance.hashed_identifier])
+    identifier_cache.invalidate_tracks([instance.pk])
+    refresh_match_index([instance.pk])
+
+
+@receiver(post_delete, sender=Track)
+def track_deleted(sender, instance, **kwargs):
+    identifier_cache.invalidate([instance.hashed_identifier])
+    identifier_cache.invalidate_tracks([instance.pk])
+    remove_from_match_index([instance.pk])
@@ -0,0 +1,66 @@
+"""
+Reads the tags of music files. Nothing here may depend on Django since it runs
+in the worker processes of the library import.
+"""
+
+import hashlib
+import os
+from collections import namedtuple
+
+from tinytag import TinyTag
+
+TaggedFile = namedtuple(
+    "TaggedFile",
+    "file_path, title, artist, albumartist, album, genre, disc, track, tag_digest",
+)
+
+
+def is_supported_file(name):
+    file_extension = os.path.splitext(name)[1]
+    return file_extension in TinyTag.SUPPORTED_FILE_EXTENSIONS
+
+
+def generate_tag_digest(tagged_data: TinyTag):
+    hasher = hashlib.md5(usedforsecurity=False)
+    # unlike identifiers, any change to the tags (including capitalisation)
+    # should be picked up by the next import
+    for arg in (
+        tagged_data.title,
+        tagged_data.artist,
+        tagged_data.albumartist,
+        tagged_data.album,
+        tagged_data.genre,
+        tagged_data.disc,
+        tagged_data.track,
+    ):
+        hasher.update(repr(arg).encode())
+    return hasher.hexdigest()
+
+
+def read_tagged_file(file_path) -> TaggedFile:
+    tagged_data = TinyTag.get(file_path)
+    return TaggedFile(
+        file_path=str(file_path),
+        title=tagged_data.title,
+        artist=tagged_data.artist,
+        albumartist=tagged_data.albumartist,
+        album=tagged_data.album,
+        genre=tagged_data.genre,
+        disc=tagged_data.disc,
+        track=tagged_data.track,
+        tag_digest=generate_tag_digest(tagged_data),
+    )
+
+
+def read_tagged_files(file_paths) -> list[TaggedFile | Exception]:
+    """
+    Reads the tags of all given files, returning the error in place of the tagged
+    data for any file that couldn't be read.
+    """
+    results = []
+    for file_path in file_paths:
+        try:
+            results.append(read_tagged_file(file_path))
+        except Exception as exc:
+            results.append(exc)
+    return results
@@ -1,3 +1,865 @@
-from django.test import TestCase
+import os
+import tempfile
+import threading
+import time
+import uuid
+from datetime import UTC, date, datetime, timedelta
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+
+from localfm.bridge.scrobbles import Scrobble
+from localfm.tracks.charts import top_played
+from localfm.tracks.importer import LibraryImporter
+from localfm.tracks.library import LibraryChangeQueue, LibraryChanges, LibraryMove
+from localfm.tracks.matching import (
+    IdentifierCache,
+    TrackMatchIndex,
+    identifier_cache,
+    normalise_name,
+    resolve_identifiers,
+)
+from localfm.tracks.models import (
+    Album,
+    AlbumPlayBucket,
+    AlbumRollup,
+    Artist,
+    ArtistRollup,
+    BucketPeriod,
+    Genre,
+    GenreRollup,
+    LibraryFile,
+    Track,
+    TrackPlay,
+    TrackPlayBucket,
+    UnmatchedScrobble,
+    refresh_rollups,
+)
+from localfm.tracks.now_playing import now_playing_store
+from localfm.tracks.search import search_library
+from localfm.tracks.tags import TaggedFile
+
+
+class LibraryChangeQueueTests(SimpleTestCase):
+    def test_coalesces_changes(self):
+        queue = LibraryChangeQueue(debounce_seconds=0.05)
+        for path in ("/lib/a.mp3", "/lib/b.mp3", "/lib/a.mp3"):
+            queue.put(path)
+        self.assertEqual(
+            queue.take(timeout=1), LibraryChanges([], ["/lib/a.mp3", "/lib/b.mp3"])
+        )
+        self.assertIsNone(queue.take(timeout=0.1))
+
+    def test_waits_for_quiet(self):
+        queue = LibraryChangeQueue(debounce_seconds=0.3)
+        queue.put("/lib/a.mp3")
+        self.assertIsNone(queue.take(timeout=0.05))
+        queue.put("/lib/b.mp3")
+        started_at = time.monotonic()
+        changes = queue.take(timeout=1)
+        self.assertGreaterEqual(time.monotonic() - started_at, 0.25)
+        self.assertEqual(changes.paths, ["/lib/a.mp3", "/lib/b.mp3"])
+
+    def test_releases_after_max_delay(self):
+        queue = LibraryChangeQueue(debounce_seconds=0.2, max_delay_seconds=0.3)
+        stop = threading.Event()
+
+        def keep_changing():
+            index = 0
+            while not stop.is_set():
+                queue.put(f"/lib/{index}.mp3")
+                index += 1
+                time.sleep(0.02)
+
+        changer = threading.Thread(target=keep_changing)
+        changer.start()
+        try:
+            started_at = time.monotonic()
+            changes = queue.take(timeout=2)
+            elapsed = time.monotonic() - started_at
+        finally:
+            stop.set()
+            changer.join()
+        self.assertIsNotNone(changes)
+        self.assertLess(elapsed, 1)
+        self.assertEqual(changes.paths[0], "/lib/0.mp3")
+
+    def test_implied_moves_are_dropped(self):
+        queue = LibraryChangeQueue(debounce_seconds=0)
+        queue.put_move("/lib/A", "/lib/B", is_directory=True)
+        # the moves of the files within the directory are implied by its move
+        queue.put_move("/lib/A/x.mp3", "/lib/B/x.mp3")
+        queue.put_move("/lib/A/sub", "/lib/B/sub", is_directory=True)
+        # whereas these aren't
+        queue.put_move("/lib/A/y.mp3", "/lib/C/y.mp3")
+        queue.put_move("/lib/AB/z.mp3", "/lib/B/z.mp3")
+        self.assertEqual(
+            queue.take(timeout=1).moves,
+            [
+                LibraryMove("/lib/A", "/lib/B", True),
+                LibraryMove("/lib/A/y.mp3", "/lib/C/y.mp3", False),
+                LibraryMove("/lib/AB/z.mp3", "/lib/B/z.mp3", False),
+            ],
+        )
+
+    def test_queued_paths_follow_moves(self):
+        queue = LibraryChangeQueue(debounce_seconds=0)
+        queue.put("/lib/A/x.mp3")
+        queue.put("/lib/AB/y.mp3")
+        queue.put("/lib/A")
+        queue.put_move("/lib/A", "/lib/B", is_directory=True)
+        self.assertEqual(
+            queue.take(timeout=1).paths,
+            ["/lib/B/x.mp3", "/lib/AB/y.mp3", "/lib/B"],
+        )
+
+
+class LibraryFileMoveTests(TestCase):
+    def add_file(self, file_path) -> Track:
+        track = Track.objects.create(
+            name=file_path, file_path=file_path, hashed_identifier=uuid.uuid4()
+        )
+        LibraryFile.objects.create(
+            file_path=file_path,
+            size=1,
+            mtime_ns=1,
+            inode=1,
+            tag_digest="digest",
+            track=track,
+        )
+        return track
+
+    def test_move_directory(self):
+        moved = self.add_file("/lib/A/x.mp3")
+        unmoved = self.add_file("/lib/AB/y.mp3")
+        replaced = self.add_file("/lib/B/x.mp3")
+        self.assertEqual(LibraryFile.move("/lib/A", "/lib/B", is_directory=True), 1)
+        self.assertEqual(
+            sorted(LibraryFile.objects.values_list("file_path", "track")),
+            [("/lib/AB/y.mp3", unmoved.pk), ("/lib/B/x.mp3", moved.pk)],
+        )
+        for track in (moved, unmoved, replaced):
+            track.refresh_from_db()
+        self.assertEqual(moved.file_path, "/lib/B/x.mp3")
+        self.assertEqual(unmoved.file_path, "/lib/AB/y.mp3")
+        self.assertTrue(replaced.is_missing)
+
+    def test_move_file(self):
+        track = self.add_file("/lib/A/x.mp3")
+        self.assertEqual(LibraryFile.move("/lib/A/x.mp3", "/lib/A/renamed.mp3"), 1)
+        track.refresh_from_db()
+        self.assertEqual(track.file_path, "/lib/A/renamed.mp3")
+        self.assertEqual(track.library_files.get().file_path, "/lib/A/renamed.mp3")
+
+
+class LibraryImporterTests(TestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = Path(directory.name)
+        self.importer = LibraryImporter()
+
+    def import_file(self, name, title="Song", artist="Artist", track=1):
+        file_path = self.directory / name
+        file_path.touch()
+        self.importer.add(
+            os.stat(file_path),
+            TaggedFile(
+                str(file_path), title, artist, None, "Album", "Rock", 1, track, name
+            ),
+        )
+        self.importer.flush()
+        return str(file_path)
+
+    def test_copies_keep_the_stored_file(self):
+        flac_path = self.import_file("song.flac")
+        mp3_path = self.import_file("song.mp3")
+        self.import_file("song.flac")
+        self.import_file("song.mp3")
+        track = Track.objects.get()
+        self.assertEqual(track.file_path, flac_path)
+        self.assertEqual(
+            sorted(track.library_files.values_list("file_path", flat=True)),
+            [flac_path, mp3_path],
+        )
+
+        # the copy takes over once the stored file goes missing
+        LibraryFile.mark_missing([flac_path])
+        track.refresh_from_db()
+        self.assertEqual((track.file_path, track.is_missing), (mp3_path, False))
+        LibraryFile.mark_missing([mp3_path])
+        track.refresh_from_db()
+        self.assertEqual((track.file_path, track.is_missing), (mp3_path, True))
+
+        self.import_file("song.flac", track=2)
+        track.refresh_from_db()
+        self.assertEqual(
+            (track.file_path, track.is_missing, track.track_number),
+            (flac_path, False, 2),
+        )
+
+    def test_re_tagged_file_updates_its_track(self):
+        self.import_file("song.mp3")
+        self.import_file("song.mp3", track=2)
+        self.assertEqual(Track.objects.get().track_number, 2)
+
+    def test_skipped_files_are_kept_in_the_manifest(self):
+        with self.assertLogs("localfm.tracks.importer", "ERROR"):
+            file_path = self.import_file("song.mp3", artist=None)
+        self.assertFalse(Track.objects.exists())
+        manifest = LibraryFile.load_file_manifest([file_path])
+        self.assertIsNone(manifest[file_path].track_id)
+        self.assertTrue(
+            LibraryFile.is_unchanged(manifest[file_path], os.stat(file_path))
+        )
+
+
+def create_track(name, artist_name="Artist", album_name="Album", genre_name="Rock"):
+    artist, _ = Artist.objects.get_or_create(name=artist_name)
+    genre, _ = Genre.objects.get_or_create(name=genre_name)
+    album, _ = Album.objects.get_or_create(
+        hashed_identifier=Album.generate_identifier(
+            album_name, artist_name=artist_name, genre=genre_name
+        ),
+        defaults={"name": album_name, "artist": artist, "genre": genre},
+    )
+    return Track.objects.create(
+        name=name,
+        artist=artist,
+        album=album,
+        file_path=f"/lib/{artist_name}/{album_name}/{name}.mp3",
+        hashed_identifier=Track.generate_identifier(
+            name, artist_name=artist_name, album_name=album_name
+        ),
+    )
+
+
+class BulkRecordTests(TestCase):
+    def setUp(self):
+        self.track = create_track("One")
+        self.other_track = create_track("Two", album_name="Other")
+        self.played_on = datetime(2025, 3, 1, 12, tzinfo=UTC)
+
+    def test_records_new_plays_only(self):
+        plays = [
+            (self.track.pk, self.played_on),
+            (self.track.pk, self.played_on + timedelta(minutes=5)),
+            (self.other_track.pk, self.played_on),
+        ]
+        self.assertEqual(TrackPlay.bulk_record(plays), 3)
+        # repeats, within the batch and of plays already recorded, are skipped
+        repeated = plays + [(self.track.pk, self.played_on + timedelta(days=40))] * 2
+        self.assertEqual(TrackPlay.bulk_record(repeated), 1)
+        self.assertEqual(TrackPlay.bulk_record([]), 0)
+        self.assertEqual(TrackPlay.objects.count(), 4)
+
+        self.track.refresh_from_db()
+        self.other_track.refresh_from_db()
+        self.assertEqual((self.track.play_count, self.other_track.play_count), (3, 1))
+        self.assertEqual(self.track.album.rollup.play_count, 3)
+        self.assertEqual(
+            ArtistRollup.objects.get(pk=self.track.artist_id).play_count, 4
+        )
+        self.assertEqual(
+            GenreRollup.objects.get(pk=self.track.album.genre_id).play_count, 4
+        )
+        self.assertEqual(
+            {
+                (period, starts_on): play_count
+                for period, starts_on, play_count in AlbumPlayBucket.objects.filter(
+                    album=self.track.album
+                ).values_list("period", "starts_on", "play_count")
+            },
+            {
+                (BucketPeriod.DAY, date(2025, 3, 1)): 2,
+                (BucketPeriod.DAY, date(2025, 4, 10)): 1,
+                (BucketPeriod.MONTH, date(2025, 3, 1)): 2,
+                (BucketPeriod.MONTH, date(2025, 4, 1)): 1,
+            },
+        )
+
+
+class RollupTests(TestCase):
+    def setUp(self):
+        self.track = create_track("One")
+        self.other_track = create_track("Two", artist_name="Other", album_name="Other")
+        self.played_on = datetime(2025, 3, 1, 12, tzinfo=UTC)
+
+    def rollups(self, rollup) -> dict[int, tuple[int, int]]:
+        return {
+            pk: (play_count, track_count)
+            for pk, play_count, track_count in rollup.objects.values_list(
+                "pk", "play_count", "track_count"
+            )
+        }
+
+    def test_bump(self):
+        ArtistRollup.bump({self.track.artist_id: 2})
+        ArtistRollup.bump({self.track.artist_id: 1, self.other_track.artist_id: 3})
+        ArtistRollup.bump({})
+        self.assertEqual(
+            self.rollups(ArtistRollup),
+            {self.track.artist_id: (3, 0), self.other_track.artist_id: (3, 0)},
+        )
+
+    def test_refresh(self):
+        TrackPlay.bulk_record(
+            [(self.track.pk, self.played_on), (self.other_track.pk, self.played_on)]
+        )
+        create_track("Three", artist_name="Other", album_name="Other")
+        artist_id = self.track.artist_id
+        Track.objects.filter(pk=self.track.pk).update(artist=self.other_track.artist)
+        ArtistRollup.refresh(keys=[self.other_track.artist_id])
+        self.assertEqual(
+            self.rollups(ArtistRollup),
+            {artist_id: (1, 0), self.other_track.artist_id: (2, 3)},
+        )
+        # the artist with no tracks left is only dropped by refreshing it, or all
+        ArtistRollup.refresh()
+        self.assertEqual(
+            self.rollups(ArtistRollup), {self.other_track.artist_id: (2, 3)}
+        )
+
+    def test_rebuild_rollups(self):
+        TrackPlay.bulk_record(
+            [
+                (self.track.pk, self.played_on),
+                (self.track.pk, self.played_on + timedelta(days=40)),
+                (self.other_track.pk, self.played_on),
+            ]
+        )
+        Track.objects.update(play_count=10)
+        AlbumRollup.objects.update(play_count=10)
+        GenreRollup.objects.all().delete()
+        AlbumPlayBucket.objects.update(play_count=10)
+
+        call_command("rebuild_rollups", log_level="WARNING")
+        self.assertEqual(
+            dict(Track.objects.values_list("pk", "play_count")),
+            {self.track.pk: 2, self.other_track.pk: 1},
+        )
+        self.assertEqual(
+            self.rollups(AlbumRollup),
+            {self.track.album_id: (2, 1), self.other_track.album_id: (1, 1)},
+        )
+        self.assertEqual(self.rollups(GenreRollup), {self.track.album.genre_id: (3, 2)})
+        self.assertEqual(
+            sorted(
+                AlbumPlayBucket.objects.filter(album=self.track.album).values_list(
+                    "period", "starts_on", "play_count"
+                )
+            ),
+            [
+                (BucketPeriod.DAY, date(2025, 3, 1), 1),
+                (BucketPeriod.DAY, date(2025, 4, 10), 1),
+                (BucketPeriod.MONTH, date(2025, 3, 1), 1),
+                (BucketPeriod.MONTH, date(2025, 4, 1), 1),
+            ],
+        )
+
+
+class RollupLockTests(TransactionTestCase):
+    def test_plays_recorded_during_a_refresh_are_kept(self):
+        track = create_track("One")
+        played_on = datetime(2025, 3, 1, 12, tzinfo=UTC)
+        TrackPlay.bulk_record([(track.pk, played_on)])
+        recorded = threading.Event()
+        commit = threading.Event()
+
+        def record():
+            try:
+                with transaction.atomic():
+                    TrackPlay.bulk_record([(track.pk, played_on + timedelta(hours=1))])
+                    recorded.set()
+                    commit.wait()
+            finally:
+                connection.close()
+
+        def refresh():
+            try:
+                refresh_rollups()
+            finally:
+                connection.close()
+
+        recorder = threading.Thread(target=record)
+        recorder.start()
+        recorded.wait()
+        refresher = threading.Thread(target=refresh)
+        refresher.start()
+        # the refresh waits for the play to be committed, rather than reading the
+        # counts without it and then overwriting its bumps
+        refresher.join(timeout=0.5)
+        self.assertTrue(refresher.is_alive())
+        commit.set()
+        recorder.join()
+        refresher.join()
+        for rollup in [AlbumRollup, ArtistRollup, GenreRollup]:
+            with self.subTest(rollup=rollup.__name__):
+                self.assertEqual(rollup.objects.get().play_count, 2)
+
+
+class PartitionTests(TestCase):
+    def setUp(self):
+        self.track = create_track("One")
+
+    def partitions(self) -> dict[datetime, str]:
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT occurred_on, tableoid::regclass::text FROM tracks_trackplay"
+            )
+            return dict(cursor.fetchall())
+
+    def test_plays_go_in_their_years_partition(self):
+        played_on = datetime(2003, 5, 1, tzinfo=UTC)
+        TrackPlay.bulk_record([(self.track.pk, played_on)])
+        self.assertEqual(self.partitions(), {played_on: "tracks_trackplay_y2003"})
+
+    def test_bogus_years_go_in_the_default_partition(self):
+        played_ons = [
+            datetime(1990, 5, 1, tzinfo=UTC),
+            datetime(9999, 5, 1, tzinfo=UTC),
+        ]
+        TrackPlay.bulk_record([(self.track.pk, played_on) for played_on in played_ons])
+        self.assertEqual(
+            self.partitions(),
+            {played_on: "tracks_trackplay_default" for played_on in played_ons},
+        )
+
+    def test_detached_years_go_in_the_default_partition(self):
+        played_on = datetime(2004, 5, 1, tzinfo=UTC)
+        TrackPlay.bulk_record([(self.track.pk, played_on)])
+        with connection.cursor() as cursor:
+            cursor.execute(
+                "ALTER TABLE tracks_trackplay DETACH PARTITION tracks_trackplay_y2004"
+            )
+        later_played_on = played_on + timedelta(days=1)
+        self.assertEqual(TrackPlay.bulk_record([(self.track.pk, later_played_on)]), 1)
+        self.assertEqual(
+            self.partitions(), {later_played_on: "tracks_trackplay_default"}
+        )
+
+
+class NormaliseNameTests(SimpleTestCase):
+    def test_normalise_name(self):
+        for name, normalised in [
+            ("Hey Jude (Remastered 2015)", "hey jude"),
+            ("Song [Deluxe Edition]", "song"),
+            ("Song - 2011 Remaster", "song"),
+            ("Bad (Live at Wembley)", "bad"),
+            ("Track feat. Someone", "track"),
+            ("Track (ft. Someone)", "track"),
+            ("The Beatles", "beatles"),
+            ("Guns N’ Roses", "guns n roses"),
+            ("Guns N' Roses", "guns n roses"),
+            ("Simon & Garfunkel", "simon and garfunkel"),
+            ("Ｆｕｌｌｗｉｄｔｈ", "fullwidth"),
+            ("Paranoid Android", "paranoid android"),
+            # names that are all noise are kept
+            ("(Live)", "live"),
+            (None, ""),
+        ]:
+            with self.subTest(name=name):
+                self.assertEqual(normalise_name(name), normalised)
+
+
+class TrackMatchIndexTests(TestCase):
+    def setUp(self):
+        self.hey_jude = create_track("Hey Jude", "The Beatles", "Hey Jude")
+        self.yesterday = create_track("Yesterday", "The Beatles", "Help!")
+        self.live_yesterday = create_track("Yesterday", "The Beatles", "Live")
+        self.song = create_track("Song", "Someone", "First")
+        self.other_song = create_track("Song", "Someone", "Second")
+        self.symphony = create_track("Symphony No. 6", "Composer", "Symphonies")
+        create_track("Track 11", "Composer", "Symphonies")
+        create_track("Part 2", "Composer", "Symphonies")
+        create_track("Act II", "Composer", "Symphonies")
+        self.index = TrackMatchIndex.build()
+
+    def test_match(self):
+        for names, track in [
+            (("the beatles", "Hey Jude (Remastered 2015)"), self.hey_jude),
+            (("Beatles", "Hey Jude - 2015 Remaster", "Hey Jude"), self.hey_jude),
+            # names that still differ are matched by trigram similarity
+            (("The Beatles Band", "Hey Jud"), self.hey_jude),
+            # the album picks between tracks of the same name
+            (("The Beatles", "Yesterday", "Help! (Deluxe Edition)"), self.yesterday),
+            (("The Beatles", "Yesterday", "Live"), self.live_yesterday),
+            # names with the same numbers can still differ
+            (("Composer", "Symphony 6"), self.symphony),
+        ]:
+            with self.subTest(names=names):
+                self.assertEqual(self.index.match(*names), track.pk)
+
+    def test_no_match(self):
+        for names in [
+            ("The Beatles", "Something"),
+            ("Nobody", "Hey Jude"),
+            ("The Beatles", None),
+            (None, "Hey Jude"),
+            # the best matches can't be told apart
+            ("The Beatles", "Yesterday"),
+            ("Someone", "Song", "Third"),
+            # numbered tracks don't match their siblings
+            ("Composer", "Symphony No. 5"),
+            ("Composer", "Track 10"),
+            ("Composer", "Part 1"),
+            ("Composer", "Act III"),
+        ]:
+            with self.subTest(names=names):
+                self.assertIsNone(self.index.match(*names))
+
+    def test_update_and_remove(self):
+        self.hey_jude.name = "Hey Jude (Take 1)"
+        self.hey_jude.save()
+        self.index.update([self.hey_jude.pk])
+        self.assertEqual(
+            self.index.match("The Beatles", "Hey Jude Take 1"), self.hey_jude.pk
+        )
+        self.index.remove([self.yesterday.pk])
+        self.assertEqual(
+            self.index.match("The Beatles", "Yesterday"), self.live_yesterday.pk
+        )
+        self.assertEqual(len(self.index), 8)
+
+
+class ResolvePendingTests(TestCase):
+    def setUp(self):
+        # the process-wide index and cache could hold tracks of earlier tests
+        match_index = mock.patch("localfm.tracks.matching._match_index", None)
+        match_index.start()
+        self.addCleanup(match_index.stop)
+        identifier_cache.clear()
+        self.addCleanup(identifier_cache.clear)
+
+    def test_resolves_by_name(self):
+        played_on = datetime(2025, 3, 1, tzinfo=UTC)
+        UnmatchedScrobble.bulk_add(
+            [
+                Scrobble(
+                    "Beatles", "Hey Jude", "Hey Jude (Remastered 2015)", played_on
+                ),
+                Scrobble("The Beatles", "Hey Jude", "Hey Jude", played_on),
+                Scrobble("Nobody", None, "Nothing", played_on),
+            ]
+        )
+        self.assertEqual(UnmatchedScrobble.resolve_pending(), 0)
+        track = create_track("Hey Jude", "The Beatles", "Hey Jude")
+        self.assertEqual(UnmatchedScrobble.resolve_pending(), 2)
+        self.assertEqual(
+            list(TrackPlay.objects.values_list("track", "occurred_on")),
+            [(track.pk, played_on)],
+        )
+        self.assertEqual(
+            list(UnmatchedScrobble.objects.values_list("artist_name", flat=True)),
+            ["Nobody"],
+        )
+
+
+class KeysetPaginationTests(TestCase):
+    def walk(self, url, limit=2) -> list[dict]:
+        """
+        Returns every item in the listing, walked forward by the next cursors,
+        after checking that walking back by the previous ones gives the same pages.
+        """
+        pages = []
+        params = {"limit": limit}
+        while True:
+            page = self.client.get(url, params).json()
+            pages.append(page["items"])
+            if not page["next"]:
+                break
+            params = {"limit": limit, "cursor": page["next"]}
+        previous_pages = [pages[-1]]
+        while page["previous"]:
+            page = self.client.get(
+                url, {"limit": limit, "cursor": page["previous"]}
+            ).json()
+            previous_pages.insert(0, page["items"])
+        self.assertEqual(previous_pages, pages)
+        return [item for page in pages for item in page]
+
+    def test_null_and_tied_keys(self):
+        for index in range(3):
+            create_track("Same", f"Artist {index}", "Album")
+            create_track(f"Track {index}", "Artist", "Album", "Pop")
+        for index in range(3):
+            Track.objects.create(
+                name="Same" if index else "Untagged",
+                file_path=f"/lib/untagged/{index}.mp3",
+                hashed_identifier=uuid.uuid4(),
+            )
+        tracks = Track.objects.order_by(
+            "album__genre__name", "artist__name", "album__name", "name", "pk"
+        )
+        for limit in (1, 2, 4):
+            with self.subTest(limit=limit):
+                self.assertEqual(
+                    [track["track_id"] for track in self.walk("/api/v1/tracks", limit)],
+                    list(tracks.values_list("pk", flat=True)),
+                )
+
+    def test_tied_times(self):
+        track = create_track("One")
+        other_track = create_track("Two")
+        played_on = datetime(2025, 3, 1, 12, 0, 0, 123456, tzinfo=UTC)
+        TrackPlay.bulk_record(
+            [
+                (track.pk, played_on),
+                (other_track.pk, played_on),
+                (track.pk, played_on + timedelta(microseconds=1)),
+                (other_track.pk, played_on - timedelta(microseconds=1)),
+                (track.pk, played_on - timedelta(microseconds=1)),
+            ]
+        )
+        # the times in the response only have millisecond precision, so the plays
+        # are told apart by their order
+        plays = TrackPlay.objects.order_by("-occurred_on", "-id")
+        self.assertEqual(
+            [play["track_id"] for play in self.walk("/api/v1/track-plays")],
+            list(plays.values_list("track_id", flat=True)),
+        )
+
+    def test_invalid_cursor(self):
+        response = self.client.get("/api/v1/tracks", {"cursor": "nonsense"})
+        self.assertEqual(response.status_code, 400)
+
+
+class IdentifierCacheTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch("localfm.tracks.matching.time.monotonic", return_value=0)
+        self.monotonic = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = IdentifierCache(max_size=3, ttl=100, missing_ttl=10)
+        self.identifiers = [uuid.uuid4() for _ in range(4)]
+
+    def test_expiry(self):
+        found, missing = self.identifiers[:2]
+        self.cache.set_many({found: 1, missing: None})
+        self.assertEqual(
+            self.cache.get_many([found, missing]), {found: 1, missing: None}
+        )
+
+        self.monotonic.return_value = 10
+        self.assertEqual(self.cache.get_many([found, missing]), {found: 1})
+        self.monotonic.return_value = 100
+        self.assertEqual(self.cache.get_many([found, missing]), {})
+        self.assertEqual(len(self.cache), 0)
+
+    def test_eviction(self):
+        first, second, third, fourth = self.identifiers
+        self.cache.set_many({first: 1, second: 2, third: 3})
+        # reading the first entry makes the second the least recently used
+        self.cache.get_many([first])
+        self.cache.set_many({fourth: 4})
+        self.assertEqual(
+            self.cache.get_many(self.identifiers), {first: 1, third: 3, fourth: 4}
+        )
+        self.assertEqual(self.cache._track_identifiers.keys(), {1, 3, 4})
+
+    def test_invalidate(self):
+        first, second, third, _ = self.identifiers
+        self.cache.set_many({first: 1, second: 1, third: 2})
+        self.cache.invalidate([first])
+        self.assertEqual(self.cache.get_many(self.identifiers), {second: 1, third: 2})
+
+        self.cache.invalidate_tracks([1])
+        self.assertEqual(self.cache.get_many(self.identifiers), {third: 2})
+        self.assertEqual(self.cache._track_identifiers.keys(), {2})
+
+    def test_replaced_entry(self):
+        identifier = self.identifiers[0]
+        self.cache.set_many({identifier: 1})
+        self.cache.set_many({identifier: 2})
+        self.cache.invalidate_tracks([1])
+        self.assertEqual(self.cache.get_many([identifier]), {identifier: 2})
+
+
+class ResolveIdentifiersTests(TestCase):
+    def setUp(self):
+        identifier_cache.clear()
+        self.addCleanup(identifier_cache.clear)
+
+    def test_renamed_track(self):
+        track = create_track("Song")
+        identifier = track.hashed_identifier
+        self.assertEqual(resolve_identifiers([identifier]), {identifier: track.pk})
+        with self.assertNumQueries(0):
+            resolve_identifiers([identifier])
+
+        track.hashed_identifier = Track.generate_identifier(
+            "Renamed", artist_name="Artist", album_name="Album"
+        )
+        track.save()
+        self.assertEqual(len(identifier_cache), 0)
+        self.assertEqual(resolve_identifiers([identifier]), {identifier: None})
+
+
+@mock.patch("localfm.tracks.views.NOW_PLAYING_POLL_SECONDS", 0.01)
+@mock.patch("localfm.tracks.views.NOW_PLAYING_STREAM_POLLS", 2)
+class NowPlayingWaitersTests(SimpleTestCase):
+    def setUp(self):
+        self.waiters = threading.BoundedSemaphore(1)
+        patcher = mock.patch("localfm.tracks.views.now_playing_waiters", self.waiters)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        now_playing_store.update("tester", "Artist", "Song")
+        self.version = now_playing_store.version
+
+    def stream(self) -> str:
+        response = self.client.get("/api/v1/now-playing/events")
+        return b"".join(response.streaming_content).decode()
+
+    def test_slot_released(self):
+        response = self.client.get("/api/v1/now-playing", {"since": self.version})
+        self.assertEqual(response.json()["version"], self.version)
+        self.assertIn(f"id: {self.version}\n", self.stream())
+        self.assertTrue(self.waiters.acquire(blocking=False))
+
+    def test_busy(self):
+        self.waiters.acquire()
+        response = self.client.get("/api/v1/now-playing", {"since": self.version})
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response["Retry-After"], "30")
+
+        events = self.stream()
+        self.assertTrue(events.startswith("retry: 30000\n\n"))
+        self.assertIn(f"id: {self.version}\n", events)
+        self.assertNotIn("keep-alive", events)
+
+
+class SearchTests(TestCase):
+    def setUp(self):
+        tracks = [
+            create_track("Highway to Hell", "AC/DC", "Highway to Hell"),
+            create_track("Losing My Religion", "R.E.M.", "Out of Time"),
+            create_track("All the Small Things", "Blink-182", "Enema of the State"),
+            create_track("Don't Stop Me Now", "Queen", "Jazz"),
+        ]
+        Track.update_search_vectors([track.pk for track in tracks])
+
+    def search(self, text) -> list[tuple[str, str]]:
+        return [(result.type, result.name) for result in search_library(text)]
+
+    def test_punctuated_names(self):
+        for text, artist_name in [
+            ("AC/DC", "AC/DC"),
+            ("ac/d", "AC/DC"),
+            ("R.E.M.", "R.E.M."),
+            ("r.e", "R.E.M."),
+            ("Blink-182", "Blink-182"),
+            ("blink-1", "Blink-182"),
+        ]:
+            with self.subTest(text=text):
+                self.assertEqual(self.search(text)[0], ("artist", artist_name))
+
+    def test_words(self):
+        self.assertCountEqual(
+            self.search("hell highway"),
+            [("album", "Highway to Hell"), ("track", "Highway to Hell")],
+        )
+        self.assertEqual(self.search("don't st"), [("track", "Don't Stop Me Now")])
+        self.assertEqual(self.search("religion queen"), [])
+
+    def test_nothing_to_search_for(self):
+        for text in ["", "  ", "/.-"]:
+            with self.subTest(text=text):
+                self.assertEqual(self.search(text), [])
+
+    def test_api(self):
+        response = self.client.get("/api/v1/search", {"q": "AC/DC"})
+        self.assertCountEqual(
+            [(result["type"], result["name"]) for result in response.json()],
+            [
+                ("artist", "AC/DC"),
+                ("track", "Highway to Hell"),
+            ],
+        )
+
+
+class ChartTests(TestCase):
+    def setUp(self):
+        self.track = create_track("One")
+        self.other_track = create_track("Two", artist_name="Other")
+        # one play a day of the track, either side of the turn of two months and
+        # a leap day
+        self.first_day = date(2023, 12, 15)
+        self.days = 92
+        TrackPlay.bulk_record(
+            [
+                (self.track.pk, datetime(day.year, day.month, day.day, 12, tzinfo=UTC))
+                for day in (
+                    self.first_day + timedelta(days=index) for index in range(self.days)
+                )
+            ]
+        )
+        TrackPlay.bulk_record([(self.other_track.pk, datetime(2024, 3, 1, tzinfo=UTC))])
+
+    def play_count(self, start, end) -> int:
+        last_day = self.first_day + timedelta(days=self.days)
+        return max(0, (min(end, last_day) - max(start, self.first_day)).days)
+
+    def test_windows(self):
+        for start, end in [
+            (date(2024, 1, 1), date(2024, 2, 1)),
+            (date(2024, 1, 1), date(2024, 3, 1)),
+            (date(2023, 12, 31), date(2024, 2, 2)),
+            (date(2024, 2, 29), date(2024, 3, 1)),
+            (date(2024, 1, 15), date(2024, 1, 20)),
+            (date(2024, 1, 2), date(2024, 2, 1)),
+            (date(2023, 12, 1), date(2024, 4, 1)),
+            (date(2023, 11, 1), date(2023, 12, 20)),
+        ]:
+            with self.subTest(start=start, end=end):
+                entries = top_played("tracks", start, end)
+                self.assertEqual(entries[0].id, self.track.pk)
+                self.assertEqual(entries[0].play_count, self.play_count(start, end))
+        self.assertEqual(top_played("tracks", date(2024, 1, 2), date(2024, 1, 2)), [])
+
+    def test_whole_months_are_read_from_monthly_buckets(self):
+        TrackPlayBucket.objects.filter(
+            period=BucketPeriod.DAY, starts_on__month=1
+        ).delete()
+        entries = top_played("tracks", date(2023, 12, 31), date(2024, 2, 2))
+        self.assertEqual(entries[0].play_count, 33)
+
+    @mock.patch(
+        "localfm.tracks.charts.timezone.localdate", return_value=date(2024, 3, 3)
+    )
+    def test_api_default_window(self, localdate):
+        # the last 7 days include today
+        response = self.client.get("/api/v1/charts/artists")
+        self.assertEqual(
+            response.json(),
+            [
+                {
+                    "id": self.track.artist_id,
+                    "name": "Artist",
+                    "artist_name": None,
+                    "play_count": 7,
+                },
+                {
+                    "id": self.other_track.artist_id,
+                    "name": "Other",
+                    "artist_name": None,
+                    "play_count": 1,
+                },
+            ],
+        )
+        response = self.client.get(
+            "/api/v1/charts/albums",
+            {"start": "2024-03-01", "end": "2024-03-02", "limit": 1},
+        )
+        self.assertEqual(
+            response.json(),
+            [
+                {
+                    "id": self.track.album_id,
+                    "name": "Album",
+                    "artist_name": "Artist",
+                    "play_count": 1,
+                }
+            ],
+        )
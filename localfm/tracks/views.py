@@ -1,26 +1,194 @@
+import logging
+import re
+import threading
+from collections import defaultdict
+from datetime import UTC, date, datetime, timedelta
+from typing import Literal, Optional
+
+from django.conf import settings
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils import timezone
 from django.views.generic import TemplateView
 from ninja import Query
 from ninja.pagination import paginate
 
 from localfm.app import v1_api
+from localfm.bridge.ingest import get_active_journal, record_scrobbles
+from localfm.bridge.scrobbles import Scrobble
+from localfm.core.pagination import KeysetPagination
+from localfm.core.responses import lastfm_error_response, lastfm_response
 
-from .models import Album, Artist, Genre, Track, TrackPlay
+from .charts import last_days, top_played
+from .models import FIRST_PLAY_YEAR, Album, Artist, Genre, Track, TrackPlay
+from .now_playing import now_playing_store
 from .payloads import (
     AlbumSchema,
     ArtistSchema,
+    ChartEntrySchema,
     GenreSchema,
+    NowPlayingListSchema,
+    SearchResultSchema,
     TrackFilterSchema,
     TrackPlaySchema,
     TrackSchema,
 )
+from .search import search_library
+
+logger = logging.getLogger(__name__)
+
+# https://www.last.fm/api/show/track.scrobble
+MAX_SCROBBLES_PER_REQUEST = 50
+INDEXED_PARAM_PATTERN = re.compile(r"^(\w+)\[(\d+)\]$")
+SCROBBLE_PARAMS = {"artist", "track", "album", "albumArtist", "timestamp"}
+IGNORED_ARTIST = 1
+IGNORED_TRACK = 2
+IGNORED_TIMESTAMP = 3
+NOW_PLAYING_POLL_SECONDS = 25
+# each open stream holds a server thread, so streams are closed after this many
+# polls and browsers reconnect to them
+NOW_PLAYING_STREAM_POLLS = 4
+# how long browsers wait to reconnect to streams, and long polling clients to
+# poll again, when all the waiter slots are taken
+NOW_PLAYING_BUSY_RETRY_SECONDS = 30
+DEFAULT_CHART_DAYS = 7
+# how far ahead of the server's clock a scrobbling client's clock can be
+MAX_SCROBBLE_CLOCK_SKEW = timedelta(days=1)
+EARLIEST_SCROBBLE = datetime(FIRST_PLAY_YEAR, 1, 1, tzinfo=UTC)
+
+# long polls and event streams hold a server thread while they wait, so only so
+# many can wait at once, leaving the rest of the threads for scrobbles and the UI
+now_playing_waiters = threading.BoundedSemaphore(settings.NOW_PLAYING_MAX_WAITERS)
 
 
 def update_now_playing(request):
-    pass
+    """
+    Records what the user is playing, in memory only, until the track's duration
+    has passed.
+    """
+    params = request.POST
+    artist_name = params.get("artist")
+    track_name = params.get("track")
+    if not artist_name or not track_name:
+        return lastfm_error_response(request, 6, "Invalid parameters")
+    try:
+        duration = timedelta(seconds=int(params["duration"]))
+    except (KeyError, ValueError):
+        duration = None
+    now_playing_store.update(
+        request.user.username,
+        artist_name,
+        track_name,
+        album_name=params.get("album") or None,
+        duration=duration,
+    )
+    return lastfm_response(
+        request,
+        {
+            "@status": "ok",
+            "nowplaying": {
+                "track": {"@corrected": 0, "#text": track_name},
+                "artist": {"@corrected": 0, "#text": artist_name},
+                "album": {"@corrected": 0, "#text": params.get("album")},
+                "albumArtist": {"@corrected": 0, "#text": params.get("albumArtist")},
+                "ignoredMessage": {"@code": 0},
+            },
+        },
+    )
+
+
+def parse_indexed_params(params, max_items=MAX_SCROBBLES_PER_REQUEST):
+    """
+    Groups the indexed request params, e.g. artist[0] and track[0], by index.
+    Unindexed params are treated as index 0.
+    """
+    items = defaultdict(dict)
+    for key, value in params.items():
+        match = INDEXED_PARAM_PATTERN.match(key)
+        if match:
+            name, index = match.group(1), int(match.group(2))
+            if index < max_items:
+                items[index][name] = value
+        elif key in SCROBBLE_PARAMS:
+            items[0].setdefault(key, value)
+    return [items[index] for index in sorted(items)]
+
+
+def to_scrobble(params) -> tuple[Scrobble, int]:
+    """
+    Returns the scrobble for the params, along with the Last.fm ignored message
+    code (0 if it isn't ignored). Scrobbles from before Last.fm existed or from
+    the future are ignored.
+    """
+    occurred_on = None
+    try:
+        occurred_on = datetime.fromtimestamp(int(params["timestamp"]), tz=UTC)
+    except (KeyError, ValueError, OverflowError):
+        pass
+    scrobble = Scrobble(
+        artist_name=params.get("artist") or None,
+        album_name=params.get("album") or None,
+        track_name=params.get("track") or None,
+        occurred_on=occurred_on,
+    )
+    if not scrobble.artist_name:
+        return scrobble, IGNORED_ARTIST
+    if not scrobble.track_name:
+        return scrobble, IGNORED_TRACK
+    if not scrobble.occurred_on:
+        return scrobble, IGNORED_TIMESTAMP
+    latest_scrobble = timezone.now() + MAX_SCROBBLE_CLOCK_SKEW
+    if not EARLIEST_SCROBBLE <= scrobble.occurred_on <= latest_scrobble:
+        return scrobble, IGNORED_TIMESTAMP
+    return scrobble, 0
 
 
 def scrobble(request):
-    pass
+    """
+    Records a batch of up to 50 scrobbles. When the service is ingesting scrobbles
+    in the background they're only journalled here, otherwise all of their tracks
+    are resolved at once and saved in a single transaction.
+    """
+    scrobble_params = [
+        params
+        for params in parse_indexed_params(request.POST)
+        if set(params) & SCROBBLE_PARAMS
+    ]
+    if not scrobble_params:
+        return lastfm_error_response(request, 6, "Invalid parameters")
+
+    scrobbles = [to_scrobble(params) for params in scrobble_params]
+    accepted_scrobbles = [scrobble for scrobble, code in scrobbles if not code]
+    journal = get_active_journal()
+    if journal:
+        # saved to the DB in the background
+        journal.append(accepted_scrobbles)
+    elif accepted_scrobbles:
+        record_scrobbles(accepted_scrobbles)
+
+    return lastfm_response(
+        request,
+        {
+            "@status": "ok",
+            "scrobbles": {
+                "@accepted": len(accepted_scrobbles),
+                "@ignored": len(scrobbles) - len(accepted_scrobbles),
+                "scrobble": [
+                    {
+                        "track": {"@corrected": 0, "#text": params.get("track")},
+                        "artist": {"@corrected": 0, "#text": params.get("artist")},
+                        "album": {"@corrected": 0, "#text": params.get("album")},
+                        "albumArtist": {
+                            "@corrected": 0,
+                            "#text": params.get("albumArtist"),
+                        },
+                        "timestamp": params.get("timestamp"),
+                        "ignoredMessage": {"@code": code},
+                    }
+                    for params, (_, code) in zip(scrobble_params, scrobbles)
+                ],
+            },
+        },
+    )
 
 
 class TracksIndex(TemplateView):
@@ -34,6 +202,17 @@ class TracksIndex(TemplateView):
             .select_related("album", "artist")
             .order_by("-play_count")[:100]
         )
+        today = timezone.localdate()
+        context["weekly_top_tracks"] = top_played("tracks", *last_days(7), limit=30)
+        context["monthly_top_albums"] = top_played(
+            "albums", today.replace(day=1), today + timedelta(days=1), limit=30
+        )
+        context["yearly_top_artists"] = top_played(
+            "artists",
+            today.replace(month=1, day=1),
+            today + timedelta(days=1),
+            limit=30,
+        )
         context["recent_track_plays"] = (
             TrackPlay.objects.all()
             .select_related("track__album", "track__artist")
@@ -43,25 +222,25 @@ class TracksIndex(TemplateView):
 
 
 @v1_api.get("artists", response=list[ArtistSchema])
-@paginate
+@paginate(KeysetPagination)
 def list_artists(request):
     return Artist.objects.all().order_by("name")
 
 
 @v1_api.get("albums", response=list[AlbumSchema])
-@paginate
+@paginate(KeysetPagination)
 def list_albums(request):
     return Album.objects.all().order_by("album_artist__name", "artist__name", "name")
 
 
 @v1_api.get("genres", response=list[GenreSchema])
-@paginate
-def list_albums(request):
+@paginate(KeysetPagination)
+def list_genres(request):
     return Genre.objects.all().order_by("name")
 
 
 @v1_api.get("tracks", response=list[TrackSchema])
-@paginate
+@paginate(KeysetPagination)
 def list_tracks(request, filters: Query[TrackFilterSchema]):
     tracks = Track.objects.all().order_by(
         "album__genre__name", "artist__name", "album__name", "name"
@@ -71,6 +250,103 @@ def list_tracks(request, filters: Query[TrackFilterSchema]):
 
 
 @v1_api.get("track-plays", response=list[TrackPlaySchema])
-@paginate
+@paginate(KeysetPagination)
 def list_track_plays(request):
-    return TrackPlay.objects.all().order_by("-occurred_on")
+    return TrackPlay.objects.all().order_by("-occurred_on", "-id")
+
+
+@v1_api.get("search", response=list[SearchResultSchema])
+def search(request, q: str, limit: int = Query(20, ge=1, le=100)):
+    """
+    Searches artists, albums and tracks by name, returning the best matches of
+    each, best first.
+    """
+    return search_library(q, limit=limit)
+
+
+@v1_api.get("charts/{chart}", response=list[ChartEntrySchema])
+def get_chart(
+    request,
+    chart: Literal["tracks", "albums", "artists"],
+    start: Optional[date] = None,
+    end: Optional[date] = None,
+    limit: int = Query(20, ge=1, le=100),
+):
+    """
+    Returns the most played tracks, albums or artists from the start date up to
+    (but not including) the end date, defaulting to the last 7 days.
+    """
+    default_start, default_end = last_days(DEFAULT_CHART_DAYS)
+    return top_played(chart, start or default_start, end or default_end, limit=limit)
+
+
+@v1_api.get("now-playing", response=NowPlayingListSchema)
+def get_now_playing(request, since: Optional[int] = None):
+    """
+    Returns what's currently playing. If the version of the last response is given
+    as since, waits (long polls) for up to 25 seconds for that to change, or
+    responds with 503 if too many requests are already waiting.
+    """
+    if since is None:
+        version, now_playing = now_playing_store.get_all()
+        return {"version": version, "now_playing": now_playing}
+    if not now_playing_waiters.acquire(blocking=False):
+        response = JsonResponse({"detail": "Too many waiting requests"}, status=503)
+        response["Retry-After"] = str(NOW_PLAYING_BUSY_RETRY_SECONDS)
+        return response
+    try:
+        version, now_playing = now_playing_store.wait_for_change(
+            since, timeout=NOW_PLAYING_POLL_SECONDS
+        )
+    finally:
+        now_playing_waiters.release()
+    return {"version": version, "now_playing": now_playing}
+
+
+@v1_api.get("now-playing/events")
+def stream_now_playing(request):
+    """
+    Pushes what's currently playing as server-sent events whenever it changes.
+    Streams end after a few polls (around 100 seconds) so they don't tie up a
+    server thread for good; browsers reconnect to them automatically, resuming
+    from the last version they were sent. If too many requests are already
+    waiting, what's playing is sent straight away and the stream ends, with
+    browsers told to wait longer before reconnecting.
+    """
+    try:
+        last_version = int(request.headers["Last-Event-ID"])
+    except (KeyError, ValueError):
+        last_version = None
+
+    def event(version, now_playing) -> str:
+        data = NowPlayingListSchema(version=version, now_playing=now_playing)
+        return f"id: {version}\ndata: {data.model_dump_json()}\n\n"
+
+    def events():
+        # the slot is taken here rather than in the view, since the stream is only
+        # iterated (and closed) once the server starts sending it
+        if not now_playing_waiters.acquire(blocking=False):
+            yield f"retry: {NOW_PLAYING_BUSY_RETRY_SECONDS * 1000}\n\n"
+            version, now_playing = now_playing_store.get_all()
+            if version != last_version:
+                yield event(version, now_playing)
+            return
+        try:
+            yield "retry: 1000\n\n"
+            version = last_version
+            for _ in range(NOW_PLAYING_STREAM_POLLS):
+                new_version, now_playing = now_playing_store.wait_for_change(
+                    version, timeout=NOW_PLAYING_POLL_SECONDS
+                )
+                if new_version == version:
+                    # keeps the connection open through any proxies
+                    yield ": keep-alive\n\n"
+                    continue
+                version = new_version
+                yield event(version, now_playing)
+        finally:
+            now_playing_waiters.release()
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    return response
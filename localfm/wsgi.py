@@ -10,6 +10,7 @@ https://docs.djangoproject.com/en/5.2/howto/deployment/wsgi/
 import logging
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 from waitress import create_server
 
@@ -20,10 +21,11 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "localfm.settings")
 logger = logging.getLogger(__name__)
 
 
-def run_wsgi_server(shutdown_token: CancellationToken, listen_address):
-    logger.info("Starting WSGI service at %s", listen_address)
+def run_wsgi_server(shutdown_token: CancellationToken, listen_address, threads=None):
+    threads = threads or settings.SERVER_THREADS
+    logger.info("Starting WSGI service at %s with %d threads", listen_address, threads)
     application = get_wsgi_application()
-    server = create_server(application, listen=listen_address)
+    server = create_server(application, listen=listen_address, threads=threads)
     try:
         while server.map and not shutdown_token.is_canceled():
             server.asyncore.poll(1.0, map=server.map)